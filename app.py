@@ -1,24 +1,107 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-import requests
+from contextlib import asynccontextmanager
+import asyncio
+import httpx
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import logging
+import math
 import time
 import json
 import uuid
-from typing import Optional
+from typing import List, Optional
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+from context import (
+    HISTORY_MAX_TURNS, Turn, build_history_window, build_messages, format_summary, format_turn, history_budget
 )
+from coordination import Coordinator
+from db import WEB_CONCURRENCY, Database, fetch_history, fetch_last_id
+from history_cache import HISTORY_CACHE_VALIDATE, HistoryCache
+from history_maintenance import HistoryMaintainer
+from idempotency import InflightRequests, KeyReused, body_digest, request_key
+from logging_utils import (
+    LOG_FULL_PROMPTS, RequestIdMiddleware, configure_logging, payload_logging_enabled, truncate
+)
+from metrics import (
+    BACKEND_STATS, CONTENT_TYPE, COMPONENT_STATS, ERRORS, MODEL_QUEUE_STATS, MODEL_SELECTIONS, STAGE_SECONDS,
+    TOKENS_PER_SECOND, TOKENS_TOTAL, MetricsMiddleware, render as render_metrics
+)
+from model_registry import FALLBACK_MODEL, PRIMARY_MODEL, ModelRegistry
+from ollama_client import generation_timings, response_text
+from ollama_pool import OllamaPool
+from persistence import TurnWriter
+from response_cache import ResponseCache
+from scheduler import (
+    CLIENT_RATE_BURST, CLIENT_RATE_LIMIT, MODEL_MAX_CONCURRENCY, MODEL_RATE_BURST, MODEL_RATE_LIMIT,
+    SCHEDULER_MAX_QUEUE, SESSION_RATE_BURST, SESSION_RATE_LIMIT, Overloaded, RateLimited, RateLimiter, Scheduler
+)
+from startup import Startup
+
+# Configure structured logging
+configure_logging()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pooled HTTP clients to every Ollama backend, shared by all requests
+    ollama_hosts = os.environ.get("OLLAMA_HOSTS") or os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+    ollama_urls = [host.strip() for host in ollama_hosts.split(",") if host.strip()]
+    logging.info(f"Using Ollama hosts: {ollama_urls}")
+    app.state.ollama = OllamaPool(ollama_urls)
+    await app.state.ollama.start()
+    # Connection pool shared by the history read and write paths
+    app.state.db = Database()
+    await app.state.db.open()
+    # Locks and rate limits shared with the other workers, through PostgreSQL
+    app.state.coordinator = Coordinator(app.state.db)
+    app.state.history_cache = HistoryCache()
+    app.state.response_cache = ResponseCache(app.state.db)
+    # Conversation turns are written in the background in batches
+    app.state.writer = TurnWriter(app.state.db, app.state.history_cache, coordinator=app.state.coordinator)
+    await app.state.writer.start()
+    # Model availability is checked once here and refreshed in the background
+    app.state.models = ModelRegistry(app.state.ollama, coordinator=app.state.coordinator)
+    await app.state.models.start()
+    # Per-model admission control and circuit breakers; the generation slots are
+    # shared by all workers through the coordinator, the queue is split between them
+    app.state.scheduler = Scheduler(
+        MODEL_MAX_CONCURRENCY * len(ollama_urls), max(1, SCHEDULER_MAX_QUEUE // WEB_CONCURRENCY),
+        coordinator=app.state.coordinator
+    )
+    # Per-session and per-client request limits, enforced by each worker at the
+    # configured values without a database round trip. A client's connections
+    # (every streamed reply opens one) land on any worker, so it can get up to
+    # WEB_CONCURRENCY x the configured rate in total
+    app.state.session_limiter = RateLimiter("session", SESSION_RATE_LIMIT, SESSION_RATE_BURST)
+    app.state.client_limiter = RateLimiter("client", CLIENT_RATE_LIMIT, CLIENT_RATE_BURST)
+    # Identical requests in flight share one generation
+    app.state.inflight = InflightRequests()
+    # Partitions, retention and summaries of old turns, in the background
+    app.state.history_maintainer = HistoryMaintainer(
+        app.state.db, app.state.ollama, app.state.models, app.state.scheduler, app.state.history_cache,
+        history_window_tokens(), coordinator=app.state.coordinator
+    )
+    app.state.history_maintainer.start()
+    # Schema, model pulls and model loading finish in the background; /readyz
+    # reports when they are done while /healthz answers right away
+    app.state.startup = Startup(app.state.db, app.state.ollama, app.state.models, warmup_payload)
+    app.state.startup.start()
+    try:
+        yield
+    finally:
+        await app.state.startup.stop()
+        await app.state.history_maintainer.stop()
+        await app.state.models.stop()
+        await app.state.ollama.aclose()
+        # Flush queued turns before the pool goes away
+        await app.state.writer.stop()
+        app.state.coordinator.close()
+        app.state.db.close()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestIdMiddleware)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -31,286 +114,629 @@ class Conversation(BaseModel):
     user_input: str
     session_id: Optional[str] = None
 
-# Function to get conversation history from database
-def get_conversation_history(session_id: str):
+# Function to get a session's summary (or None) and its turns from the cache or
+# database, plus unwritten turns
+async def get_conversation_history(db: Database, cache: HistoryCache, writer: TurnWriter, session_id: str):
+    cached = cache.get(session_id)
+    if cached is not None:
+        if not HISTORY_CACHE_VALIDATE:
+            cache.record_hit()
+            return cached.summary, cached.turns + writer.pending_turns(session_id, cached.last_id)
+        try:
+            # Another worker may have written to this session since it was cached
+            last_id = await db.run(fetch_last_id, session_id)
+        except Exception as e:
+            ERRORS.inc("history_fetch")
+            logging.error(f"Error validating cached history, using cached copy: {e}")
+            cache.record_hit()
+            return cached.summary, cached.turns + writer.pending_turns(session_id, cached.last_id)
+        if last_id == cached.last_id:
+            cache.record_hit()
+            return cached.summary, cached.turns + writer.pending_turns(session_id, cached.last_id)
+        cache.record_stale(session_id)
+    
     try:
-        conn = psycopg2.connect(
-            host="postgres",
-            database="vit",
-            user="vit",
-            password="vit"
-        )
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            "SELECT user_input, model_response FROM conversation_history WHERE session_id = %s ORDER BY timestamp ASC",
-            (session_id,)
-        )
-        history = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        # Log the raw history data
-        logging.info(f"Raw history data for session {session_id}: {json.dumps([dict(h) for h in history])}")
-        
-        # Format history as a conversation string with clear context markers
-        conversation_history = ""
-        for entry in history:
-            conversation_history += f"User: {entry['user_input']}\nAssistant: {entry['model_response']}\n\n"
+        # Only the most recent turns can fit in the context window
+        summary, history = await db.run(fetch_history, session_id, HISTORY_MAX_TURNS)
         
-        # Log the formatted conversation history
-        logging.info(f"Formatted conversation history: {conversation_history}")
+        # Log an excerpt of the raw history data only when debugging
+        if payload_logging_enabled():
+            logging.debug("Raw history data", extra={
+                "session_id": session_id, "history": truncate(json.dumps([dict(h) for h in history]))
+            })
         
-        return conversation_history
+        # Format each turn with clear context markers
+        turns = [format_turn(entry['user_input'], entry['model_response']) for entry in history]
+        last_id = max((entry['id'] for entry in history), default=None)
+        # Turns older than the window are only present as the stored summary
+        summary_turn = format_summary(summary) if summary else None
+        cache.put(session_id, turns, history[-1]['id'] if history else None, summary_turn)
+        return summary_turn, turns + writer.pending_turns(session_id, last_id)
     except Exception as e:
+        ERRORS.inc("history_fetch")
         logging.error(f"Error retrieving conversation history: {e}")
-        return ""
+        return None, writer.pending_turns(session_id)
+
+# Function to queue a conversation turn for the background database writer
+def store_conversation(writer: TurnWriter, session_id: str, user_input: str, model_response: str):
+    logging.debug("Queueing conversation turn", extra={"session_id": session_id})
+    writer.submit(session_id, user_input, model_response)
+
+# Prompt prefix sent ahead of the conversation history
+SYSTEM_INSTRUCTION = """You are an AI assistant having a conversation with a user. 
+        You MUST remember all information shared in this conversation, especially names, preferences, and personal details.
+        When asked about information previously shared, you MUST recall it accurately.
+        Pay special attention to the user's name if they mention it and ALWAYS remember it for future reference.
+        If the user says their name is X, you MUST remember that their name is X and use it when appropriate.
+        Always maintain context throughout the entire conversation.
+        The following is the conversation history:
+        """
+
+# Stable system message for the /api/chat mode, where history is sent as messages
+CHAT_SYSTEM_PROMPT = """You are an AI assistant having a conversation with a user.
+You MUST remember all information shared in this conversation, especially names, preferences, and personal details.
+When asked about information previously shared, you MUST recall it accurately.
+Pay special attention to the user's name if they mention it and ALWAYS remember it for future reference.
+If the user says their name is X, you MUST remember that their name is X and use it when appropriate.
+Always maintain context throughout the entire conversation."""
+
+# Generation options for the primary model
+GENERATION_OPTIONS = {
+    "temperature": 0.7,
+    "num_ctx": 4096,  # Increase context window
+    "top_p": 0.9
+}
+
+# "chat" sends structured messages to /api/chat so Ollama can reuse the cached
+# prompt prefix; "generate" sends the flat transcript to /api/generate
+OLLAMA_API_MODE = os.environ.get("OLLAMA_API_MODE", "chat")
+# How long Ollama keeps the model loaded after a request
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
+# Function to pick the model for a request from the cached registry and circuit breakers
+def select_model(models: ModelRegistry, scheduler: Scheduler):
+    model_name = PRIMARY_MODEL
+    if not models.reachable:
+        # Last refresh failed; refresh now and let the generate call report the error
+        models.invalidate()
+    elif not models.is_available(model_name):
+        # Pull once in the background and serve from the fallback model meanwhile
+        models.ensure_pulled(model_name)
+        if models.is_available(FALLBACK_MODEL):
+            logging.info("Model %s not available yet, using %s", model_name, FALLBACK_MODEL)
+            MODEL_SELECTIONS.inc(FALLBACK_MODEL, "unavailable")
+            return FALLBACK_MODEL
+    # Route to the fallback model while the primary model's circuit breaker is open
+    if not scheduler.breaker(model_name).allow_request():
+        logging.warning("Circuit breaker open for %s, using %s", model_name, FALLBACK_MODEL)
+        MODEL_SELECTIONS.inc(FALLBACK_MODEL, "circuit_open")
+        return FALLBACK_MODEL
+    MODEL_SELECTIONS.inc(model_name, "primary")
+    return model_name
+
+# Function to log the prompt: its size always, an excerpt when debugging, all of it on request
+def log_prompt(payload: dict):
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    full_prompt = payload["prompt"] if "prompt" in payload else json.dumps(payload["messages"])
+    logging.debug("Prepared prompt", extra={"model": payload["model"], "prompt_chars": len(full_prompt)})
+    if LOG_FULL_PROMPTS:
+        logging.debug("Full prompt", extra={"prompt": full_prompt})
+    elif payload_logging_enabled():
+        logging.debug("Prompt excerpt", extra={"prompt": truncate(full_prompt)})
+
+class ClientDisconnected(Exception):
+    pass
+
+# Function to run a coroutine, cancelling it if the client goes away
+async def cancel_on_disconnect(request: Request, coro, poll_interval: float = 0.5):
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+# Function to turn a full queue or exhausted rate limit into a 429 response with Retry-After
+def too_many_requests(queue_error: Overloaded):
+    ERRORS.inc(queue_error.reason)
+    logging.warning("Rejecting request: %s", queue_error, extra={"retry_after": queue_error.retry_after})
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(queue_error),
+        headers={"Retry-After": str(queue_error.retry_after)}
+    )
+
+# Function to apply the cluster-wide generation rate limit of a model, if configured
+async def enforce_rate_limit(coordinator: Coordinator, model_name: str):
+    if MODEL_RATE_LIMIT <= 0:
+        return
+    allowed, retry_after = await coordinator.take_token(f"model:{model_name}", MODEL_RATE_LIMIT, MODEL_RATE_BURST)
+    if not allowed:
+        raise RateLimited(f"Rate limit exceeded for model {model_name}", max(1, math.ceil(retry_after)))
+
+# Function to apply this worker's per-session and per-client request limits
+def enforce_request_limits(request: Request, session_id: Optional[str]):
+    try:
+        if session_id:
+            request.app.state.session_limiter.take(session_id)
+        if request.client is not None:
+            request.app.state.client_limiter.take(request.client.host)
+    except RateLimited as limit_error:
+        raise too_many_requests(limit_error)
+
+# Function to find the identical request already in flight, or register this one to run
+def claim_shared_request(request: Request, endpoint: str, conversation: "Conversation"):
+    idempotency_key = request.headers.get("Idempotency-Key")
+    key = request_key(endpoint, conversation.session_id, conversation.user_input, idempotency_key)
+    try:
+        # Requests that cannot have duplicates still run through a shared request of their own
+        shared, leader = request.app.state.inflight.claim(
+            key or f"{endpoint}:{uuid.uuid4()}", keep=bool(idempotency_key),
+            fingerprint=body_digest(conversation.user_input)
+        )
+    except KeyReused as reuse_error:
+        ERRORS.inc("idempotency_key_reused")
+        logging.warning("Rejecting request: %s", reuse_error, extra={"session_id": conversation.session_id})
+        raise HTTPException(status_code=422, detail=str(reuse_error))
+    if not leader:
+        logging.info("Sharing the result of an identical request", extra={"session_id": conversation.session_id})
+    return shared, leader
+
+# Function to turn a coroutine into the single-item producer of a shared request
+async def single_result(coro):
+    yield await coro
+
+# Function to build the full prompt from the system instruction, summary and history
+def build_prompt(history: List[Turn], user_input: str, summary: Optional[Turn] = None):
+    # Always keep the summary, then the most recent turns that fit in the model's context window
+    budget = history_budget(GENERATION_OPTIONS["num_ctx"], SYSTEM_INSTRUCTION, user_input, summary)
+    conversation_history = build_history_window(history, budget, summary)
+    
+    full_prompt = SYSTEM_INSTRUCTION + "\n\n"
+    
+    if conversation_history:
+        full_prompt += conversation_history
+        # Make sure there's a newline at the end of the history
+        if not full_prompt.endswith("\n\n"):
+            full_prompt += "\n\n"
+    full_prompt += f"User: {user_input}\nAssistant:"
+    return full_prompt
+
+# Function to build the Ollama request body for the configured API mode
+def build_payload(model_name: str, history: List[Turn], user_input: str, options: Optional[dict] = None,
+                  summary: Optional[Turn] = None):
+    if OLLAMA_API_MODE == "chat":
+        num_ctx = (options or GENERATION_OPTIONS)["num_ctx"]
+        payload = {
+            "model": model_name,
+            "messages": build_messages(CHAT_SYSTEM_PROMPT, history, user_input, num_ctx, summary)
+        }
+    else:
+        payload = {"model": model_name, "prompt": build_prompt(history, user_input, summary)}
+    payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+    if options:
+        payload["options"] = options
+    return payload
+
+# Function to get the tokens a prompt has for history before its new message and summary
+def history_window_tokens():
+    system_prompt = CHAT_SYSTEM_PROMPT if OLLAMA_API_MODE == "chat" else SYSTEM_INSTRUCTION
+    return history_budget(GENERATION_OPTIONS["num_ctx"], system_prompt, "")
+
+# Function to build the one-token request that loads a model at startup; it uses
+# the chat options, since Ollama reloads a model whose num_ctx changes
+def warmup_payload(model_name: str):
+    return build_payload(model_name, [], "Hi", dict(GENERATION_OPTIONS, num_predict=1))
+
+# Function to record Ollama's token counts and generation speed
+def record_timings(model_name: str, timings: dict):
+    if "prompt_eval_count" in timings:
+        TOKENS_TOTAL.inc(model_name, "prompt", amount=timings["prompt_eval_count"])
+    if "eval_count" in timings:
+        TOKENS_TOTAL.inc(model_name, "generated", amount=timings["eval_count"])
+    if "eval_tokens_per_second" in timings:
+        TOKENS_PER_SECOND.observe(timings["eval_tokens_per_second"], model_name)
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    # Levels and totals already tracked by the components are copied in on scrape
+    state = request.app.state
+    for component, stats in (
+        ("db_pool", state.db.stats()),
+        ("history_cache", state.history_cache.stats()),
+        ("response_cache", state.response_cache.stats()),
+        ("persistence", state.writer.stats()),
+        ("history_maintenance", state.history_maintainer.stats()),
+        ("shared_requests", state.inflight.stats()),
+        ("session_rate_limit", state.session_limiter.stats()),
+        ("client_rate_limit", state.client_limiter.stats()),
+    ):
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)):
+                COMPONENT_STATS.set(value, component, stat)
+    for model_name, stats in state.scheduler.stats().items():
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)):
+                MODEL_QUEUE_STATS.set(value, model_name, stat)
+        MODEL_QUEUE_STATS.set(stats["circuit"] == "open", model_name, "circuit_open")
+    for url, stats in state.ollama.stats()["backends"].items():
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)):
+                BACKEND_STATS.set(value, url, stat)
+    return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE)
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process is up and its event loop responds
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz(request: Request):
+    # Readiness: startup has finished and some Ollama backend is healthy
+    startup = request.app.state.startup.snapshot()
+    backend_up = any(not backend.ejected for backend in request.app.state.ollama.backends)
+    ready = startup["ready"] and backend_up
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=dict(startup, status="ready" if ready else "starting" if not startup["ready"] else "unavailable")
+    )
+
+@app.get("/health/db")
+async def db_health(request: Request):
+    db = request.app.state.db
+    healthy = await db.ping()
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "ok" if healthy else "unavailable", "pool": db.stats()}
+    )
+
+@app.get("/health/cache")
+async def cache_health(request: Request):
+    return {
+        "history": request.app.state.history_cache.stats(),
+        "responses": request.app.state.response_cache.stats(),
+    }
+
+@app.get("/health/scheduler")
+async def scheduler_health(request: Request):
+    return request.app.state.scheduler.stats()
+
+@app.get("/health/persistence")
+async def persistence_health(request: Request):
+    return request.app.state.writer.stats()
+
+@app.get("/health/requests")
+async def requests_health(request: Request):
+    return {
+        "shared": request.app.state.inflight.stats(),
+        "session_rate_limit": request.app.state.session_limiter.stats(),
+        "client_rate_limit": request.app.state.client_limiter.stats(),
+    }
+
+@app.get("/health/history")
+async def history_health(request: Request):
+    return request.app.state.history_maintainer.stats()
+
+@app.get("/health/backends")
+async def backends_health(request: Request):
+    return request.app.state.ollama.stats()
+
+@app.get("/health/models")
+async def models_health(request: Request):
+    return request.app.state.models.snapshot()
 
 @app.post("/chat")
-async def chat(conversation: Conversation):
+async def chat(conversation: Conversation, request: Request):
+    shared, leader = claim_shared_request(request, "chat", conversation)
+    if leader:
+        try:
+            enforce_request_limits(request, conversation.session_id)
+            shared.run(single_result(answer_chat(conversation, request)))
+        except BaseException as start_error:
+            shared.fail(start_error)
+            raise
+    else:
+        await shared.joined()
+    try:
+        # The generation is cancelled once every client waiting for it has gone
+        return await cancel_on_disconnect(request, shared.result())
+    except ClientDisconnected:
+        ERRORS.inc("client_disconnect")
+        logging.info("Client disconnected before the reply was ready", extra={"session_id": conversation.session_id})
+        raise HTTPException(status_code=499, detail="Client closed request")
+
+# Function to answer a chat request; runs once for all identical requests in flight
+async def answer_chat(conversation: Conversation, request: Request):
+    ollama = request.app.state.ollama
+    db = request.app.state.db
+    history_cache = request.app.state.history_cache
+    response_cache = request.app.state.response_cache
+    writer = request.app.state.writer
+    models = request.app.state.models
+    scheduler = request.app.state.scheduler
+    coordinator = request.app.state.coordinator
     try:
         # Generate session ID if not provided
         if not conversation.session_id:
             conversation.session_id = str(uuid.uuid4())
-            logging.info(f"Created new session ID: {conversation.session_id}")
-        else:
-            logging.info(f"Using existing session ID: {conversation.session_id}")
+            logging.info("Created new session ID", extra={"session_id": conversation.session_id})
         
         # Get conversation history
-        conversation_history = get_conversation_history(conversation.session_id)
-        logging.info(f"Retrieved conversation history for session {conversation.session_id}, length: {len(conversation_history)}")
+        with STAGE_SECONDS.time("history_fetch"):
+            summary, conversation_history = await get_conversation_history(
+                db, history_cache, writer, conversation.session_id
+            )
         
         # Log the incoming request
-        logging.info(f"Received chat request with input: {conversation.user_input[:50]}...")
+        logging.info("Received chat request", extra={
+            "session_id": conversation.session_id,
+            "history_turns": len(conversation_history),
+            "has_summary": summary is not None,
+            "input_chars": len(conversation.user_input),
+        })
         
-        # Get Ollama host from environment variable with fallback
-        ollama_host = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
-        logging.info(f"Using Ollama host: {ollama_host}")
+        model_name = select_model(models, scheduler)
+        breaker = scheduler.breaker(model_name)
         
-        # Test basic connectivity to Ollama
-        try:
-            version_check = requests.get(
-                f"{ollama_host}/api/version",
-                timeout=5
-            )
-            if version_check.status_code == 200:
-                logging.info(f"Ollama API is reachable. Version: {version_check.json()}")
-            else:
-                logging.error(f"Ollama API returned non-200 status on version check: {version_check.status_code}")
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Ollama service is not responding properly. Status: {version_check.status_code}"
-                )
-        except requests.exceptions.RequestException as conn_error:
-            logging.error(f"Failed to connect to Ollama API: {conn_error}")
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail=f"Cannot connect to Ollama service: {str(conn_error)}"
+        # Prepare the request with conversation history
+        with STAGE_SECONDS.time("prompt_build"):
+            payload = build_payload(
+                model_name, conversation_history, conversation.user_input, GENERATION_OPTIONS, summary
             )
+        log_prompt(payload)
         
-        # Check if model exists, if not try to pull it
-        model_name = "qwen2.5:7b"
-        fallback_model = "llama2"
-        model_exists = False
+        # Identical prompts answered before are served from the response cache
+        cache_key = response_cache.key(payload)
+        cached_response = await response_cache.get(cache_key)
+        if cached_response is not None:
+            logging.info("Serving cached response", extra={"session_id": conversation.session_id})
+            store_conversation(writer, conversation.session_id, conversation.user_input, cached_response)
+            return {"response": cached_response, "session_id": conversation.session_id, "timings": {}, "cached": True}
         
-        try:
-            # Check if model exists
-            logging.info(f"Checking if model {model_name} exists")
-            model_check = requests.get(
-                f"{ollama_host}/api/tags",
-                timeout=10
-            )
-            
-            if model_check.status_code == 200:
-                models_data = model_check.json()
-                logging.info(f"Available models: {json.dumps(models_data)}")
-                
-                models = models_data.get("models", [])
-                model_exists = any(model.get("name") == model_name for model in models)
-                logging.info(f"Model {model_name} exists: {model_exists}")
-                
-                # Also check if fallback model exists
-                fallback_exists = any(model.get("name") == fallback_model for model in models)
-                logging.info(f"Fallback model {fallback_model} exists: {fallback_exists}")
-                
-                # If model doesn't exist, try to pull it
-                if not model_exists:
-                    logging.info(f"Model {model_name} not found, attempting to pull...")
-                    pull_response = requests.post(
-                        f"{ollama_host}/api/pull",
-                        json={"name": model_name},
-                        timeout=300  # Longer timeout for model pulling
+        async def generate():
+            await enforce_rate_limit(coordinator, model_name)
+            # Wait for a free generation slot for this model, then call Ollama
+            async with scheduler.slot(model_name, conversation.session_id) as waited:
+                logging.debug("Sending request to model %s", model_name, extra={"queue_wait_seconds": waited})
+                with STAGE_SECONDS.time("generation"):
+                    return await ollama.complete(
+                        payload,
+                        timeout=120,  # Increased timeout for model generation
+                        session_id=conversation.session_id
                     )
-                    if pull_response.status_code == 200:
-                        logging.info(f"Successfully initiated pull for model {model_name}")
-                        # Wait for model to be ready
-                        for _ in range(5):  # Try up to 5 times
-                            time.sleep(5)  # Wait 5 seconds between checks
-                            check_response = requests.get(f"{ollama_host}/api/tags", timeout=10)
-                            if check_response.status_code == 200:
-                                models = check_response.json().get("models", [])
-                                if any(model.get("name") == model_name for model in models):
-                                    model_exists = True
-                                    logging.info(f"Model {model_name} is now available")
-                                    break
-                        if not model_exists:
-                            logging.warning(f"Model {model_name} still not available after pull attempt")
-                    else:
-                        logging.error(f"Failed to pull model: {pull_response.text}")
-            else:
-                logging.error(f"Failed to get model list: {model_check.status_code}")
-        except Exception as model_error:
-            logging.error(f"Error checking/pulling model: {model_error}")
-            # Continue anyway, maybe the model exists but we couldn't check
-        
-        # Prepare the full prompt with conversation history
-        system_instruction = """You are an AI assistant having a conversation with a user. 
-        You MUST remember all information shared in this conversation, especially names, preferences, and personal details.
-        When asked about information previously shared, you MUST recall it accurately.
-        Pay special attention to the user's name if they mention it and ALWAYS remember it for future reference.
-        If the user says their name is X, you MUST remember that their name is X and use it when appropriate.
-        Always maintain context throughout the entire conversation.
-        The following is the conversation history:
-        """
-        
-        full_prompt = system_instruction + "\n\n"
-        
-        if conversation_history:
-            full_prompt += conversation_history
-            # Make sure there's a newline at the end of the history
-            if not full_prompt.endswith("\n\n"):
-                full_prompt += "\n\n"
-            full_prompt += f"User: {conversation.user_input}\nAssistant:"
-        else:
-            full_prompt += f"User: {conversation.user_input}\nAssistant:"
         
-        logging.info(f"Prepared full prompt with history, total length: {len(full_prompt)}")
-        # Log a preview of the prompt to avoid excessive logging
-        prompt_preview = full_prompt[:500] + "..." if len(full_prompt) > 500 else full_prompt
-        logging.info(f"Full prompt preview: {prompt_preview}")
-        logging.info(f"Full prompt: {full_prompt}")
-        
-        # Try with primary model first, then fallback if needed
-        response = None
         try:
-            # Log the request we're about to make
-            logging.info(f"Sending request to model {model_name}")
             start_time = time.time()
-            
-            response = requests.post(
-                f"{ollama_host}/api/generate",
-                json={
-                    "model": model_name,
-                    "prompt": full_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.7,
-                        "num_ctx": 4096,  # Increase context window
-                        "top_p": 0.9
-                    }
-                },
-                timeout=120  # Increased timeout for model generation
-            )
+            response = await generate()
             
             elapsed_time = time.time() - start_time
-            logging.info(f"Response received from {model_name} in {elapsed_time:.2f} seconds with status {response.status_code}")
+            logging.info("Response received from %s", model_name, extra={
+                "elapsed_seconds": elapsed_time, "status": response.status_code
+            })
             
-            # Log response headers and partial content for debugging
-            logging.info(f"Response headers: {dict(response.headers)}")
-            if response.content:
-                content_preview = response.content[:200] if len(response.content) > 200 else response.content
-                logging.info(f"Response content preview: {content_preview}")
+            # Log response headers and partial content only when debugging
+            if payload_logging_enabled():
+                logging.debug("Model response excerpt", extra={
+                    "headers": dict(response.headers), "content": truncate(response.text)
+                })
             
-        except requests.exceptions.Timeout as timeout_error:
-            logging.error(f"Timeout error with {model_name}: {timeout_error}")
+        except Overloaded as queue_error:
+            raise too_many_requests(queue_error)
+        except httpx.TimeoutException as timeout_error:
+            logging.error("Timeout error with %s: %s", model_name, timeout_error)
+            ERRORS.inc("timeout")
+            breaker.record_failure()
+            models.invalidate()
             raise HTTPException(
                 status_code=status.HTTP_504_GATEWAY_TIMEOUT,
                 detail=f"Request to model {model_name} timed out after 120 seconds"
             )
         except Exception as api_error:
-            logging.error(f"API request error with {model_name}: {api_error}")
-            
-            # Try with a fallback model
-            logging.info(f"Attempting to use fallback model {fallback_model}")
-            try:
-                start_time = time.time()
-                response = requests.post(
-                    f"{ollama_host}/api/generate",
-                    json={
-                        "model": fallback_model,
-                        "prompt": full_prompt,
-                        "stream": False
-                    },
-                    timeout=60
-                )
-                elapsed_time = time.time() - start_time
-                logging.info(f"Response received from fallback model {fallback_model} in {elapsed_time:.2f} seconds with status {response.status_code}")
-            except Exception as fallback_error:
-                logging.error(f"Fallback model error: {fallback_error}")
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Both primary and fallback models failed. Last error: {fallback_error}"
-                )
+            # No per-request retry: the circuit breaker moves traffic to the fallback model
+            logging.error("API request error with %s: %s", model_name, api_error)
+            ERRORS.inc("api_error")
+            breaker.record_failure()
+            models.invalidate()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Request to model {model_name} failed: {api_error}"
+            )
         
-        if not response or response.status_code != 200:
-            error_detail = "No response received" if not response else f"Model API error: {response.status_code}"
-            if response and response.content:
+        if response.status_code != 200:
+            error_detail = f"Model API error: {response.status_code}"
+            if response.content:
                 try:
                     error_content = response.json()
                     error_detail = f"{error_detail}. Details: {json.dumps(error_content)}"
                 except:
                     error_detail = f"{error_detail}. Raw response: {response.text[:200]}"
             
-            logging.error(f"Failed request: {error_detail}")
+            logging.error("Failed request: %s", truncate(error_detail))
+            ERRORS.inc("bad_status")
+            breaker.record_failure()
+            models.invalidate()
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=error_detail
             )
+        breaker.record_success()
         
         # Parse the response
         try:
             response_json = response.json()
-            logging.info(f"Successfully parsed JSON response: {json.dumps(response_json)[:200]}...")
-            model_response = response_json.get("response", "No response received")
+            model_response = response_text(response_json)
+            await response_cache.put(cache_key, model_name, model_response)
+            model_response = model_response or "No response received"
             if not model_response or model_response == "No response received":
-                logging.warning(f"Empty or missing response field in API response: {json.dumps(response_json)[:200]}...")
+                logging.warning("Empty or missing response field in API response: %s", truncate(response.text))
         except Exception as json_error:
-            logging.error(f"Failed to parse JSON response: {json_error}. Response content: {response.text[:200]}")
+            logging.error("Failed to parse JSON response: %s. Response content: %s", json_error, truncate(response.text))
+            ERRORS.inc("parse_error")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"Failed to parse model response: {str(json_error)}"
             )
         
+        # Report prefill versus generation time for this request
+        timings = generation_timings(response_json)
+        logging.info("Generation timings", extra=dict(timings, model=model_name))
+        record_timings(model_name, timings)
+        if "total_seconds" in timings and "eval_seconds" in timings:
+            # Not streamed, so time to first token is Ollama's load and prefill time
+            STAGE_SECONDS.observe(timings["total_seconds"] - timings["eval_seconds"], "ttft")
+        
         # Store conversation in database with session_id
-        try:
-            logging.info(f"Storing conversation in database for session {conversation.session_id}")
-            conn = psycopg2.connect(
-                host="postgres",
-                database="vit",
-                user="vit",
-                password="vit"
-            )
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO conversation_history (session_id, user_input, model_response) VALUES (%s, %s, %s)",
-                (conversation.session_id, conversation.user_input, model_response)
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
-            logging.info("Successfully stored conversation in database")
-        except Exception as db_error:
-            logging.error(f"Database error: {db_error}")
-            # Continue even if database operation fails
+        store_conversation(writer, conversation.session_id, conversation.user_input, model_response)
         
-        logging.info(f"Returning successful response with length {len(model_response)}")
-        return {"response": model_response, "session_id": conversation.session_id}
+        logging.debug("Returning successful response", extra={"response_chars": len(model_response)})
+        return {"response": model_response, "session_id": conversation.session_id, "timings": timings, "cached": False}
     
     except HTTPException:
         # Re-raise HTTP exceptions without modification
         raise
     except Exception as e:
-        logging.exception(f"Unhandled exception in chat endpoint: {str(e)}")
+        logging.exception("Unhandled exception in chat endpoint: %s", e)
+        ERRORS.inc("unhandled")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An unexpected error occurred: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+# Function to format a Server-Sent Event
+def sse_event(data: dict, event: Optional[str] = None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(conversation: Conversation, request: Request):
+    """Stream the model response as Server-Sent Events.
+
+    Emits a ``session`` event, one ``data`` event per token chunk and a
+    final ``done`` (or ``error``) event. The complete response is stored in
+    the conversation history once the stream has finished. An identical
+    request joining late gets the events sent so far, then the rest.
+    """
+    shared, leader = claim_shared_request(request, "chat/stream", conversation)
+    if leader:
+        try:
+            enforce_request_limits(request, conversation.session_id)
+            shared.run(await start_chat_stream(conversation, request))
+        except BaseException as start_error:
+            shared.fail(start_error)
+            raise
+    else:
+        await shared.joined()
+    return StreamingResponse(
+        shared.subscribe(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Function to do the work before a chat stream starts and return its event generator
+async def start_chat_stream(conversation: Conversation, request: Request):
+    ollama = request.app.state.ollama
+    db = request.app.state.db
+    history_cache = request.app.state.history_cache
+    response_cache = request.app.state.response_cache
+    writer = request.app.state.writer
+    models = request.app.state.models
+    scheduler = request.app.state.scheduler
+    coordinator = request.app.state.coordinator
+    
+    if not conversation.session_id:
+        conversation.session_id = str(uuid.uuid4())
+        logging.info("Created new session ID", extra={"session_id": conversation.session_id})
+    session_id = conversation.session_id
+    
+    with STAGE_SECONDS.time("history_fetch"):
+        summary, conversation_history = await get_conversation_history(db, history_cache, writer, session_id)
+    model_name = select_model(models, scheduler)
+    breaker = scheduler.breaker(model_name)
+    with STAGE_SECONDS.time("prompt_build"):
+        payload = build_payload(model_name, conversation_history, conversation.user_input, GENERATION_OPTIONS, summary)
+    logging.info("Received streaming chat request", extra={
+        "session_id": session_id,
+        "history_turns": len(conversation_history),
+        "has_summary": summary is not None,
+        "input_chars": len(conversation.user_input),
+    })
+    log_prompt(payload)
+    
+    # Identical prompts answered before are replayed from the response cache
+    cache_key = response_cache.key(payload)
+    cached_response = await response_cache.get(cache_key)
+    
+    # Reject over capacity with a proper 429 before the event stream starts
+    if cached_response is None:
+        try:
+            await enforce_rate_limit(coordinator, model_name)
+            scheduler.queue(model_name).check_capacity(session_id)
+        except Overloaded as queue_error:
+            raise too_many_requests(queue_error)
+    
+    async def event_stream():
+        yield sse_event({"session_id": session_id}, event="session")
+        
+        timings = {}
+        if cached_response is not None:
+            logging.info("Serving cached response", extra={"session_id": session_id})
+            model_response = cached_response
+            yield sse_event({"token": model_response})
+        else:
+            chunks = []
+            start_time = time.time()
+            # Once every client has disconnected this generator is cancelled, which
+            # releases the slot and closes the stream to Ollama
+            try:
+                async with scheduler.slot(model_name, session_id) as waited:
+                    logging.debug("Streaming response from model %s", model_name, extra={"queue_wait_seconds": waited})
+                    generation_start = time.perf_counter()
+                    async for chunk in ollama.stream(payload, timeout=120, session_id=session_id):
+                        token = response_text(chunk)
+                        if token:
+                            if not chunks:
+                                STAGE_SECONDS.observe(time.perf_counter() - generation_start, "ttft")
+                            chunks.append(token)
+                            yield sse_event({"token": token})
+                        if chunk.get("done"):
+                            timings = generation_timings(chunk)
+                    STAGE_SECONDS.observe(time.perf_counter() - generation_start, "generation")
+            except Overloaded as queue_error:
+                ERRORS.inc(queue_error.reason)
+                yield sse_event({"detail": str(queue_error), "retry_after": queue_error.retry_after}, event="error")
+                return
+            except asyncio.CancelledError:
+                ERRORS.inc("client_disconnect")
+                raise
+            except Exception as api_error:
+                logging.error("Streaming error with %s: %s", model_name, api_error)
+                ERRORS.inc("api_error")
+                breaker.record_failure()
+                models.invalidate()
+                yield sse_event({"detail": f"Model {model_name} failed: {api_error}"}, event="error")
+                return
+            breaker.record_success()
+            
+            model_response = "".join(chunks)
+            elapsed_time = time.time() - start_time
+            logging.info("Streamed response from %s", model_name, extra=dict(
+                timings, elapsed_seconds=elapsed_time, response_chars=len(model_response)
+            ))
+            record_timings(model_name, timings)
+            await response_cache.put(cache_key, model_name, model_response)
+        
+        # Persist the full response in a single write once the stream is complete
+        store_conversation(writer, session_id, conversation.user_input, model_response)
+        yield sse_event(
+            {"session_id": session_id, "timings": timings, "cached": cached_response is not None},
+            event="done"
+        )
+    
+    return event_stream()
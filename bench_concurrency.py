@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Concurrency benchmark for the /chat endpoint against a local fake Ollama.
+
+Starts fake_ollama.py and the app with uvicorn, then sends one chat request
+followed by N parallel ones. With a non-blocking request path the parallel
+batch should finish in roughly the time of a single request. Admission
+control and the client rate limit are raised out of the way unless set in
+the environment, so the batch measures the request path, not the scheduler.
+
+    python bench_concurrency.py --parallel 10 --latency 1.0
+"""
+import argparse
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def start_server(module: str, port: int, env: dict, workers: int = 1) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--port", str(port), "--log-level", "warning",
+         "--workers", str(workers)],
+        env=env,
+        # The app and fake server are imported and serve static files from the repo root
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start in {timeout} seconds")
+
+
+async def send_chat(client: httpx.AsyncClient, app_url: str, i: int) -> float:
+    start_time = time.time()
+    response = await client.post(f"{app_url}/chat", json={"user_input": f"Hello number {i}"}, timeout=300)
+    response.raise_for_status()
+    return time.time() - start_time
+
+
+async def run(args):
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    async with httpx.AsyncClient() as client:
+        single = await send_chat(client, app_url, 0)
+        logging.info(f"Single request: {single:.2f} seconds")
+
+        start_time = time.time()
+        await asyncio.gather(*(send_chat(client, app_url, i) for i in range(args.parallel)))
+        parallel = time.time() - start_time
+        logging.info(f"{args.parallel} parallel requests: {parallel:.2f} seconds "
+                     f"({parallel / single:.2f}x a single request)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--parallel", type=int, default=10, help="number of concurrent chats")
+    parser.add_argument("--latency", type=float, default=1.0, help="fake generation latency in seconds")
+    parser.add_argument("--ollama-port", type=int, default=11435)
+    parser.add_argument("--app-port", type=int, default=8001)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["FAKE_OLLAMA_LATENCY"] = str(args.latency)
+    env["OLLAMA_HOST"] = f"http://127.0.0.1:{args.ollama_port}"
+    env.setdefault("POSTGRES_HOST", "127.0.0.1")
+    # Let every parallel request have a generation slot, as bench_workers.py does
+    env.setdefault("MODEL_MAX_CONCURRENCY", str(args.parallel))
+    env.setdefault("SCHEDULER_MAX_QUEUE", str(args.parallel * 4))
+    env.setdefault("CLIENT_RATE_LIMIT", "0")
+
+    servers = [
+        start_server("fake_ollama:app", args.ollama_port, env),
+        start_server("app:app", args.app_port, env),
+    ]
+    try:
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{args.ollama_port}/api/version"))
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{args.app_port}/"))
+        asyncio.run(run(args))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
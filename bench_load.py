@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""Load test for the chat endpoints against a local fake Ollama.
+
+Starts fake_ollama.py, a throwaway PostgreSQL and the app, then drives
+/chat (or /chat/stream) with a fixed number of concurrent sessions. Long
+sessions (many turns, so the history grows) are mixed with short ones,
+and every session sends its turns one after another like a real user.
+Latency percentiles, throughput, time to first token (streaming only),
+average time per request stage from /metrics (of the worker that answers
+the scrape) and the app's memory are saved as JSON. Given a baseline file, the run fails on regressions:
+
+    python bench_load.py --concurrency 16 --sessions 64 --output bench_results.json
+    python bench_load.py --baseline bench_results.json --tolerance 0.2
+
+--database picks the PostgreSQL: "local" creates a temporary cluster with
+initdb/pg_ctl, "docker" starts a postgres container, "existing" uses the
+POSTGRES_* environment and "none" runs without a database (history reads
+fail fast and turns are spilled to a temporary file). "auto" uses the
+first of local, docker and none that is available. Any other app setting,
+e.g. MODEL_MAX_CONCURRENCY, is taken from the environment.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import httpx
+import psycopg2
+
+from bench_concurrency import start_server, wait_until_up
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+INITDB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "initdb")
+_STAGE_PATTERN = re.compile(r'^chat_stage_duration_seconds_(sum|count)\{stage="(\w+)"\} (\S+)$')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_postgres(env: dict, timeout: float = 60):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn = psycopg2.connect(
+                host=env["POSTGRES_HOST"], port=env["POSTGRES_PORT"], database=env["POSTGRES_DB"],
+                user=env["POSTGRES_USER"], password=env["POSTGRES_PASSWORD"], connect_timeout=2,
+            )
+            try:
+                with conn.cursor() as cursor:
+                    # The schema is created by the init script, which may still be running
+                    cursor.execute("SELECT 1 FROM conversation_history LIMIT 1")
+                return
+            finally:
+                conn.close()
+        except psycopg2.Error:
+            if time.time() > deadline:
+                raise RuntimeError(f"PostgreSQL did not become ready in {timeout} seconds")
+            time.sleep(0.5)
+
+
+@contextmanager
+def throwaway_database(mode: str, workdir: str, env: dict):
+    """Point ``env`` at a database for the run; yields the mode actually used."""
+    if mode == "auto":
+        if all(shutil.which(tool) for tool in ("initdb", "pg_ctl", "psql")):
+            mode = "local"
+        elif shutil.which("docker"):
+            mode = "docker"
+        else:
+            logging.warning("Neither initdb/pg_ctl nor docker found, running without a database")
+            mode = "none"
+    env["PERSIST_SPILL_PATH"] = os.path.join(workdir, "pending_turns.jsonl")
+    if mode == "existing":
+        yield mode
+        return
+
+    port = free_port()
+    env.update({
+        "POSTGRES_HOST": "127.0.0.1",
+        "POSTGRES_PORT": str(port),
+        "POSTGRES_DB": "vit",
+        "POSTGRES_USER": "vit",
+        "POSTGRES_PASSWORD": "vit",
+    })
+    if mode == "none":
+        # Nothing listens on the port, so every query fails fast
+        yield mode
+    elif mode == "local":
+        data_dir = os.path.join(workdir, "pgdata")
+        subprocess.run(["initdb", "-D", data_dir, "-U", "vit", "--auth=trust"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(
+            ["pg_ctl", "-D", data_dir, "-w", "-l", os.path.join(workdir, "postgres.log"),
+             "-o", f"-p {port} -k {workdir} -c listen_addresses=127.0.0.1", "start"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        try:
+            psql = ["psql", "-h", "127.0.0.1", "-p", str(port), "-U", "vit", "-v", "ON_ERROR_STOP=1", "-q"]
+            subprocess.run(psql + ["-d", "postgres", "-c", "CREATE DATABASE vit"], check=True)
+            subprocess.run(psql + ["-d", "vit", "-f", os.path.join(INITDB_DIR, "init.sql")], check=True)
+            wait_for_postgres(env)
+            yield mode
+        finally:
+            subprocess.run(["pg_ctl", "-D", data_dir, "-m", "fast", "stop"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elif mode == "docker":
+        name = f"bench-postgres-{os.getpid()}"
+        subprocess.run(
+            ["docker", "run", "--rm", "-d", "--name", name,
+             "-e", "POSTGRES_USER=vit", "-e", "POSTGRES_PASSWORD=vit", "-e", "POSTGRES_DB=vit",
+             "-p", f"127.0.0.1:{port}:5432", "-v", f"{INITDB_DIR}:/docker-entrypoint-initdb.d:ro",
+             "postgres:17"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_postgres(env)
+            yield mode
+        finally:
+            subprocess.run(["docker", "rm", "-f", name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        raise ValueError(f"Unknown database mode: {mode}")
+
+
+def process_memory(pid: int) -> Dict[str, float]:
+    """Resident and peak memory in MiB of ``pid`` and its worker processes (Linux only)."""
+    memory: Dict[str, float] = {}
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+            pids += [int(child) for child in children_file.read().split()]
+    except OSError:
+        pass
+    for process_id in pids:
+        try:
+            with open(f"/proc/{process_id}/status") as status_file:
+                for line in status_file:
+                    if line.startswith(("VmRSS:", "VmHWM:")):
+                        key = "rss_mb" if line.startswith("VmRSS:") else "peak_rss_mb"
+                        memory[key] = memory.get(key, 0.0) + int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return memory
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+def summarize(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def stage_totals(metrics_text: str) -> Dict[str, List[float]]:
+    totals: Dict[str, List[float]] = {}
+    for line in metrics_text.splitlines():
+        match = _STAGE_PATTERN.match(line)
+        if match:
+            kind, stage, value = match.groups()
+            totals.setdefault(stage, [0.0, 0.0])[0 if kind == "sum" else 1] = float(value)
+    return totals
+
+
+def stage_averages(before: Dict[str, List[float]], after: Dict[str, List[float]]) -> Dict[str, float]:
+    averages = {}
+    for stage, (total, count) in after.items():
+        previous_total, previous_count = before.get(stage, (0.0, 0.0))
+        if count > previous_count:
+            averages[stage] = (total - previous_total) / (count - previous_count)
+    return averages
+
+
+def user_input(kind: str, turn: int, words: int) -> str:
+    filler = " ".join(f"word{i}" for i in range(words))
+    return f"This is turn {turn} of a {kind} session. {filler}"
+
+
+async def send_turn(client: httpx.AsyncClient, app_url: str, endpoint: str,
+                    session_id: Optional[str], text: str) -> dict:
+    body = {"user_input": text, "session_id": session_id}
+    result = {"ok": False, "status": None, "latency": None, "ttft": None, "session_id": session_id}
+    start_time = time.perf_counter()
+    try:
+        if endpoint == "chat":
+            response = await client.post(f"{app_url}/chat", json=body)
+            result["status"] = response.status_code
+            if response.status_code == 200:
+                result["ok"] = True
+                result["session_id"] = response.json()["session_id"]
+        else:
+            async with client.stream("POST", f"{app_url}/chat/stream", json=body) as response:
+                result["status"] = response.status_code
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        data = json.loads(line[len("data: "):])
+                        if event == "session":
+                            result["session_id"] = data["session_id"]
+                        elif event == "done":
+                            result["ok"] = True
+                        elif event == "error":
+                            result["status"] = "stream_error"
+                        elif result["ttft"] is None:
+                            result["ttft"] = time.perf_counter() - start_time
+                    elif not line:
+                        event = None
+    except httpx.HTTPError as http_error:
+        result["status"] = type(http_error).__name__
+    result["latency"] = time.perf_counter() - start_time
+    return result
+
+
+async def run_session(client: httpx.AsyncClient, app_url: str, args, kind: str, turns: int, results: List[dict]):
+    session_id = None
+    for turn in range(turns):
+        result = await send_turn(client, app_url, args.endpoint, session_id, user_input(kind, turn, args.input_words))
+        result["kind"] = kind
+        results.append(result)
+        session_id = result["session_id"]
+
+
+async def run(args, app_pid: int) -> dict:
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    long_count = round(args.sessions * args.long_fraction)
+    plan = [("long", args.long_turns)] * long_count + [("short", args.short_turns)] * (args.sessions - long_count)
+    random.Random(args.seed).shuffle(plan)
+
+    limits = httpx.Limits(max_connections=args.concurrency + 2)
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        for i in range(args.warmup):
+            await send_turn(client, app_url, args.endpoint, None, user_input("warmup", i, args.input_words))
+        stages_before = stage_totals((await client.get(f"{app_url}/metrics")).text)
+        memory_before = process_memory(app_pid)
+
+        sessions: "asyncio.Queue" = asyncio.Queue()
+        for item in plan:
+            sessions.put_nowait(item)
+        results: List[dict] = []
+
+        async def worker():
+            while not sessions.empty():
+                kind, turns = sessions.get_nowait()
+                await run_session(client, app_url, args, kind, turns, results)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        duration = time.perf_counter() - start_time
+
+        stages_after = stage_totals((await client.get(f"{app_url}/metrics")).text)
+        memory_after = process_memory(app_pid)
+
+    succeeded = [result for result in results if result["ok"]]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "status_counts": dict(Counter(str(result["status"]) for result in results)),
+        "duration_seconds": duration,
+        "throughput_rps": len(succeeded) / duration if duration else 0.0,
+        "latency_seconds": summarize([result["latency"] for result in succeeded]),
+        "latency_seconds_by_session": {
+            kind: summarize([result["latency"] for result in succeeded if result["kind"] == kind])
+            for kind in ("long", "short")
+        },
+        "ttft_seconds": summarize([result["ttft"] for result in succeeded if result["ttft"] is not None]),
+        "stage_seconds_avg": stage_averages(stages_before, stages_after),
+        "memory_mb": {
+            "rss_before": memory_before.get("rss_mb"),
+            "rss_after": memory_after.get("rss_mb"),
+            "peak_rss": memory_after.get("peak_rss_mb"),
+        },
+    }
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    old_latency = baseline.get("latency_seconds") or {}
+    new_latency = results.get("latency_seconds") or {}
+    for key in ("p50", "p95", "p99"):
+        old, new = old_latency.get(key), new_latency.get(key)
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"latency {key} {old:.3f}s -> {new:.3f}s")
+    old_rps, new_rps = baseline.get("throughput_rps", 0.0), results["throughput_rps"]
+    if new_rps < old_rps * (1 - tolerance):
+        regressions.append(f"throughput {old_rps:.2f} -> {new_rps:.2f} requests/s")
+    if results["errors"] > baseline.get("errors", 0):
+        regressions.append(f"errors {baseline.get('errors', 0)} -> {results['errors']}")
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint", choices=("chat", "stream"), default="chat",
+                        help="drive /chat or the streaming /chat/stream")
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions running at the same time")
+    parser.add_argument("--sessions", type=int, default=32, help="total sessions")
+    parser.add_argument("--long-fraction", type=float, default=0.25, help="share of long sessions")
+    parser.add_argument("--long-turns", type=int, default=20, help="turns per long session")
+    parser.add_argument("--short-turns", type=int, default=2, help="turns per short session")
+    parser.add_argument("--input-words", type=int, default=20, help="filler words per user message")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests before the run")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the session order")
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="fake generation time in seconds, used when --token-rate is 0")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="fake tokens per second")
+    parser.add_argument("--prefill", type=float, default=0.0, help="fake seconds before the first token")
+    parser.add_argument("--response-tokens", type=int, default=0, help="fake response length in tokens")
+    parser.add_argument("--database", choices=("auto", "local", "docker", "existing", "none"), default="auto")
+    parser.add_argument("--workers", type=int, default=1, help="app (and fake Ollama) worker processes")
+    parser.add_argument("--ollama-port", type=int, default=11435)
+    parser.add_argument("--app-port", type=int, default=8001)
+    parser.add_argument("--output", default="bench_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slowdown before a regression is reported")
+    return parser
+
+
+def run_benchmark(args) -> dict:
+    """Start the servers and database, run the load and return the results."""
+    env = dict(os.environ)
+    env.update({
+        "FAKE_OLLAMA_LATENCY": str(args.latency),
+        "FAKE_OLLAMA_TOKEN_RATE": str(args.token_rate),
+        "FAKE_OLLAMA_PREFILL": str(args.prefill),
+        "FAKE_OLLAMA_TOKENS": str(args.response_tokens),
+        "OLLAMA_HOST": f"http://127.0.0.1:{args.ollama_port}",
+        "WEB_CONCURRENCY": str(args.workers),
+    })
+    # All simulated users share one address and send turns back to back
+    env.setdefault("SESSION_RATE_LIMIT", "0")
+    env.setdefault("CLIENT_RATE_LIMIT", "0")
+    env.pop("OLLAMA_HOSTS", None)
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir, \
+            throwaway_database(args.database, workdir, env) as database:
+        servers = [
+            start_server("fake_ollama:app", args.ollama_port, env, workers=args.workers),
+            start_server("app:app", args.app_port, env, workers=args.workers),
+        ]
+        try:
+            asyncio.run(wait_until_up(f"http://127.0.0.1:{args.ollama_port}/api/version"))
+            asyncio.run(wait_until_up(f"http://127.0.0.1:{args.app_port}/"))
+            results = asyncio.run(run(args, servers[1].pid))
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+
+    return dict(
+        results,
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        database=database,
+        config=dict(vars(args)),
+    )
+
+
+def main():
+    args = build_parser().parse_args()
+
+    # Read the baseline first: it may be the file this run overwrites
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run_benchmark(args)
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    latency = results["latency_seconds"] or {}
+    logging.info(
+        f"{results['requests']} requests, {results['errors']} errors, "
+        f"{results['throughput_rps']:.2f} requests/s, p50 {latency.get('p50') or 0:.3f}s "
+        f"p95 {latency.get('p95') or 0:.3f}s p99 {latency.get('p99') or 0:.3f}s; saved to {args.output}"
+    )
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            logging.error(f"Regression against {args.baseline}: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Throughput scaling of the app with the number of worker processes.
+
+Runs bench_load.py's load once per worker count, with a fast fake Ollama
+and a high concurrency limit so the app itself, not the model, is the
+bottleneck. Accepts every bench_load.py option; results per worker count
+and the speed-up over one worker are written to --output:
+
+    python bench_workers.py --worker-counts 1 2 4 --concurrency 64 --sessions 256
+"""
+import json
+import logging
+import os
+
+from bench_load import build_parser, run_benchmark
+
+
+def main():
+    parser = build_parser()
+    parser.description = __doc__
+    parser.add_argument("--worker-counts", type=int, nargs="+",
+                        default=sorted({1, 2, os.cpu_count() or 1}), help="worker counts to compare")
+    parser.set_defaults(latency=0.05, concurrency=64, sessions=256, output="bench_workers.json")
+    args = parser.parse_args()
+
+    # Keep admission control out of the way; the limit is shared by all workers
+    os.environ.setdefault("MODEL_MAX_CONCURRENCY", str(args.concurrency))
+    os.environ.setdefault("SCHEDULER_MAX_QUEUE", str(args.concurrency * 4))
+
+    runs = []
+    for workers in args.worker_counts:
+        args.workers = workers
+        results = run_benchmark(args)
+        runs.append(results)
+        logging.info(f"{workers} workers: {results['throughput_rps']:.2f} requests/s, "
+                     f"p95 {(results['latency_seconds'] or {}).get('p95') or 0:.3f}s, {results['errors']} errors")
+
+    base = runs[0]["throughput_rps"] or 1.0
+    summary = {
+        "cpu_count": os.cpu_count(),
+        "scaling": [
+            {
+                "workers": run["config"]["workers"],
+                "throughput_rps": run["throughput_rps"],
+                "speedup": run["throughput_rps"] / base,
+                "p95_seconds": (run["latency_seconds"] or {}).get("p95"),
+                "memory_mb": run["memory_mb"]["rss_after"],
+            }
+            for run in runs
+        ],
+        "runs": runs,
+    }
+    with open(args.output, "w") as output_file:
+        json.dump(summary, output_file, indent=2)
+    for row in summary["scaling"]:
+        logging.info(f"{row['workers']} workers: {row['speedup']:.2f}x the throughput of "
+                     f"{runs[0]['config']['workers']} worker(s)")
+
+
+if __name__ == "__main__":
+    main()
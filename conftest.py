@@ -0,0 +1,26 @@
+import time
+
+import pytest
+
+# Manual check against a live Ollama, run with `python test_ollama_connection.py`
+collect_ignore = ["test_ollama_connection.py"]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces ``time.monotonic``, which every module reads through ``import time``; advance ``clock.now``.
+
+    The event loop reads the same clock, so tests using it must not sleep
+    for more than ``asyncio.sleep(0)``.
+    """
+    fake = FakeClock()
+    monkeypatch.setattr(time, "monotonic", fake)
+    return fake
@@ -0,0 +1,139 @@
+import functools
+import hashlib
+import logging
+import os
+import re
+from typing import List, NamedTuple, Optional, Sequence
+
+# Maximum number of past turns fetched from the database per request
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", "50"))
+# Tokens of the context window kept free for the model's reply
+CONTEXT_RESPONSE_RESERVE = int(os.environ.get("CONTEXT_RESPONSE_RESERVE", "1024"))
+# Optional Hugging Face tokenizer name used for exact token counts
+CONTEXT_TOKENIZER = os.environ.get("CONTEXT_TOKENIZER", "")
+# Roughly how many turns are dropped at once when the history outgrows the
+# window, so its start (and Ollama's cached prefix) stays put in between; 1 trims turn by turn
+HISTORY_TRIM_BLOCK = int(os.environ.get("HISTORY_TRIM_BLOCK", "8"))
+
+# User turn that introduces a session's stored summary of its older turns
+SUMMARY_REQUEST = "Summarize our conversation so far."
+
+# Word pieces and single punctuation marks, roughly what a BPE tokenizer splits on
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+class Turn(NamedTuple):
+    """One user/assistant exchange and its estimated token count."""
+    user_input: str
+    model_response: str
+    tokens: int
+
+    @property
+    def text(self) -> str:
+        return f"User: {self.user_input}\nAssistant: {self.model_response}\n\n"
+
+
+@functools.lru_cache(maxsize=1)
+def _load_tokenizer():
+    if not CONTEXT_TOKENIZER:
+        return None
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(CONTEXT_TOKENIZER)
+    except Exception as tokenizer_error:
+        logging.warning(f"Could not load tokenizer {CONTEXT_TOKENIZER}, using estimate: {tokenizer_error}")
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """Count tokens with the configured tokenizer, or estimate them cheaply.
+
+    The estimate counts words and punctuation and adds a third for sub-word
+    splits, which slightly over-counts for English so the window stays safe.
+    """
+    tokenizer = _load_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    return (len(_TOKEN_PATTERN.findall(text)) * 4 + 2) // 3
+
+
+def format_turn(user_input: str, model_response: str) -> Turn:
+    turn = Turn(user_input, model_response, 0)
+    return turn._replace(tokens=estimate_tokens(turn.text))
+
+
+def format_summary(summary: str) -> Turn:
+    """The stored summary as an exchange, so both API modes send it like any other turn."""
+    return format_turn(SUMMARY_REQUEST, summary)
+
+
+def history_budget(num_ctx: int, system_prompt: str, user_input: str, summary: Optional[Turn] = None) -> int:
+    """Tokens left for history after the system prompt, summary, new input and reply."""
+    used = estimate_tokens(system_prompt) + estimate_tokens(user_input) + CONTEXT_RESPONSE_RESERVE
+    if summary is not None:
+        used += summary.tokens
+    return max(num_ctx - used, 0)
+
+
+def is_trim_point(turn: Turn, block: int = HISTORY_TRIM_BLOCK) -> bool:
+    """Whether a trimmed window may start at ``turn``.
+
+    Decided by the turn's content alone, about one turn in ``block``, so
+    every worker picks the same points however much history it was given.
+    """
+    if block <= 1:
+        return True
+    digest = hashlib.sha1(f"{turn.user_input}\0{turn.model_response}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % block == 0
+
+
+def select_history_window(turns: Sequence[Turn], budget: int) -> List[Turn]:
+    """Return the most recent turns that fit in ``budget`` tokens, oldest first.
+
+    When the history does not fit, the window starts at the oldest trim
+    point (see :func:`is_trim_point`) among the turns that do. New turns
+    leave that start in place until it no longer fits, and then it moves
+    to the next trim point, dropping a block of turns at once. Between
+    those moves the prompt keeps the same prefix, so Ollama can reuse it;
+    the cost is that up to a block of turns that would fit is left out.
+    Without a trim point in range the window is trimmed turn by turn.
+    """
+    start = len(turns)
+    used = 0
+    while start > 0 and used + turns[start - 1].tokens <= budget:
+        start -= 1
+        used += turns[start].tokens
+    if start > 0:
+        trim_point = next((index for index in range(start, len(turns)) if is_trim_point(turns[index])), None)
+        if trim_point is not None:
+            start = trim_point
+        logging.debug("Trimmed history to the last %d of %d turns", len(turns) - start, len(turns))
+    return list(turns[start:])
+
+
+def build_history_window(turns: Sequence[Turn], budget: int, summary: Optional[Turn] = None) -> str:
+    """Join the summary and the most recent turns that fit in ``budget`` tokens, oldest first.
+
+    ``budget`` must already leave room for the summary, which is always kept.
+    """
+    window = select_history_window(turns, budget)
+    return "".join(turn.text for turn in ([summary] if summary is not None else []) + window)
+
+
+def build_messages(system_prompt: str, turns: Sequence[Turn], user_input: str, num_ctx: int,
+                   summary: Optional[Turn] = None) -> List[dict]:
+    """Messages for ``/api/chat``: system prompt, summary, windowed history, new input.
+
+    The system prompt and earlier messages are sent unchanged every turn so
+    Ollama can reuse its cached prefix and only prefill the new turn; the
+    window is trimmed in blocks to keep it that way in long sessions. The
+    summary of turns older than the stored ones is always sent, and its
+    tokens come out of the history budget before the window is chosen.
+    """
+    budget = history_budget(num_ctx, system_prompt, user_input, summary)
+    messages = [{"role": "system", "content": system_prompt}]
+    for turn in ([summary] if summary is not None else []) + select_history_window(turns, budget):
+        messages.append({"role": "user", "content": turn.user_input})
+        messages.append({"role": "assistant", "content": turn.model_response})
+    messages.append({"role": "user", "content": user_input})
+    return messages
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set, Tuple
+
+import psycopg2
+
+from db import Database, take_rate_limit_token
+
+
+def advisory_key(name: str) -> int:
+    """Stable signed 64-bit key for ``pg_advisory_lock``."""
+    return int.from_bytes(hashlib.sha1(name.encode("utf-8")).digest()[:8], "big", signed=True)
+
+
+class Coordinator:
+    """Cross-worker coordination through PostgreSQL, so no extra service is needed.
+
+    Locks are session-level advisory locks held on one dedicated connection
+    per worker; they are released automatically if the worker dies.
+    Counted limits such as generation slots are a set of numbered locks, one
+    per slot, so whichever worker has work takes a free one.
+    Rate limits are token buckets in the ``rate_limits`` table, updated
+    atomically in a single statement. When the database is unreachable,
+    both fail open: locks are granted and requests are allowed, leaving
+    only the per-worker limits in place.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        # One thread, so calls on the lock connection never overlap
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coordination")
+        # Slot numbers this worker holds per name; advisory locks are re-entrant
+        # within a connection, so these must not be tried again
+        self._held_slots: Dict[str, Set[int]] = {}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _on_lock_connection(self, fn, *args):
+        with self._conn_lock:
+            if self._conn is None or self._conn.closed:
+                connect_kwargs = dict(self.db.connect_kwargs)
+                connect_kwargs.setdefault("connect_timeout", 5)
+                self._conn = psycopg2.connect(**connect_kwargs)
+                self._conn.autocommit = True
+            try:
+                with self._conn.cursor() as cursor:
+                    return fn(cursor, *args)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Locks held on a broken connection are gone with it
+                self._conn.close()
+                self._conn = None
+                raise
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._on_lock_connection, fn, *args
+        )
+
+    @asynccontextmanager
+    async def lock(self, name: str):
+        """Try to take the cluster-wide lock ``name``; yields whether it was acquired."""
+        key = advisory_key(name)
+        try:
+            acquired = await self._call(_try_advisory_lock, key)
+        except Exception as lock_error:
+            logging.warning(f"Cross-worker lock {name} unavailable, continuing without it: {lock_error}")
+            yield True
+            return
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    await self._call(_advisory_unlock, key)
+                except Exception as unlock_error:
+                    logging.warning(f"Could not release cross-worker lock {name}: {unlock_error}")
+
+    async def try_slot(self, name: str, slots: int) -> Optional[int]:
+        """Try to take one of the ``slots`` cluster-wide slots ``name``.
+
+        Returns the slot number to pass to :meth:`release_slot`, or None
+        when every slot is taken. Without the database it fails open and
+        returns -1, leaving only the worker's own limit in place.
+        """
+        held = self._held_slots.setdefault(name, set())
+        candidates = [number for number in range(slots) if number not in held]
+        if not candidates:
+            return None
+        # Reserved while the call is in flight, so a concurrent call cannot
+        # take the same lock a second time on this connection
+        held.update(candidates)
+        keys = [(candidate, advisory_key(f"{name}:{candidate}")) for candidate in candidates]
+        try:
+            number = await self._call(_try_slot_locks, keys)
+        except Exception as lock_error:
+            logging.warning(f"Cross-worker slots {name} unavailable, continuing without them: {lock_error}")
+            number = -1
+        finally:
+            held.difference_update(candidates)
+        if number is not None and number >= 0:
+            held.add(number)
+        return number
+
+    async def release_slot(self, name: str, number: int):
+        if number < 0:
+            return
+        self._held_slots.get(name, set()).discard(number)
+        try:
+            await self._call(_advisory_unlock, advisory_key(f"{name}:{number}"))
+        except Exception as unlock_error:
+            logging.warning(f"Could not release cross-worker slot {name}:{number}: {unlock_error}")
+
+    async def take_token(self, key: str, rate: float, burst: float) -> Tuple[bool, Optional[float]]:
+        """Take one token from the shared bucket ``key``.
+
+        Returns ``(allowed, retry_after_seconds)``; ``retry_after`` is None
+        when the request is allowed.
+        """
+        try:
+            return await self.db.run(take_rate_limit_token, key, rate, burst)
+        except Exception as db_error:
+            logging.warning(f"Shared rate limit {key} unavailable, allowing request: {db_error}")
+            return True, None
+
+
+def _try_advisory_lock(cursor, key: int) -> bool:
+    cursor.execute("SELECT pg_try_advisory_lock(%s)", (key,))
+    return cursor.fetchone()[0]
+
+
+def _try_slot_locks(cursor, slots: List[Tuple[int, int]]) -> Optional[int]:
+    for number, key in slots:
+        if _try_advisory_lock(cursor, key):
+            return number
+    return None
+
+
+def _advisory_unlock(cursor, key: int):
+    cursor.execute("SELECT pg_advisory_unlock(%s)", (key,))
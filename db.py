@@ -0,0 +1,351 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import pool, sql
+from psycopg2.extras import RealDictCursor, execute_values
+
+# Database connection settings
+POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "postgres")
+POSTGRES_PORT = int(os.environ.get("POSTGRES_PORT", "5432"))
+POSTGRES_DB = os.environ.get("POSTGRES_DB", "vit")
+POSTGRES_USER = os.environ.get("POSTGRES_USER", "vit")
+POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "vit")
+
+# Worker processes serving the app (uvicorn --workers reads the same variable)
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# Connections all workers may open together; keep it below PostgreSQL's max_connections
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", "24"))
+
+# Connection pool sizing; by default each worker gets its share of DB_MAX_CONNECTIONS,
+# less the connection its coordinator holds for advisory locks
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX") or max(1, DB_MAX_CONNECTIONS // WEB_CONCURRENCY - 1))
+
+
+class Database:
+    """Pooled access to PostgreSQL for the async request path.
+
+    psycopg2 is blocking, so every query runs on a dedicated thread pool
+    sized to the connection pool. A call therefore never waits on
+    ``getconn`` inside a worker thread; excess calls queue in the executor,
+    which is what the saturation metrics report.
+    """
+
+    def __init__(self, minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.connect_kwargs = connect_kwargs or {
+            "host": POSTGRES_HOST,
+            "port": POSTGRES_PORT,
+            "database": POSTGRES_DB,
+            "user": POSTGRES_USER,
+            "password": POSTGRES_PASSWORD,
+        }
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix="db")
+        self._stats_lock = threading.Lock()
+        self._waiting = 0
+        self._in_use = 0
+        self._acquired_total = 0
+        self._errors_total = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+
+    async def open(self):
+        """Create the pool, logging instead of failing if the database is down."""
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._get_pool)
+            logging.info(f"Database pool ready (min={self.minconn}, max={self.maxconn})")
+        except Exception as db_error:
+            logging.error(f"Could not open database pool, will retry on first use: {db_error}")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.connect_kwargs)
+            return self._pool
+
+    async def run(self, fn, *args):
+        """Run ``fn(conn, *args)`` on a pooled connection and commit.
+
+        Rolls back and re-raises on error; connections broken by the error
+        are discarded instead of being returned to the pool.
+        """
+        with self._stats_lock:
+            self._waiting += 1
+        submitted = time.perf_counter()
+        # Carry the request id into the worker thread for log correlation
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, context.run, self._call, fn, submitted, args
+        )
+
+    def _call(self, fn, submitted, args):
+        waited = time.perf_counter() - submitted
+        with self._stats_lock:
+            self._waiting -= 1
+            self._in_use += 1
+            self._acquired_total += 1
+            self._wait_seconds_total += waited
+            self._wait_seconds_max = max(self._wait_seconds_max, waited)
+        conn = None
+        try:
+            db_pool = self._get_pool()
+            conn = db_pool.getconn()
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            with self._stats_lock:
+                self._errors_total += 1
+            if conn is not None and not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+        finally:
+            if conn is not None:
+                self._pool.putconn(conn, close=bool(conn.closed))
+            with self._stats_lock:
+                self._in_use -= 1
+
+    async def ping(self) -> bool:
+        try:
+            await self.run(_select_one)
+            return True
+        except Exception as db_error:
+            logging.error(f"Database health check failed: {db_error}")
+            return False
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            acquired = self._acquired_total
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "saturation": self._in_use / self.maxconn if self.maxconn else 0.0,
+                "acquired_total": acquired,
+                "errors_total": self._errors_total,
+                "wait_seconds_avg": self._wait_seconds_total / acquired if acquired else 0.0,
+                "wait_seconds_max": self._wait_seconds_max,
+            }
+
+
+def _select_one(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1")
+        return cursor.fetchone()
+
+
+def fetch_history(conn, session_id: str, limit: int):
+    """Return the session's stored summary (or None) and its last ``limit`` turns, oldest first.
+
+    Served by the ``(session_id, timestamp)`` index without sorting the
+    whole session; older turns are folded into the summary by
+    :class:`history_maintenance.HistoryMaintainer`, so the rows read stay
+    bounded however long the session runs.
+    """
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("SELECT summary FROM conversation_summaries WHERE session_id = %s", (session_id,))
+        summary = cursor.fetchone()
+        cursor.execute(
+            "SELECT id, user_input, model_response FROM conversation_history WHERE session_id = %s "
+            "ORDER BY timestamp DESC, id DESC LIMIT %s",
+            (session_id, limit)
+        )
+        rows = cursor.fetchall()
+    rows.reverse()
+    return (summary["summary"] if summary else None), rows
+
+
+def fetch_last_id(conn, session_id: str):
+    """Return the id of the session's newest row, or None if it has none."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM conversation_history WHERE session_id = %s ORDER BY timestamp DESC, id DESC LIMIT 1",
+            (session_id,)
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def insert_turns(conn, rows, on_inserted=None):
+    """Insert ``(session_id, user_input, model_response, timestamp)`` rows at once.
+
+    Returns ``(row_id, previous_id)`` per row, where ``previous_id`` is the
+    session's newest row before it, for history cache write-through.
+    ``on_inserted`` is called with that list before the transaction commits.
+    """
+    session_ids = list({row[0] for row in rows})
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT DISTINCT ON (session_id) session_id, id FROM conversation_history "
+            "WHERE session_id = ANY(%s) ORDER BY session_id, timestamp DESC, id DESC",
+            (session_ids,)
+        )
+        last_ids = dict(cursor.fetchall())
+        inserted = execute_values(
+            cursor,
+            "INSERT INTO conversation_history (session_id, user_input, model_response, timestamp) "
+            "VALUES %s RETURNING id",
+            rows,
+            page_size=len(rows),
+            fetch=True
+        )
+    results = []
+    for row, (row_id,) in zip(rows, inserted):
+        results.append((row_id, last_ids.get(row[0])))
+        last_ids[row[0]] = row_id
+    if on_inserted is not None:
+        on_inserted(results)
+    return results
+
+
+def find_sessions_to_compact(conn, max_turns: int, max_chars: int, active_since, limit: int):
+    """Sessions written to since ``active_since`` holding more than ``max_turns`` turns or ``max_chars`` characters."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT session_id FROM conversation_history WHERE session_id IN ("
+            "SELECT DISTINCT session_id FROM conversation_history WHERE timestamp >= %s) "
+            "GROUP BY session_id HAVING count(*) > %s "
+            "OR sum(length(user_input) + length(model_response)) > %s LIMIT %s",
+            (active_since, max_turns, max_chars, limit)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def find_sessions_continuing_after(conn, partition: str, upper, limit: int):
+    """Sessions with turns in ``partition`` that also have turns from ``upper`` on."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                "SELECT DISTINCT old.session_id FROM {} AS old WHERE EXISTS ("
+                "SELECT 1 FROM conversation_history AS newer "
+                "WHERE newer.session_id = old.session_id AND newer.timestamp >= %s) LIMIT %s"
+            ).format(sql.Identifier(partition)),
+            (upper, limit)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def fetch_turns_to_compact(conn, session_id: str, limit: int, keep: int = 0, before=None):
+    """Return the session's summary and its oldest turns, up to ``limit`` of them.
+
+    The newest ``keep`` turns are never returned, nor turns from
+    ``before`` on when it is given.
+    """
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("SELECT summary FROM conversation_summaries WHERE session_id = %s", (session_id,))
+        summary = cursor.fetchone()
+        cursor.execute(
+            "SELECT id, user_input, model_response FROM ("
+            "SELECT id, user_input, model_response, timestamp FROM conversation_history "
+            "WHERE session_id = %(session_id)s AND (%(before)s::timestamp IS NULL OR timestamp < %(before)s) "
+            "ORDER BY timestamp DESC, id DESC OFFSET %(keep)s"
+            ") AS older ORDER BY timestamp, id LIMIT %(limit)s",
+            {"session_id": session_id, "before": before, "keep": keep, "limit": limit}
+        )
+        rows = cursor.fetchall()
+    return (summary["summary"] if summary else None), rows
+
+
+def store_summary(conn, session_id: str, summary: str, row_ids):
+    """Replace the session's summary and delete the turns folded into it, atomically."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO conversation_summaries (session_id, summary, turns) VALUES (%s, %s, %s) "
+            "ON CONFLICT (session_id) DO UPDATE SET summary = EXCLUDED.summary, "
+            "turns = conversation_summaries.turns + EXCLUDED.turns, updated_at = CURRENT_TIMESTAMP",
+            (session_id, summary, len(row_ids))
+        )
+        cursor.execute(
+            "DELETE FROM conversation_history WHERE session_id = %s AND id = ANY(%s)",
+            (session_id, list(row_ids))
+        )
+
+
+def delete_orphan_summaries(conn, retention_days: int) -> int:
+    """Delete summaries of sessions with no turns left and no update within the retention period."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM conversation_summaries AS summaries "
+            "WHERE updated_at < CURRENT_TIMESTAMP - make_interval(days => %s) AND NOT EXISTS ("
+            "SELECT 1 FROM conversation_history WHERE session_id = summaries.session_id)",
+            (retention_days,)
+        )
+        return cursor.rowcount
+
+
+def fetch_cached_response(conn, key: str, ttl_seconds: float):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT response FROM response_cache WHERE key = %s "
+            "AND created_at > CURRENT_TIMESTAMP - make_interval(secs => %s)",
+            (key, ttl_seconds)
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def store_cached_response(conn, key: str, model_name: str, response: str):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO response_cache (key, model, response) VALUES (%s, %s, %s) "
+            "ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response, created_at = CURRENT_TIMESTAMP",
+            (key, model_name, response)
+        )
+
+
+def delete_expired_cached_responses(conn, ttl_seconds: float) -> int:
+    """Delete cached responses older than ``ttl_seconds``, which lookups no longer return."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM response_cache WHERE created_at <= CURRENT_TIMESTAMP - make_interval(secs => %s)",
+            (ttl_seconds,)
+        )
+        return cursor.rowcount
+
+
+def take_rate_limit_token(conn, key: str, rate: float, burst: float):
+    """Take a token from bucket ``key`` refilling at ``rate``/s up to ``burst``.
+
+    The refill and the take happen in one upsert; the row is left untouched
+    when no token is available. Returns ``(allowed, retry_after_seconds)``.
+    """
+    params = {"key": key, "rate": rate, "burst": burst}
+    available = (
+        "LEAST(%(burst)s, bucket.tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - bucket.updated_at) * %(rate)s)"
+    )
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO rate_limits AS bucket (key, tokens, updated_at) "
+            "VALUES (%(key)s, %(burst)s - 1, CURRENT_TIMESTAMP) "
+            f"ON CONFLICT (key) DO UPDATE SET tokens = {available} - 1, updated_at = CURRENT_TIMESTAMP "
+            f"WHERE {available} >= 1 RETURNING tokens",
+            params
+        )
+        if cursor.fetchone() is not None:
+            return True, None
+        cursor.execute(
+            f"SELECT (1 - {available}) / %(rate)s FROM rate_limits AS bucket WHERE key = %(key)s",
+            params
+        )
+        row = cursor.fetchone()
+    return False, float(row[0]) if row else 1 / rate
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Minimal stand-in for the Ollama HTTP API used by the benchmarks.
+
+Run it with uvicorn, e.g.:
+
+    FAKE_OLLAMA_LATENCY=1.0 uvicorn fake_ollama:app --port 11435
+
+By default FAKE_OLLAMA_LATENCY is spread evenly over the response words.
+Setting FAKE_OLLAMA_TOKEN_RATE instead models a real server: a fixed
+FAKE_OLLAMA_PREFILL delay before the first token, then FAKE_OLLAMA_TOKENS
+tokens at the given rate.
+"""
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+import asyncio
+import json
+import os
+
+# Seconds spent "generating" each response
+FAKE_OLLAMA_LATENCY = float(os.environ.get("FAKE_OLLAMA_LATENCY", "1.0"))
+# Fake text returned by /api/generate, streamed one word at a time
+FAKE_OLLAMA_RESPONSE = os.environ.get("FAKE_OLLAMA_RESPONSE", "This is a fake response.")
+FAKE_OLLAMA_MODELS = os.environ.get("FAKE_OLLAMA_MODELS", "qwen2.5:7b,llama2").split(",")
+# Tokens per second; 0 spreads FAKE_OLLAMA_LATENCY over the response instead
+FAKE_OLLAMA_TOKEN_RATE = float(os.environ.get("FAKE_OLLAMA_TOKEN_RATE", "0"))
+# Seconds before the first token when FAKE_OLLAMA_TOKEN_RATE is set
+FAKE_OLLAMA_PREFILL = float(os.environ.get("FAKE_OLLAMA_PREFILL", "0"))
+# Response length in tokens, repeating FAKE_OLLAMA_RESPONSE; 0 keeps it as is
+FAKE_OLLAMA_TOKENS = int(os.environ.get("FAKE_OLLAMA_TOKENS", "0"))
+
+app = FastAPI()
+
+
+@app.get("/api/version")
+async def version():
+    return {"version": "0.0.0-fake"}
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": name} for name in FAKE_OLLAMA_MODELS if name]}
+
+
+@app.post("/api/pull")
+async def pull(body: dict):
+    name = body.get("name") or body.get("model")
+    if name and name not in FAKE_OLLAMA_MODELS:
+        FAKE_OLLAMA_MODELS.append(name)
+    return {"status": "success"}
+
+
+@app.post("/api/generate")
+async def generate(body: dict):
+    return await respond(body, chat=False)
+
+
+@app.post("/api/chat")
+async def chat(body: dict):
+    return await respond(body, chat=True)
+
+
+def response_words():
+    words = FAKE_OLLAMA_RESPONSE.split(" ")
+    if FAKE_OLLAMA_TOKENS:
+        words = [words[i % len(words)] for i in range(FAKE_OLLAMA_TOKENS)]
+    return words
+
+
+def schedule(words):
+    """Seconds before the first token and between tokens."""
+    if FAKE_OLLAMA_TOKEN_RATE > 0:
+        return FAKE_OLLAMA_PREFILL, 1 / FAKE_OLLAMA_TOKEN_RATE
+    return 0.0, FAKE_OLLAMA_LATENCY / len(words)
+
+
+def prompt_tokens(body):
+    if "messages" in body:
+        text = " ".join(message.get("content", "") for message in body["messages"])
+    else:
+        text = body.get("prompt", "")
+    return len(text.split())
+
+
+def chunk(model, text, chat, done, prompt_eval_count=1, words=0, prefill=0.0, per_token=0.0):
+    if chat:
+        data = {"model": model, "message": {"role": "assistant", "content": text}, "done": done}
+    else:
+        data = {"model": model, "response": text, "done": done}
+    if done:
+        data.update({
+            "total_duration": int((prefill + per_token * words) * 1e9),
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": int(prefill * 1e9),
+            "eval_count": words,
+            "eval_duration": int(per_token * words * 1e9),
+        })
+    return data
+
+
+async def respond(body, chat):
+    model = body.get("model")
+    words = response_words()
+    if body.get("stream", True):
+        return StreamingResponse(stream_tokens(model, chat, words, prompt_tokens(body)),
+                                 media_type="application/x-ndjson")
+    prefill, per_token = schedule(words)
+    await asyncio.sleep(prefill + per_token * len(words))
+    return chunk(model, " ".join(words), chat, True, prompt_tokens(body), len(words), prefill, per_token)
+
+
+async def stream_tokens(model, chat, words, prompt_eval_count):
+    prefill, per_token = schedule(words)
+    await asyncio.sleep(prefill)
+    for i, word in enumerate(words):
+        await asyncio.sleep(per_token)
+        token = word if i == 0 else " " + word
+        yield json.dumps(chunk(model, token, chat, done=False)) + "\n"
+    yield json.dumps(chunk(model, "", chat, True, prompt_eval_count, len(words), prefill, per_token)) + "\n"
@@ -0,0 +1,132 @@
+import os
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+from context import HISTORY_MAX_TURNS, Turn
+
+# Upper bound on the text held by the cache across all sessions
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Seconds an idle session stays cached
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", "600"))
+# Check the session's latest row id before serving a cached entry; only safe
+# to disable when a single process writes to the database
+HISTORY_CACHE_VALIDATE = os.environ.get("HISTORY_CACHE_VALIDATE", "1") != "0"
+
+
+class CachedHistory(NamedTuple):
+    turns: List[Turn]
+    last_id: Optional[int]
+    size: int
+    expires_at: float
+    summary: Optional[Turn] = None
+
+
+def _size(turns: List[Turn]) -> int:
+    return sum(len(turn.user_input) + len(turn.model_response) for turn in turns)
+
+
+class HistoryCache:
+    """Per-session LRU/TTL cache of formatted history turns.
+
+    Entries hold the same summary and window of recent turns that
+    :func:`db.fetch_history` returns, tagged with the id of the newest row.
+    Callers compare that id with the database before trusting an entry, so
+    rows written by other worker processes cause a reload rather than a
+    silently shortened history.
+
+    The TTL is measured from the last access, so a session's expiry and its
+    LRU position move together and eviction only looks at the oldest entry.
+    """
+
+    def __init__(self, max_bytes: int = HISTORY_CACHE_MAX_BYTES, ttl: float = HISTORY_CACHE_TTL,
+                 max_turns: int = HISTORY_MAX_TURNS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self._entries: "OrderedDict[str, CachedHistory]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, session_id: str) -> Optional[CachedHistory]:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at < time.monotonic():
+            self._remove(session_id)
+            self.misses += 1
+            return None
+        # Sliding expiry keeps the dict ordered by both recency and expiry
+        entry = entry._replace(expires_at=time.monotonic() + self.ttl)
+        self._entries[session_id] = entry
+        self._entries.move_to_end(session_id)
+        return entry
+
+    def record_hit(self):
+        self.hits += 1
+
+    def record_stale(self, session_id: str):
+        """Count and drop an entry that no longer matches the database."""
+        self.stale += 1
+        self.misses += 1
+        self.invalidate(session_id)
+
+    def put(self, session_id: str, turns: List[Turn], last_id: Optional[int], summary: Optional[Turn] = None):
+        turns = list(turns[-self.max_turns:])
+        size = _size(turns + [summary] if summary is not None else turns)
+        self.invalidate(session_id)
+        if size > self.max_bytes:
+            return
+        self._entries[session_id] = CachedHistory(turns, last_id, size, time.monotonic() + self.ttl, summary)
+        self._bytes += size
+        self._evict()
+
+    def append(self, session_id: str, turn: Turn, row_id: int, previous_id: Optional[int]):
+        """Write-through for a newly inserted row.
+
+        ``previous_id`` is the session's newest row id seen by the insert;
+        if it differs from the cached one another process wrote in between
+        and the entry is dropped instead of being extended.
+        """
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return
+        if entry.last_id != previous_id:
+            self.invalidate(session_id)
+            return
+        self.put(session_id, entry.turns + [turn], row_id, entry.summary)
+
+    def invalidate(self, session_id: str):
+        if session_id in self._entries:
+            self._remove(session_id)
+
+    def _remove(self, session_id: str):
+        entry = self._entries.pop(session_id)
+        self._bytes -= entry.size
+
+    def _evict(self):
+        now = time.monotonic()
+        # The oldest entry is both least recently used and first to expire
+        while self._entries:
+            session_id, entry = next(iter(self._entries.items()))
+            if self._bytes <= self.max_bytes and entry.expires_at >= now:
+                break
+            self._remove(session_id)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from context import HISTORY_MAX_TURNS, format_turn, select_history_window
+from coordination import Coordinator
+from db import (
+    Database, delete_expired_cached_responses, delete_orphan_summaries, fetch_history, fetch_turns_to_compact, find_sessions_continuing_after,
+    find_sessions_to_compact, store_summary
+)
+from history_cache import HistoryCache
+from metrics import ERRORS
+from migrations import Partition, ensure_partitions, list_partitions, retire_partition, run_migrations
+from model_registry import PRIMARY_MODEL, ModelRegistry
+from ollama_client import response_text
+from ollama_pool import OllamaPool
+from response_cache import RESPONSE_CACHE_POSTGRES, RESPONSE_CACHE_TTL
+from scheduler import Scheduler
+
+# Seconds between maintenance passes (partitions, retention, summaries)
+HISTORY_MAINTENANCE_INTERVAL = float(os.environ.get("HISTORY_MAINTENANCE_INTERVAL", "300"))
+# Days of turns kept in conversation_history; 0 keeps them forever
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "0"))
+# "drop" deletes expired partitions, "detach" keeps them as standalone tables for archiving
+HISTORY_RETENTION_MODE = os.environ.get("HISTORY_RETENTION_MODE", "drop")
+# Model that writes session summaries; empty disables summarization
+HISTORY_SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL", PRIMARY_MODEL)
+# Most turns of a session kept verbatim; fewer when they do not all fit the
+# prompt window, and older ones are folded into its summary
+HISTORY_SUMMARY_KEEP_TURNS = int(os.environ.get("HISTORY_SUMMARY_KEEP_TURNS", str(HISTORY_MAX_TURNS)))
+# Tokens of the prompt window left for the new message and a longer summary
+# when deciding which turns still fit
+HISTORY_SUMMARY_HEADROOM = int(os.environ.get("HISTORY_SUMMARY_HEADROOM", "512"))
+# Most turns folded per summarization call
+HISTORY_SUMMARY_BATCH = int(os.environ.get("HISTORY_SUMMARY_BATCH", "20"))
+# Sessions summarized per maintenance pass
+HISTORY_SUMMARY_SESSIONS = int(os.environ.get("HISTORY_SUMMARY_SESSIONS", "50"))
+# Timeout for one summarization call
+HISTORY_SUMMARY_TIMEOUT = float(os.environ.get("HISTORY_SUMMARY_TIMEOUT", "120"))
+
+# Fewest characters per token the estimate gives for ordinary text, used to
+# find sessions that may no longer fit the window without counting tokens in SQL
+_MIN_CHARS_PER_TOKEN = 3
+
+SUMMARY_INSTRUCTION = """Below is an earlier summary of a conversation between a user and an AI assistant, followed by
+the turns that came after it. Write a new summary covering both, in at most 200 words. Keep names,
+facts, decisions, open questions and user preferences; leave out small talk. Reply with the summary only.
+
+Earlier summary:
+{summary}
+
+Turns:
+{turns}"""
+
+
+class HistoryMaintainer:
+    """Background upkeep of conversation_history.
+
+    Every pass creates the coming months' partitions, expires partitions
+    older than the retention period and shared cached responses older than
+    their TTL, and folds the old turns of long
+    sessions into one summary row per session, so prompt building reads a
+    bounded number of rows. ``window_tokens`` is the history budget of a
+    prompt: turns that no longer fit it are folded, so they reach the model
+    through the summary rather than not at all. Turns of a session that is
+    still active are summarized before their partition expires. With a
+    ``coordinator`` only one worker runs a pass at a time.
+    """
+
+    def __init__(self, db: Database, ollama: OllamaPool, models: ModelRegistry, scheduler: Scheduler,
+                 cache: HistoryCache, window_tokens: int, coordinator: Optional[Coordinator] = None,
+                 migrated: bool = False):
+        self.db = db
+        self.ollama = ollama
+        self.models = models
+        self.scheduler = scheduler
+        self.cache = cache
+        self.window_tokens = max(window_tokens - HISTORY_SUMMARY_HEADROOM, 0)
+        self.coordinator = coordinator
+        self.migrated = migrated
+        self._task: Optional[asyncio.Task] = None
+        # Sessions written before this were checked by an earlier pass
+        self._active_since = datetime.utcnow() - timedelta(seconds=2 * HISTORY_MAINTENANCE_INTERVAL)
+        self.passes_total = 0
+        self.failed_passes_total = 0
+        self.partitions_created_total = 0
+        self.partitions_retired_total = 0
+        self.sessions_summarized_total = 0
+        self.turns_summarized_total = 0
+        self.summary_failures_total = 0
+        self.cached_responses_expired_total = 0
+        self.last_pass_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(HISTORY_MAINTENANCE_INTERVAL)
+            try:
+                await self.run_once()
+            except Exception as maintenance_error:
+                self.failed_passes_total += 1
+                ERRORS.inc("history_maintenance")
+                logging.error(f"History maintenance pass failed: {maintenance_error}")
+
+    async def run_once(self):
+        if not self.migrated:
+            self.migrated = await run_migrations(self.db)
+            if not self.migrated:
+                return
+        if self.coordinator is None:
+            await self._run_once()
+            return
+        async with self.coordinator.lock("history_maintenance") as acquired:
+            if acquired:
+                await self._run_once()
+
+    async def _run_once(self):
+        start_time = time.perf_counter()
+        now = datetime.utcnow()
+        created = await self.db.run(ensure_partitions, now)
+        if created:
+            self.partitions_created_total += len(created)
+            logging.info(f"Created history partitions: {created}")
+        budget = HISTORY_SUMMARY_SESSIONS
+        if HISTORY_RETENTION_DAYS > 0:
+            budget = await self._expire(now - timedelta(days=HISTORY_RETENTION_DAYS), budget)
+        if RESPONSE_CACHE_POSTGRES:
+            self.cached_responses_expired_total += await self.db.run(
+                delete_expired_cached_responses, RESPONSE_CACHE_TTL
+            )
+        if HISTORY_SUMMARY_MODEL:
+            await self._compact(now, budget)
+        self.passes_total += 1
+        self.last_pass_seconds = time.perf_counter() - start_time
+
+    async def _expire(self, cutoff: datetime, budget: int) -> int:
+        """Retire partitions ending before ``cutoff``; returns the summary budget left."""
+        for partition in await self.db.run(list_partitions):
+            if partition.upper is None or partition.upper > cutoff:
+                continue
+            budget, summarized = await self._summarize_continuing(partition, budget)
+            if not summarized:
+                logging.info(f"Keeping history partition {partition.name} until its active sessions are summarized")
+                continue
+            await self.db.run(retire_partition, partition.name, HISTORY_RETENTION_MODE == "detach")
+            self.partitions_retired_total += 1
+            if HISTORY_RETENTION_MODE == "detach":
+                logging.info(f"Detached history partition {partition.name}; archive it and drop the table")
+            else:
+                logging.info(f"Dropped history partition {partition.name}")
+        deleted = await self.db.run(delete_orphan_summaries, HISTORY_RETENTION_DAYS)
+        if deleted:
+            logging.info(f"Deleted {deleted} summaries of expired sessions")
+        return budget
+
+    async def _summarize_continuing(self, partition: Partition, budget: int):
+        """Fold the partition's turns of sessions that carry on past it into their summaries.
+
+        Returns the budget left and whether no such turns remain.
+        """
+        if not HISTORY_SUMMARY_MODEL:
+            return budget, True
+        sessions = await self.db.run(find_sessions_continuing_after, partition.name, partition.upper, budget + 1)
+        for session_id in sessions[:budget]:
+            while True:
+                folded = await self.summarize(session_id, before=partition.upper)
+                if folded is None:
+                    return 0, False
+                if folded < HISTORY_SUMMARY_BATCH:
+                    break
+        return max(budget - len(sessions), 0), len(sessions) <= budget
+
+    async def _compact(self, now: datetime, budget: int):
+        sessions = await self.db.run(
+            find_sessions_to_compact, HISTORY_SUMMARY_KEEP_TURNS, self.window_tokens * _MIN_CHARS_PER_TOKEN,
+            self._active_since, budget
+        )
+        for session_id in sessions:
+            keep = await self.window_turns(session_id)
+            if keep is not None and await self.summarize(session_id, keep=keep) is None:
+                return
+        # Sessions left over when the budget ran out are found again next pass
+        if len(sessions) < budget:
+            self._active_since = now
+
+    async def window_turns(self, session_id: str) -> Optional[int]:
+        """How many of the session's newest turns a prompt window holds, or None if it holds them all."""
+        _, rows = await self.db.run(fetch_history, session_id, HISTORY_SUMMARY_KEEP_TURNS)
+        turns = [format_turn(row["user_input"], row["model_response"]) for row in rows]
+        # Counted like a prompt does, trim points included, so no turn falls between the window and the summary
+        kept = len(select_history_window(turns, self.window_tokens))
+        if kept == len(rows) < HISTORY_SUMMARY_KEEP_TURNS:
+            return None
+        return kept
+
+    async def summarize(self, session_id: str, keep: int = 0, before: Optional[datetime] = None) -> Optional[int]:
+        """Fold the session's oldest turns into its summary.
+
+        Returns the number of turns folded, or None if the model could not
+        be reached, in which case the turns are left as they are.
+        """
+        summary, rows = await self.db.run(fetch_turns_to_compact, session_id, HISTORY_SUMMARY_BATCH, keep, before)
+        if not rows:
+            return 0
+        prompt = SUMMARY_INSTRUCTION.format(
+            summary=summary or "(none)",
+            turns="".join(format_turn(row["user_input"], row["model_response"]).text for row in rows)
+        )
+        payload = {"model": HISTORY_SUMMARY_MODEL, "prompt": prompt, "options": {"temperature": 0.2}}
+        try:
+            if not self.models.is_available(HISTORY_SUMMARY_MODEL):
+                raise RuntimeError(f"model {HISTORY_SUMMARY_MODEL} is not available")
+            # Summaries queue for the same generation slots as chat requests and
+            # give up with the rest when the queue is full
+            async with self.scheduler.slot(HISTORY_SUMMARY_MODEL, f"summary:{session_id}"):
+                response = await self.ollama.complete(payload, timeout=HISTORY_SUMMARY_TIMEOUT, session_id=session_id)
+            if response.status_code != 200:
+                raise RuntimeError(f"status {response.status_code}")
+            new_summary = response_text(response.json()).strip()
+            if not new_summary:
+                raise RuntimeError("empty summary")
+        except Exception as summary_error:
+            self.summary_failures_total += 1
+            ERRORS.inc("history_summary")
+            logging.warning(f"Could not summarize session {session_id}, keeping its turns: {summary_error}")
+            return None
+        await self.db.run(store_summary, session_id, new_summary, [row["id"] for row in rows])
+        # This worker's cached copy lacks the new summary; other workers pick it up on their next reload
+        self.cache.invalidate(session_id)
+        self.sessions_summarized_total += 1
+        self.turns_summarized_total += len(rows)
+        logging.info(f"Summarized {len(rows)} turns of session {session_id}")
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "migrated": self.migrated,
+            "retention_days": HISTORY_RETENTION_DAYS,
+            "summary_model": HISTORY_SUMMARY_MODEL,
+            "passes_total": self.passes_total,
+            "failed_passes_total": self.failed_passes_total,
+            "partitions_created_total": self.partitions_created_total,
+            "partitions_retired_total": self.partitions_retired_total,
+            "sessions_summarized_total": self.sessions_summarized_total,
+            "turns_summarized_total": self.turns_summarized_total,
+            "summary_failures_total": self.summary_failures_total,
+            "cached_responses_expired_total": self.cached_responses_expired_total,
+            "last_pass_seconds": self.last_pass_seconds,
+        }
@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+# Seconds a finished request stays replayable under its Idempotency-Key
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "300"))
+# Finished requests remembered for replay; the oldest are forgotten first
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "1000"))
+
+
+class KeyReused(Exception):
+    """Raised when an ``Idempotency-Key`` comes back with a different request body."""
+
+
+def body_digest(user_input: str) -> str:
+    return hashlib.sha256(user_input.encode("utf-8")).hexdigest()
+
+
+def request_key(endpoint: str, session_id: Optional[str], user_input: str,
+                idempotency_key: Optional[str]) -> Optional[str]:
+    """Key under which identical requests share one result, or None if they cannot.
+
+    An explicit ``Idempotency-Key`` is scoped to the session. Without one,
+    requests of the same session with the same input are identical; a
+    request without a session starts a new one, so it has no duplicates.
+    """
+    if idempotency_key:
+        return f"{endpoint}:{session_id or '-'}:key:{idempotency_key}"
+    if session_id:
+        return f"{endpoint}:{session_id}:input:{body_digest(user_input)}"
+    return None
+
+
+class SharedRequest:
+    """The work of one request, shared by every identical request that joins it.
+
+    The first caller either starts the work with :meth:`run`, an async
+    iterator producing the reply (one item for ``/chat``, SSE events for
+    ``/chat/stream``), or rejects it with :meth:`fail`. Everyone, the first
+    caller included, reads the reply through :meth:`result` or
+    :meth:`subscribe`, which replay what was produced before they joined.
+    The work runs outside any single client request and is cancelled when
+    its last reader goes away.
+    """
+
+    def __init__(self, registry: "InflightRequests", key: str, keep: bool, fingerprint: Optional[str] = None):
+        self.registry = registry
+        self.key = key
+        self.keep = keep
+        # Digest of the request body, compared when the key is used again
+        self.fingerprint = fingerprint
+        self.started = asyncio.get_running_loop().create_future()
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def run(self, producer: AsyncIterator):
+        self._task = asyncio.create_task(self._produce(producer))
+        self.started.set_result(None)
+
+    def fail(self, error: BaseException):
+        """Reject this request and every request waiting to join it with ``error``."""
+        if not isinstance(error, Exception):
+            # Cancellation belongs to the first caller's task, not to the ones joining it
+            error = RuntimeError("The identical request this one joined was cancelled")
+        self.started.set_exception(error)
+        # Nobody may be waiting; retrieve it so asyncio does not warn
+        self.started.exception()
+        self.registry.forget(self)
+
+    async def joined(self):
+        """Wait until the first caller has started the work; re-raises its rejection."""
+        await asyncio.shield(self.started)
+
+    async def _produce(self, producer: AsyncIterator):
+        try:
+            async for item in producer:
+                self.items.append(item)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as producer_error:
+            self.error = producer_error
+        finally:
+            self.done = True
+            self._notify()
+            self.registry.finished(self)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _attach(self):
+        self.readers += 1
+
+    def _detach(self):
+        self.readers -= 1
+        if self.readers == 0 and not self.done and self._task is not None:
+            self._task.cancel()
+            self.registry.forget(self)
+
+    async def _read(self):
+        index = 0
+        while True:
+            while index < len(self.items):
+                yield self.items[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+    async def result(self) -> Any:
+        """The single item produced, for request/response endpoints."""
+        self._attach()
+        try:
+            async for item in self._read():
+                return item
+            return None
+        finally:
+            self._detach()
+
+    def subscribe(self) -> AsyncIterator:
+        """Every item produced so far and from now on, for streaming endpoints."""
+        # Counted right away, so the work is not cancelled before the stream is read
+        self._attach()
+        return self._subscribe()
+
+    async def _subscribe(self):
+        try:
+            async for item in self._read():
+                yield item
+        finally:
+            self._detach()
+
+
+class InflightRequests:
+    """In-process registry of running, and recently finished, shared requests.
+
+    Requests are shared only within a worker; a duplicate routed to another
+    worker runs on its own.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._running: Dict[str, SharedRequest] = {}
+        self._finished: "OrderedDict[str, Tuple[SharedRequest, float]]" = OrderedDict()
+        self.started_total = 0
+        self.joined_total = 0
+        self.replayed_total = 0
+        self.reused_total = 0
+
+    def claim(self, key: str, keep: bool = False, fingerprint: Optional[str] = None) -> Tuple[SharedRequest, bool]:
+        """Return the shared request for ``key`` and whether the caller must start it.
+
+        With ``keep``, a successful result stays replayable for ``ttl``
+        seconds after it finished. Raises :class:`KeyReused` if ``key`` is
+        running or replayable for a request with another ``fingerprint``.
+        """
+        self._expire()
+        finished = self._finished.get(key)
+        if finished is not None:
+            self._check_fingerprint(finished[0], fingerprint)
+            self.replayed_total += 1
+            return finished[0], False
+        shared = self._running.get(key)
+        if shared is not None:
+            self._check_fingerprint(shared, fingerprint)
+            self.joined_total += 1
+            return shared, False
+        shared = self._running[key] = SharedRequest(self, key, keep, fingerprint)
+        self.started_total += 1
+        return shared, True
+
+    def _check_fingerprint(self, shared: SharedRequest, fingerprint: Optional[str]):
+        if fingerprint is not None and shared.fingerprint is not None and fingerprint != shared.fingerprint:
+            self.reused_total += 1
+            raise KeyReused("Idempotency-Key was already used for a different request")
+
+    def forget(self, shared: SharedRequest):
+        if self._running.get(shared.key) is shared:
+            del self._running[shared.key]
+
+    def finished(self, shared: SharedRequest):
+        self.forget(shared)
+        # Failures are not remembered, so a retry runs again
+        if shared.keep and shared.error is None and self.ttl > 0:
+            self._finished[shared.key] = (shared, time.monotonic() + self.ttl)
+            self._finished.move_to_end(shared.key)
+            self._expire()
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._finished:
+            _, expires_at = next(iter(self._finished.values()))
+            if len(self._finished) <= self.max_keys and expires_at > now:
+                break
+            self._finished.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "replayable": len(self._finished),
+            "started_total": self.started_total,
+            "joined_total": self.joined_total,
+            "replayed_total": self.replayed_total,
+            "reused_total": self.reused_total,
+        }
@@ -30,14 +30,42 @@ GRANT ALL PRIVILEGES ON DATABASE vit TO vit;
 -- Connect to the vit database
 \connect vit;
 
--- Create conversation history table
+-- Create conversation history table, partitioned by month
 CREATE TABLE IF NOT EXISTS conversation_history (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     session_id TEXT NOT NULL,
     user_input TEXT NOT NULL,
     model_response TEXT NOT NULL,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+-- Catches rows outside the monthly partitions the app creates ahead of time
+CREATE TABLE IF NOT EXISTS conversation_history_default PARTITION OF conversation_history DEFAULT;
+
+-- Composite index for fetching the most recent turns of a session
+CREATE INDEX IF NOT EXISTS idx_session_timestamp ON conversation_history(session_id, timestamp);
+
+-- One rolling summary per session of the turns folded out of conversation_history
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    session_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    turns INTEGER NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Optional cache of model responses for repeated prompts
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX IF NOT EXISTS idx_response_cache_created_at ON response_cache(created_at);
 
--- Create index for faster queries by session_id
-CREATE INDEX IF NOT EXISTS idx_session_id ON conversation_history(session_id);
\ No newline at end of file
+-- Token buckets shared by all app workers for rate limiting
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
\ No newline at end of file
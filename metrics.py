@@ -0,0 +1,176 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, from cache hits and DB calls up to long generations
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Upper bounds for generation speed in tokens per second
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, values)} {_number(value)}"
+            for values, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Counter):
+    """Point-in-time value, usually copied from a component's ``stats()``."""
+    kind = "gauge"
+
+    def set(self, value: float, *labelvalues: str):
+        self._values[labelvalues] = float(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: per-bucket (non-cumulative) counts, +Inf last, then the sum
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *labelvalues)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                labels = _labels(self.labelnames, values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, values)} {_number(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, values)} {cumulative}")
+        return lines
+
+
+_REGISTRY: List[_Metric] = []
+
+
+def _register(metric):
+    _REGISTRY.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_SECONDS = _register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency, including streamed bodies",
+    ("method", "route", "status")))
+STAGE_SECONDS = _register(Histogram(
+    "chat_stage_duration_seconds",
+    "Time spent per stage of a chat request: history_fetch, prompt_build, queue_wait, ttft, generation, db_write",
+    ("stage",)))
+TOKENS_PER_SECOND = _register(Histogram(
+    "ollama_eval_tokens_per_second", "Generation speed reported by Ollama's eval counts",
+    ("model",), buckets=TOKEN_RATE_BUCKETS))
+TOKENS_TOTAL = _register(Counter(
+    "ollama_tokens_total", "Tokens processed by Ollama, by kind (prompt or generated)", ("model", "kind")))
+MODEL_SELECTIONS = _register(Counter(
+    "chat_model_selections_total",
+    "Model chosen per request; reason is primary, unavailable (fallback) or circuit_open (fallback)",
+    ("model", "reason")))
+ERRORS = _register(Counter("chat_errors_total", "Errors by type", ("type",)))
+COMPONENT_STATS = _register(Gauge(
+    "component_stat", "Numeric values reported by the /health endpoints, refreshed on scrape",
+    ("component", "stat")))
+MODEL_QUEUE_STATS = _register(Gauge(
+    "model_queue_stat", "Per-model admission queue values from /health/scheduler; circuit_open is 0 or 1",
+    ("model", "stat")))
+BACKEND_STATS = _register(Gauge(
+    "ollama_backend_stat", "Per-backend values from /health/backends; ejected is 0 or 1",
+    ("backend", "stat")))
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every request by route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The route template keeps the label set bounded, unlike the raw path
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start_time, scope["method"],
+                getattr(route, "path", "unmatched"), str(status_code)
+            )
@@ -0,0 +1,253 @@
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+
+from psycopg2 import sql
+
+from coordination import advisory_key
+from db import Database
+
+# Monthly conversation_history partitions created ahead of the current month
+HISTORY_PARTITIONS_AHEAD = int(os.environ.get("HISTORY_PARTITIONS_AHEAD", "2"))
+
+_PARTITION_BOUNDS = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable
+
+
+class Partition(NamedTuple):
+    """A range partition of conversation_history; None bounds are unbounded."""
+    name: str
+    lower: Optional[datetime]
+    upper: Optional[datetime]
+
+
+def month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(moment: datetime, months: int) -> datetime:
+    month = moment.month - 1 + months
+    return moment.replace(year=moment.year + month // 12, month=month % 12 + 1)
+
+
+def _create_partitioned_history(cursor):
+    cursor.execute(
+        "CREATE TABLE conversation_history ("
+        "id SERIAL, session_id TEXT NOT NULL, user_input TEXT NOT NULL, model_response TEXT NOT NULL, "
+        "timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (id, timestamp)"
+        ") PARTITION BY RANGE (timestamp)"
+    )
+    cursor.execute("CREATE INDEX idx_session_timestamp ON conversation_history(session_id, timestamp)")
+    cursor.execute("CREATE TABLE conversation_history_default PARTITION OF conversation_history DEFAULT")
+
+
+def _create_initial_schema(cursor):
+    cursor.execute("SELECT to_regclass('conversation_history')")
+    if cursor.fetchone()[0] is None:
+        _create_partitioned_history(cursor)
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS response_cache ("
+        "key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS rate_limits ("
+        "key TEXT PRIMARY KEY, tokens DOUBLE PRECISION NOT NULL, "
+        "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    )
+
+
+def _add_session_timestamp_index(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_session_timestamp ON conversation_history(session_id, timestamp)")
+
+
+def _partition_history(cursor):
+    """Turn a plain conversation_history into a table partitioned by month.
+
+    The existing table is not copied: it becomes the partition holding
+    everything up to the end of its newest month, and new months get
+    their own partitions. Its primary key is rebuilt to include the
+    timestamp, as every partition's must, and attaching it scans the
+    table once to check the bounds.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'conversation_history'::regclass")
+    if cursor.fetchone()[0] == "p":
+        return
+    # Range partitions cannot hold NULL keys; such rows predate any timestamp we know
+    cursor.execute("UPDATE conversation_history SET timestamp = 'epoch' WHERE timestamp IS NULL")
+    cursor.execute("ALTER TABLE conversation_history ALTER COLUMN timestamp SET NOT NULL")
+    cursor.execute("SELECT max(timestamp) FROM conversation_history")
+    newest = cursor.fetchone()[0]
+    upper = add_months(month_start(newest or datetime.utcnow()), 1)
+
+    cursor.execute("ALTER TABLE conversation_history RENAME TO conversation_history_legacy")
+    # A partition's primary key must match the parent's, which includes the partition key
+    cursor.execute("ALTER TABLE conversation_history_legacy DROP CONSTRAINT conversation_history_pkey")
+    cursor.execute("ALTER TABLE conversation_history_legacy ADD PRIMARY KEY (id, timestamp)")
+    cursor.execute("ALTER INDEX IF EXISTS idx_session_timestamp RENAME TO conversation_history_legacy_session_timestamp")
+    # The composite index serves every lookup the single-column one did
+    cursor.execute("DROP INDEX IF EXISTS idx_session_id")
+    cursor.execute(
+        "CREATE TABLE conversation_history ("
+        "id INTEGER NOT NULL DEFAULT nextval('conversation_history_id_seq'), session_id TEXT NOT NULL, "
+        "user_input TEXT NOT NULL, model_response TEXT NOT NULL, "
+        "timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (id, timestamp)"
+        ") PARTITION BY RANGE (timestamp)"
+    )
+    cursor.execute("ALTER SEQUENCE conversation_history_id_seq OWNED BY conversation_history.id")
+    cursor.execute("CREATE INDEX idx_session_timestamp ON conversation_history(session_id, timestamp)")
+    cursor.execute(
+        "ALTER TABLE conversation_history ATTACH PARTITION conversation_history_legacy "
+        "FOR VALUES FROM (MINVALUE) TO (%s)",
+        (upper,)
+    )
+    cursor.execute("CREATE TABLE conversation_history_default PARTITION OF conversation_history DEFAULT")
+
+
+def _create_summaries(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS conversation_summaries ("
+        "session_id TEXT PRIMARY KEY, summary TEXT NOT NULL, turns INTEGER NOT NULL, "
+        "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    )
+
+
+def _index_response_cache_age(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created_at ON response_cache(created_at)")
+
+
+# Applied in order and recorded in schema_migrations. Every step is
+# idempotent, so a database created from initdb/init.sql passes through them
+# unchanged, and version 0 creates the schema on an empty database.
+MIGRATIONS = [
+    Migration(0, "initial_schema", _create_initial_schema),
+    Migration(1, "history_session_timestamp_index", _add_session_timestamp_index),
+    Migration(2, "partition_conversation_history", _partition_history),
+    Migration(3, "conversation_summaries", _create_summaries),
+    Migration(4, "response_cache_created_at_index", _index_response_cache_age),
+]
+
+
+def pending_migrations(conn) -> List[int]:
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cursor.fetchall()}
+    return [migration.version for migration in MIGRATIONS if migration.version not in applied]
+
+
+def apply_migration(conn, version: int) -> bool:
+    """Apply one migration in the caller's transaction; False if another worker already did."""
+    migration = next(migration for migration in MIGRATIONS if migration.version == version)
+    with conn.cursor() as cursor:
+        # Held until commit, so workers starting together apply each step once
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (advisory_key("schema_migrations"),))
+        cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+        if cursor.fetchone() is not None:
+            return False
+        migration.apply(cursor)
+        cursor.execute(
+            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, migration.name)
+        )
+    return True
+
+
+def list_partitions(conn) -> List[Partition]:
+    """Range partitions of conversation_history, oldest first; the default partition is left out."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = 'conversation_history'::regclass"
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, bound in rows:
+        match = _PARTITION_BOUNDS.search(bound)
+        if match:
+            partitions.append(Partition(name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    partitions.sort(key=lambda partition: partition.lower or datetime.min)
+    return partitions
+
+
+def _parse_bound(value: str) -> Optional[datetime]:
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+def ensure_partitions(conn, now: datetime, months_ahead: int = HISTORY_PARTITIONS_AHEAD) -> List[str]:
+    """Create the monthly partitions from ``now`` up to ``months_ahead`` months later.
+
+    Months already covered by a partition are skipped, as are months with
+    rows in the default partition, which Postgres would refuse to split.
+    Returns the names of the partitions created.
+    """
+    created = []
+    with conn.cursor() as cursor:
+        # Workers run this at the same time on startup
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (advisory_key("history_partitions"),))
+        partitions = list_partitions(conn)
+        for offset in range(months_ahead + 1):
+            lower = add_months(month_start(now), offset)
+            upper = add_months(lower, 1)
+            if any((partition.lower is None or partition.lower <= lower)
+                   and (partition.upper is None or lower < partition.upper) for partition in partitions):
+                continue
+            cursor.execute(
+                "SELECT 1 FROM conversation_history_default WHERE timestamp >= %s AND timestamp < %s LIMIT 1",
+                (lower, upper)
+            )
+            if cursor.fetchone() is not None:
+                logging.warning(f"Rows for {lower:%Y-%m} are in the default partition, not creating one for it")
+                continue
+            name = f"conversation_history_p{lower:%Y%m}"
+            cursor.execute(
+                sql.SQL("CREATE TABLE {} PARTITION OF conversation_history FOR VALUES FROM (%s) TO (%s)").format(
+                    sql.Identifier(name)
+                ),
+                (lower, upper)
+            )
+            created.append(name)
+    return created
+
+
+def retire_partition(conn, name: str, detach: bool):
+    """Drop a partition, or detach it so it can be archived and dropped by hand."""
+    with conn.cursor() as cursor:
+        if detach:
+            cursor.execute(
+                sql.SQL("ALTER TABLE conversation_history DETACH PARTITION {}").format(sql.Identifier(name))
+            )
+        else:
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+
+
+async def run_migrations(db: Database) -> bool:
+    """Bring the schema up to date and create upcoming partitions.
+
+    Logs instead of raising when the database is unavailable, like
+    :meth:`Database.open`; returns whether the schema is current.
+    """
+    try:
+        for version in await db.run(pending_migrations):
+            if await db.run(apply_migration, version):
+                logging.info(f"Applied schema migration {version}")
+        created = await db.run(ensure_partitions, datetime.utcnow())
+        if created:
+            logging.info(f"Created history partitions: {created}")
+        return True
+    except Exception as migration_error:
+        logging.error(f"Could not migrate the database schema, will retry: {migration_error}")
+        return False
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Iterable, Optional, Set
+
+from coordination import Coordinator
+from ollama_pool import OllamaPool
+
+# Models served by the chat endpoint
+PRIMARY_MODEL = os.environ.get("PRIMARY_MODEL", "qwen2.5:7b")
+FALLBACK_MODEL = os.environ.get("FALLBACK_MODEL", "llama2")
+
+# Seconds between background refreshes of the model list
+MODEL_REGISTRY_TTL = float(os.environ.get("MODEL_REGISTRY_TTL", "60"))
+# Faster refresh interval used while Ollama is unreachable
+MODEL_REGISTRY_RETRY = float(os.environ.get("MODEL_REGISTRY_RETRY", "5"))
+# Timeout for a single /api/pull; downloads of a 7B model take minutes
+MODEL_PULL_TIMEOUT = float(os.environ.get("MODEL_PULL_TIMEOUT", "1800"))
+
+
+def normalize_model_name(name: str) -> str:
+    """Ollama reports untagged models as ``name:latest``."""
+    return name if ":" in name else f"{name}:latest"
+
+
+class ModelRegistry:
+    """Cached view of which configured models Ollama can serve.
+
+    The model list is fetched once at startup and refreshed in the
+    background every ``ttl`` seconds, so requests only read in-memory state.
+    Generation failures call :meth:`invalidate` to force an early refresh.
+    Missing models are pulled by a single background job per model, and
+    with a ``coordinator`` by a single worker across the deployment.
+    """
+
+    def __init__(self, ollama: OllamaPool, models: Iterable[str] = (PRIMARY_MODEL, FALLBACK_MODEL),
+                 ttl: float = MODEL_REGISTRY_TTL, coordinator: Optional[Coordinator] = None):
+        self.ollama = ollama
+        self.coordinator = coordinator
+        self.models = list(models)
+        self.ttl = ttl
+        self.reachable = False
+        self.refreshed_at = 0.0
+        self._available: Set[str] = set()
+        self._pulls: Dict[str, asyncio.Task] = {}
+        # Why the last pull of a model failed, until one succeeds
+        self.pull_errors: Dict[str, str] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.refresh()
+        for model_name in self.models:
+            if self.reachable and not self.is_available(model_name):
+                self.ensure_pulled(model_name)
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        tasks = list(self._pulls.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def refresh(self):
+        try:
+            response = await self.ollama.tags(timeout=10)
+            if response.status_code != 200:
+                raise RuntimeError(f"status {response.status_code}")
+            models = response.json().get("models", [])
+            self._available = {normalize_model_name(model.get("name", "")) for model in models}
+            self.reachable = True
+            logging.info(f"Model registry refreshed, available: {self.available_models()}")
+        except Exception as refresh_error:
+            self.reachable = False
+            logging.error(f"Failed to refresh model list from Ollama: {refresh_error}")
+        self.refreshed_at = time.time()
+
+    async def _refresh_loop(self):
+        while True:
+            interval = self.ttl if self.reachable else MODEL_REGISTRY_RETRY
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.refresh()
+
+    def invalidate(self):
+        """Schedule an immediate refresh, e.g. after a failed generation."""
+        self._wakeup.set()
+
+    def is_available(self, model_name: str) -> bool:
+        return normalize_model_name(model_name) in self._available
+
+    def available_models(self):
+        return [model_name for model_name in self.models if self.is_available(model_name)]
+
+    def ensure_pulled(self, model_name: str) -> asyncio.Task:
+        """Start pulling ``model_name`` unless a pull is already running."""
+        task = self._pulls.get(model_name)
+        if task is None or task.done():
+            task = asyncio.create_task(self._pull(model_name))
+            self._pulls[model_name] = task
+        return task
+
+    async def _pull(self, model_name: str):
+        if self.coordinator is None:
+            await self._pull_now(model_name)
+            return
+        while True:
+            async with self.coordinator.lock(f"pull:{model_name}") as acquired:
+                if acquired:
+                    # The worker that held the lock may just have finished this pull
+                    await self.refresh()
+                    if not self.is_available(model_name):
+                        await self._pull_now(model_name)
+                    return
+            logging.info(f"Model {model_name} is being pulled by another worker, waiting...")
+            await asyncio.sleep(MODEL_REGISTRY_RETRY)
+            await self.refresh()
+            if self.is_available(model_name):
+                return
+
+    async def _pull_now(self, model_name: str):
+        logging.info(f"Model {model_name} not found, pulling in the background...")
+        try:
+            response = await self.ollama.pull(model_name, timeout=MODEL_PULL_TIMEOUT)
+            if response.status_code == 200:
+                logging.info(f"Finished pulling model {model_name}")
+                self.pull_errors.pop(model_name, None)
+            else:
+                logging.error(f"Failed to pull model {model_name}: {response.text[:200]}")
+                self.pull_errors[model_name] = f"status {response.status_code}: {response.text[:200]}"
+        except Exception as pull_error:
+            logging.error(f"Error pulling model {model_name}: {pull_error}")
+            self.pull_errors[model_name] = str(pull_error) or type(pull_error).__name__
+        await self.refresh()
+
+    def snapshot(self) -> dict:
+        return {
+            "reachable": self.reachable,
+            "refreshed_at": self.refreshed_at,
+            "models": {model_name: self.is_available(model_name) for model_name in self.models},
+            "pulling": [model_name for model_name, task in self._pulls.items() if not task.done()],
+            "pull_errors": dict(self.pull_errors),
+        }
@@ -0,0 +1,116 @@
+import httpx
+import json
+import os
+from typing import AsyncIterator, Optional
+
+from logging_utils import request_id_var
+
+# Connection pool sizing for the shared Ollama client
+OLLAMA_MAX_CONNECTIONS = int(os.environ.get("OLLAMA_MAX_CONNECTIONS", "20"))
+OLLAMA_MAX_KEEPALIVE = int(os.environ.get("OLLAMA_MAX_KEEPALIVE", "10"))
+# Seconds to establish a connection; a host that is down fails fast instead of
+# holding the request for the whole generation timeout
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "3"))
+
+
+class OllamaClient:
+    """Thin async wrapper around the Ollama HTTP API.
+
+    A single instance is created at application startup and shared by all
+    requests, so TCP connections to Ollama are pooled and reused instead of
+    being opened for every call.
+    """
+
+    def __init__(self, base_url: str, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.base_url = base_url.rstrip("/")
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            transport=transport,
+            limits=httpx.Limits(
+                max_connections=OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(10.0),
+            event_hooks={"request": [_add_request_id]},
+        )
+
+    async def version(self, timeout: float = 5) -> httpx.Response:
+        return await self._client.get("/api/version", timeout=_timeout(timeout))
+
+    async def tags(self, timeout: float = 10) -> httpx.Response:
+        return await self._client.get("/api/tags", timeout=_timeout(timeout))
+
+    async def pull(self, model_name: str, timeout: float = 300) -> httpx.Response:
+        return await self._client.post(
+            "/api/pull",
+            json={"name": model_name, "stream": False},
+            timeout=_timeout(timeout),
+        )
+
+    async def generate(self, payload: dict, timeout: float = 120) -> httpx.Response:
+        return await self._client.post("/api/generate", json=payload, timeout=_timeout(timeout))
+
+    async def chat(self, payload: dict, timeout: float = 120) -> httpx.Response:
+        return await self._client.post("/api/chat", json=payload, timeout=_timeout(timeout))
+
+    async def complete(self, payload: dict, timeout: float = 120) -> httpx.Response:
+        """Non-streaming call to ``/api/chat`` or ``/api/generate``, picked by payload shape."""
+        payload = dict(payload, stream=False)
+        if "messages" in payload:
+            return await self.chat(payload, timeout=timeout)
+        return await self.generate(payload, timeout=timeout)
+
+    async def stream(self, payload: dict, timeout: float = 120) -> AsyncIterator[dict]:
+        """Yield the NDJSON chunks of a streaming ``/api/chat`` or ``/api/generate`` call.
+
+        ``timeout`` bounds the wait for each chunk rather than the whole
+        generation. Raises ``httpx.HTTPStatusError`` on a non-200 response.
+        """
+        path = "/api/chat" if "messages" in payload else "/api/generate"
+        payload = dict(payload, stream=True)
+        async with self._client.stream("POST", path, json=payload, timeout=_timeout(timeout)) as response:
+            if response.status_code != 200:
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+def _timeout(seconds: float) -> httpx.Timeout:
+    return httpx.Timeout(seconds, connect=min(seconds, OLLAMA_CONNECT_TIMEOUT))
+
+
+async def _add_request_id(request: httpx.Request):
+    # Lets Ollama-side logs and proxies be matched with our request logs
+    request_id = request_id_var.get()
+    if request_id != "-":
+        request.headers["X-Request-ID"] = request_id
+
+
+def response_text(data: dict) -> str:
+    """Text of a response or stream chunk from either endpoint."""
+    if "message" in data:
+        return data["message"].get("content", "")
+    return data.get("response", "")
+
+
+def generation_timings(data: dict) -> dict:
+    """Prefill/eval timings from a final response, converted to seconds.
+
+    ``prompt_eval`` is the prefill of the prompt (small when Ollama reuses
+    its cached prefix), ``eval`` the generation of the reply.
+    """
+    timings = {}
+    for key in ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration"):
+        if key in data:
+            timings[key.replace("_duration", "_seconds")] = data[key] / 1e9
+    for key in ("prompt_eval_count", "eval_count"):
+        if key in data:
+            timings[key] = data[key]
+    if data.get("eval_count") and data.get("eval_duration"):
+        timings["eval_tokens_per_second"] = data["eval_count"] / (data["eval_duration"] / 1e9)
+    return timings
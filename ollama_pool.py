@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set
+
+import httpx
+
+from metrics import ERRORS
+from ollama_client import OllamaClient, response_text
+
+# Seconds between active health checks of every backend
+OLLAMA_HEALTH_INTERVAL = float(os.environ.get("OLLAMA_HEALTH_INTERVAL", "10"))
+# A health check slower than this counts as a failure
+OLLAMA_HEALTH_TIMEOUT = float(os.environ.get("OLLAMA_HEALTH_TIMEOUT", "2"))
+# Consecutive failures (health checks, refused connections, server errors) that eject a backend
+OLLAMA_EJECT_FAILURES = int(os.environ.get("OLLAMA_EJECT_FAILURES", "2"))
+# Seconds to wait for the first chunk before failing over to another backend; a
+# slow start means a busy backend, not a broken one, so it does not count towards ejection
+OLLAMA_FIRST_TOKEN_TIMEOUT = float(os.environ.get("OLLAMA_FIRST_TOKEN_TIMEOUT", "30"))
+# Sessions remembered for backend stickiness
+OLLAMA_STICKY_SESSIONS = int(os.environ.get("OLLAMA_STICKY_SESSIONS", "10000"))
+# Extra in-flight requests tolerated on a session's backend before it is moved
+OLLAMA_STICKY_SLACK = int(os.environ.get("OLLAMA_STICKY_SLACK", "2"))
+
+
+class FirstTokenTimeout(httpx.ReadTimeout):
+    """Raised when a backend sends no first chunk within ``OLLAMA_FIRST_TOKEN_TIMEOUT``."""
+
+
+def _normalize(model_name: str) -> str:
+    return model_name if ":" in model_name else f"{model_name}:latest"
+
+
+class Backend:
+    """One Ollama server in the pool and its routing state."""
+
+    def __init__(self, url: str, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.url = url.rstrip("/")
+        self.client = OllamaClient(self.url, transport)
+        self.models: Set[str] = set()
+        self.checked = False
+        self.ejected = False
+        self.failures = 0
+        self.outstanding: Dict[str, int] = defaultdict(int)
+        self.outstanding_total = 0
+        self.requests_total = 0
+        self.failures_total = 0
+        self.slow_starts_total = 0
+        self.health_check_seconds = 0.0
+
+    def has_model(self, model_name: str) -> bool:
+        # Until the first health check we do not know, so assume it does
+        return not self.checked or _normalize(model_name) in self.models
+
+    def begin(self, model_name: str):
+        self.outstanding[model_name] += 1
+        self.outstanding_total += 1
+        self.requests_total += 1
+
+    def end(self, model_name: str):
+        self.outstanding[model_name] -= 1
+        self.outstanding_total -= 1
+
+    def record_success(self):
+        self.failures = 0
+        if self.ejected:
+            logging.info(f"Ollama backend {self.url} is healthy again")
+        self.ejected = False
+
+    def record_failure(self, error: Exception):
+        self.failures += 1
+        self.failures_total += 1
+        if not self.ejected and self.failures >= OLLAMA_EJECT_FAILURES:
+            self.ejected = True
+            logging.warning(f"Ejecting Ollama backend {self.url} after {self.failures} failures: {error}")
+
+    def record_slow_start(self):
+        self.slow_starts_total += 1
+
+    def stats(self) -> dict:
+        return {
+            "ejected": self.ejected,
+            "consecutive_failures": self.failures,
+            "outstanding": self.outstanding_total,
+            "outstanding_by_model": {model: count for model, count in self.outstanding.items() if count},
+            "requests_total": self.requests_total,
+            "failures_total": self.failures_total,
+            "slow_starts_total": self.slow_starts_total,
+            "health_check_seconds": self.health_check_seconds,
+            "models": sorted(self.models),
+        }
+
+
+class OllamaPool:
+    """Routes Ollama calls over several backends.
+
+    Each request goes to the backend with the fewest in-flight requests for
+    its model, except that a session stays on the backend it used last so
+    Ollama can reuse that session's cached prompt prefix. Backends are
+    health-checked in the background and ejected after repeated failures.
+    A backend that refuses the connection, answers with a server error or
+    sends no first chunk in time is skipped and the request is retried on
+    the next one, as long as nothing has been streamed to the caller yet.
+    Only the first two count towards ejection; a slow first chunk is
+    counted separately, since a busy backend is still a working one.
+
+    The pool offers the same calls as :class:`OllamaClient`, so a single
+    backend is just a pool of one.
+    """
+
+    def __init__(self, urls: Iterable[str], transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.backends = [Backend(url, transport) for url in urls]
+        if not self.backends:
+            raise ValueError("At least one Ollama backend is required")
+        self._sticky: "OrderedDict[str, Backend]" = OrderedDict()
+        self._next = 0
+        self._task: Optional[asyncio.Task] = None
+        self.failovers_total = 0
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    async def start(self):
+        await self.check_health()
+        self._task = asyncio.create_task(self._health_loop())
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*(backend.client.aclose() for backend in self.backends))
+
+    async def check_health(self) -> List[Optional[httpx.Response]]:
+        """Fetch ``/api/tags`` from every backend, updating health and model lists."""
+        return await asyncio.gather(*(self._check(backend) for backend in self.backends))
+
+    async def _check(self, backend: Backend) -> Optional[httpx.Response]:
+        start_time = time.perf_counter()
+        try:
+            response = await backend.client.tags(timeout=OLLAMA_HEALTH_TIMEOUT)
+            if response.status_code != 200:
+                raise RuntimeError(f"status {response.status_code}")
+            backend.models = {_normalize(model.get("name", "")) for model in response.json().get("models", [])}
+            backend.checked = True
+            backend.record_success()
+            return response
+        except Exception as check_error:
+            backend.record_failure(check_error)
+            return None
+        finally:
+            backend.health_check_seconds = time.perf_counter() - start_time
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(OLLAMA_HEALTH_INTERVAL)
+            await self.check_health()
+
+    def pick(self, model_name: str, session_id: Optional[str] = None,
+             exclude: Iterable[Backend] = ()) -> Optional[Backend]:
+        """Choose a backend for ``model_name``, or None if all were tried."""
+        remaining = [backend for backend in self.backends if backend not in exclude]
+        # With every backend ejected, trying one beats failing outright
+        candidates = [backend for backend in remaining if not backend.ejected] or remaining
+        candidates = [backend for backend in candidates if backend.has_model(model_name)] or candidates
+        if not candidates:
+            return None
+        # Rotate the starting point so ties are spread across backends
+        self._next = (self._next + 1) % len(candidates)
+        rotated = candidates[self._next:] + candidates[:self._next]
+        chosen = min(rotated, key=lambda backend: (backend.outstanding[model_name], backend.outstanding_total))
+        if session_id is not None:
+            sticky = self._sticky.get(session_id)
+            if sticky in candidates and (
+                    sticky.outstanding[model_name] <= chosen.outstanding[model_name] + OLLAMA_STICKY_SLACK):
+                chosen = sticky
+            self._sticky[session_id] = chosen
+            self._sticky.move_to_end(session_id)
+            if len(self._sticky) > OLLAMA_STICKY_SESSIONS:
+                self._sticky.popitem(last=False)
+        return chosen
+
+    async def stream(self, payload: dict, timeout: float = 120,
+                     session_id: Optional[str] = None) -> AsyncIterator[dict]:
+        """Stream a generation, failing over until the first chunk arrives.
+
+        Raises the last backend's error once every backend has failed.
+        """
+        model_name = payload["model"]
+        tried: List[Backend] = []
+        while True:
+            backend = self.pick(model_name, session_id, exclude=tried)
+            tried.append(backend)
+            has_alternative = len(tried) < len(self.backends)
+            chunks = backend.client.stream(payload, timeout=timeout).__aiter__()
+            backend.begin(model_name)
+            streamed = False
+            try:
+                # Only bound the first chunk when there is somewhere else to go
+                first_chunk_timeout = OLLAMA_FIRST_TOKEN_TIMEOUT if has_alternative else None
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), first_chunk_timeout)
+                except asyncio.TimeoutError:
+                    raise FirstTokenTimeout(f"No response within {first_chunk_timeout} seconds")
+                streamed = True
+                yield chunk
+                async for chunk in chunks:
+                    yield chunk
+                backend.record_success()
+                return
+            except StopAsyncIteration:
+                backend.record_success()
+                return
+            except (httpx.TransportError, httpx.HTTPStatusError) as backend_error:
+                is_client_error = (isinstance(backend_error, httpx.HTTPStatusError)
+                                   and backend_error.response.status_code < 500)
+                if isinstance(backend_error, FirstTokenTimeout):
+                    backend.record_slow_start()
+                elif not is_client_error:
+                    backend.record_failure(backend_error)
+                if streamed or is_client_error or not has_alternative:
+                    raise
+                self.failovers_total += 1
+                ERRORS.inc("backend_failover")
+                logging.warning(f"Ollama backend {backend.url} failed, retrying on another backend: {backend_error}")
+            finally:
+                backend.end(model_name)
+                await chunks.aclose()
+
+    async def complete(self, payload: dict, timeout: float = 120,
+                       session_id: Optional[str] = None) -> httpx.Response:
+        """Non-streaming call, served from :meth:`stream` so it can fail over.
+
+        The chunks are joined into the body Ollama returns for
+        ``stream: false``; error responses are returned as they are.
+        """
+        chunks = self.stream(payload, timeout=timeout, session_id=session_id)
+        parts = []
+        final: dict = {}
+        try:
+            async for chunk in chunks:
+                parts.append(response_text(chunk))
+                if chunk.get("done"):
+                    final = chunk
+        except httpx.HTTPStatusError as status_error:
+            return status_error.response
+        finally:
+            await chunks.aclose()
+        if "message" in final:
+            final["message"] = dict(final["message"], content="".join(parts))
+        else:
+            final["response"] = "".join(parts)
+        return httpx.Response(200, json=final)
+
+    async def version(self, timeout: float = 5) -> httpx.Response:
+        last_error: Exception = RuntimeError("No Ollama backend configured")
+        for backend in sorted(self.backends, key=lambda backend: backend.ejected):
+            try:
+                return await backend.client.version(timeout=timeout)
+            except httpx.HTTPError as version_error:
+                last_error = version_error
+        raise last_error
+
+    async def tags(self, timeout: float = 10) -> httpx.Response:
+        """Models served by any healthy backend, as one ``/api/tags`` response."""
+        responses = [response for response in await self.check_health() if response is not None]
+        if not responses:
+            raise RuntimeError("No Ollama backend is reachable")
+        models = {}
+        for response in responses:
+            for model in response.json().get("models", []):
+                models.setdefault(model.get("name"), model)
+        return httpx.Response(200, json={"models": list(models.values())})
+
+    async def pull(self, model_name: str, timeout: float = 300) -> httpx.Response:
+        """Pull ``model_name`` on every reachable backend; returns the first failure if any."""
+        backends = [backend for backend in self.backends if not backend.ejected] or self.backends
+        results = await asyncio.gather(
+            *(backend.client.pull(model_name, timeout=timeout) for backend in backends),
+            return_exceptions=True,
+        )
+        responses = [result for result in results if isinstance(result, httpx.Response)]
+        if not responses:
+            raise results[0]
+        return next((response for response in responses if response.status_code != 200), responses[0])
+
+    def stats(self) -> dict:
+        return {
+            "backends": {backend.url: backend.stats() for backend in self.backends},
+            "sticky_sessions": len(self._sticky),
+            "failovers_total": self.failovers_total,
+        }
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from context import Turn, format_turn
+from coordination import Coordinator
+from db import Database, insert_turns
+from history_cache import HistoryCache
+from logging_utils import request_id_var
+from metrics import ERRORS, STAGE_SECONDS
+
+# Turns written per multi-row INSERT
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", "100"))
+# Turns held in memory waiting for the database; beyond this they are spilled
+PERSIST_QUEUE_MAX = int(os.environ.get("PERSIST_QUEUE_MAX", "10000"))
+# Attempts per batch before it is spilled to disk
+PERSIST_MAX_RETRIES = int(os.environ.get("PERSIST_MAX_RETRIES", "5"))
+# First retry delay in seconds, doubled on every attempt
+PERSIST_RETRY_BACKOFF = float(os.environ.get("PERSIST_RETRY_BACKOFF", "0.5"))
+# Append-only file holding turns that could not be written to Postgres
+PERSIST_SPILL_PATH = os.environ.get("PERSIST_SPILL_PATH", "pending_turns.jsonl")
+# Seconds between attempts to replay the spill file
+PERSIST_REPLAY_INTERVAL = float(os.environ.get("PERSIST_REPLAY_INTERVAL", "30"))
+
+
+class PendingTurn:
+    __slots__ = ("session_id", "user_input", "model_response", "created_at", "row_id", "request_id")
+
+    def __init__(self, session_id: str, user_input: str, model_response: str, created_at: str):
+        self.session_id = session_id
+        self.user_input = user_input
+        self.model_response = model_response
+        self.created_at = created_at
+        self.row_id: Optional[int] = None
+        # Batches are written outside the request, so keep its id for the logs
+        self.request_id = request_id_var.get()
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "session_id": self.session_id,
+            "user_input": self.user_input,
+            "model_response": self.model_response,
+            "created_at": self.created_at,
+        })
+
+    @classmethod
+    def from_json(cls, line: str) -> "PendingTurn":
+        data = json.loads(line)
+        return cls(data["session_id"], data["user_input"], data["model_response"], data["created_at"])
+
+
+def _utcnow() -> str:
+    # conversation_history.timestamp is a naive UTC timestamp
+    return datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class TurnWriter:
+    """Write-behind queue for conversation turns.
+
+    ``submit`` returns immediately; a background task group-commits
+    everything queued since the previous batch with one multi-row INSERT.
+    Failed batches are retried with exponential backoff and then appended
+    to a local spill file, which a second task replays every
+    ``PERSIST_REPLAY_INTERVAL`` once Postgres is reachable again. Turns
+    waiting for the database, spilled ones included, are returned by
+    :meth:`pending_turns` so the next prompt never misses them.
+    """
+
+    def __init__(self, db: Database, cache: HistoryCache, batch_size: int = PERSIST_BATCH_SIZE,
+                 max_queue: int = PERSIST_QUEUE_MAX, spill_path: str = PERSIST_SPILL_PATH,
+                 coordinator: Optional[Coordinator] = None):
+        self.db = db
+        self.cache = cache
+        self.coordinator = coordinator
+        self.batch_size = batch_size
+        self.spill_path = spill_path
+        self._queue: "asyncio.Queue[Optional[PendingTurn]]" = asyncio.Queue(maxsize=max_queue)
+        self._pending: Dict[str, List[PendingTurn]] = defaultdict(list)
+        # Turns this worker spilled, by their spill file line, until they are replayed
+        self._spilled: Dict[str, PendingTurn] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._replay_task: Optional[asyncio.Task] = None
+        self._stopped = asyncio.Event()
+        self._closing = False
+        self.written_total = 0
+        self.batches_total = 0
+        self.failed_batches_total = 0
+        self.spilled_total = 0
+        self.replayed_total = 0
+
+    async def start(self):
+        await self.replay_spill()
+        self._task = asyncio.create_task(self._run())
+        self._replay_task = asyncio.create_task(self._replay_periodically())
+
+    async def stop(self):
+        """Flush everything still queued, spilling what cannot be written."""
+        self._closing = True
+        self._stopped.set()
+        if self._replay_task is not None:
+            # Lets a replay in progress finish, so its turns are not inserted twice
+            await self._replay_task
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+
+    def submit(self, session_id: str, user_input: str, model_response: str):
+        turn = PendingTurn(session_id, user_input, model_response, _utcnow())
+        self._pending[session_id].append(turn)
+        try:
+            self._queue.put_nowait(turn)
+        except asyncio.QueueFull:
+            logging.warning("Persistence queue full, spilling turn to disk")
+            self._spill_pending([turn])
+
+    def pending_turns(self, session_id: str, stored_through: Optional[int] = None) -> List[Turn]:
+        """Turns of ``session_id`` still waiting to be written.
+
+        ``stored_through`` is the newest row id the caller already has from
+        the database or cache; turns committed at or below it are skipped so
+        they are not counted twice.
+        """
+        pending = self._pending.get(session_id)
+        if not pending:
+            return []
+        return [format_turn(turn.user_input, turn.model_response) for turn in pending
+                if turn.row_id is None or stored_through is None or turn.row_id > stored_through]
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            batch = [first] if first is not None else []
+            # Group commit: take whatever queued up while the last batch was written
+            while len(batch) < self.batch_size and not self._queue.empty():
+                turn = self._queue.get_nowait()
+                if turn is None:
+                    break
+                batch.append(turn)
+            if batch:
+                await self._write(batch)
+            if self._closing and self._queue.empty():
+                return
+
+    async def _replay_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopped.wait(), PERSIST_REPLAY_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if os.path.exists(self.spill_path) or os.path.exists(self.spill_path + ".replay"):
+                await self.replay_spill()
+            elif self._spilled:
+                # Another worker sharing the spill file replayed them
+                self._forget(list(self._spilled.values()))
+                self._spilled.clear()
+
+    async def _write(self, batch: List[PendingTurn]):
+        attempts = 1 if self._closing else PERSIST_MAX_RETRIES
+        for attempt in range(attempts):
+            try:
+                with STAGE_SECONDS.time("db_write"):
+                    results = await self.db.run(insert_turns, [_row(turn) for turn in batch], _assign_ids(batch))
+                break
+            except Exception as db_error:
+                self.failed_batches_total += 1
+                ERRORS.inc("db_write")
+                logging.error(
+                    "Failed to write %d turns (attempt %d/%d): %s", len(batch), attempt + 1, attempts, db_error,
+                    extra={"request_ids": [turn.request_id for turn in batch]}
+                )
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(min(PERSIST_RETRY_BACKOFF * 2 ** attempt, 30))
+        else:
+            self._spill_pending(batch)
+            return
+
+        self.batches_total += 1
+        self.written_total += len(batch)
+        for turn, (row_id, previous_id) in zip(batch, results):
+            # Write through so the next turn is served from the cache
+            self.cache.append(turn.session_id, format_turn(turn.user_input, turn.model_response),
+                              row_id, previous_id)
+        self._forget(batch)
+
+    def _forget(self, batch: List[PendingTurn]):
+        for turn in batch:
+            pending = self._pending.get(turn.session_id)
+            if pending is not None:
+                pending.remove(turn)
+                if not pending:
+                    del self._pending[turn.session_id]
+
+    def _spill_pending(self, turns: List[PendingTurn]):
+        """Spill turns that are still pending; they stay pending until replayed."""
+        if self._spill(turns):
+            for turn in turns:
+                self._spilled[turn.to_json()] = turn
+        else:
+            # Lost with the spill file, so later prompts cannot count on them either
+            self._forget(turns)
+
+    def _spill(self, turns: List[PendingTurn], count: bool = True) -> bool:
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+                for turn in turns:
+                    spill_file.write(turn.to_json() + "\n")
+        except OSError as spill_error:
+            ERRORS.inc("spill")
+            logging.error(f"Could not spill {len(turns)} turns to {self.spill_path}: {spill_error}")
+            return False
+        if count:
+            self.spilled_total += len(turns)
+        logging.warning(f"Spilled {len(turns)} turns to {self.spill_path}")
+        return True
+
+    async def replay_spill(self):
+        """Insert spilled turns into Postgres, keeping whatever still fails."""
+        if self.coordinator is None:
+            await self._replay_spill()
+            return
+        # Workers share the spill file; only one may replay it at a time
+        async with self.coordinator.lock(f"replay:{os.path.abspath(self.spill_path)}") as acquired:
+            if acquired:
+                await self._replay_spill()
+
+    async def _replay_spill(self):
+        replay_path = self.spill_path + ".replay"
+        try:
+            if not os.path.exists(replay_path):
+                os.replace(self.spill_path, replay_path)
+            with open(replay_path, encoding="utf-8") as replay_file:
+                turns = [PendingTurn.from_json(line) for line in replay_file if line.strip()]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as replay_error:
+            logging.error(f"Could not read spill file {replay_path}: {replay_error}")
+            return
+
+        done = 0
+        try:
+            for start in range(0, len(turns), self.batch_size):
+                batch = turns[start:start + self.batch_size]
+                # This worker's own spilled turns get their row ids, as in _write
+                spilled = [self._spilled.pop(turn.to_json(), None) for turn in batch]
+                try:
+                    await self.db.run(insert_turns, [_row(turn) for turn in batch],
+                                      _assign_ids([own or turn for own, turn in zip(spilled, batch)]))
+                except Exception:
+                    for own in spilled:
+                        if own is not None:
+                            self._spilled[own.to_json()] = own
+                    raise
+                self._forget([own for own in spilled if own is not None])
+                done += len(batch)
+        except Exception as db_error:
+            logging.error(f"Replayed {done} of {len(turns)} spilled turns, keeping the rest: {db_error}")
+            if not self._spill(turns[done:], count=False):
+                # Keep the replay file so nothing is lost; it is retried next time
+                return
+        os.remove(replay_path)
+        if done:
+            self.replayed_total += done
+            logging.info(f"Replayed {done} spilled turns into the database")
+            # Replayed rows are older than cached ones, so id checks cannot catch them
+            for session_id in {turn.session_id for turn in turns[:done]}:
+                self.cache.invalidate(session_id)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written_total": self.written_total,
+            "batches_total": self.batches_total,
+            "failed_batches_total": self.failed_batches_total,
+            "spilled_total": self.spilled_total,
+            "replayed_total": self.replayed_total,
+            "spill_file": os.path.exists(self.spill_path),
+        }
+
+
+def _row(turn: PendingTurn):
+    return (turn.session_id, turn.user_input, turn.model_response, turn.created_at)
+
+
+def _assign_ids(batch: List[PendingTurn]):
+    # Row ids are set before commit, so a reader that sees a committed row
+    # can also tell it apart from the pending copy
+    def on_inserted(results):
+        for turn, (row_id, _) in zip(batch, results):
+            turn.row_id = row_id
+    return on_inserted
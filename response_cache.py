@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from db import Database, fetch_cached_response, store_cached_response
+
+# The response cache is off unless enabled
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "0") == "1"
+# Also cache sampled (temperature > 0) generations, trading variety for speed
+RESPONSE_CACHE_ALLOW_SAMPLING = os.environ.get("RESPONSE_CACHE_ALLOW_SAMPLING", "0") == "1"
+# Share cached responses through the response_cache table
+RESPONSE_CACHE_POSTGRES = os.environ.get("RESPONSE_CACHE_POSTGRES", "0") == "1"
+# Upper bound on the response text held in memory
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Seconds a cached response stays valid
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+
+# Ollama's default temperature when a request sets none
+_DEFAULT_TEMPERATURE = 0.8
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+class _Entry(NamedTuple):
+    response: str
+    expires_at: float
+
+
+class ResponseCache:
+    """Cache of model responses for identical prompts.
+
+    Keys hash the model, the generation options and the whitespace-normalized
+    prompt (history included), so a hit is only possible when the model
+    would see exactly the same input. Entries live in an in-memory LRU
+    bounded by bytes and optionally in Postgres, shared by all workers.
+    """
+
+    def __init__(self, db: Optional[Database] = None, enabled: bool = RESPONSE_CACHE_ENABLED,
+                 allow_sampling: bool = RESPONSE_CACHE_ALLOW_SAMPLING,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, ttl: float = RESPONSE_CACHE_TTL):
+        self.db = db if RESPONSE_CACHE_POSTGRES else None
+        self.enabled = enabled
+        self.allow_sampling = allow_sampling
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def key(self, payload: dict) -> Optional[str]:
+        """Cache key for an Ollama request body, or None if it must not be cached."""
+        if not self.enabled:
+            return None
+        options = payload.get("options") or {}
+        if options.get("temperature", _DEFAULT_TEMPERATURE) > 0 and not self.allow_sampling:
+            self.bypassed += 1
+            return None
+        if "messages" in payload:
+            prompt = [[message["role"], _normalize(message["content"])] for message in payload["messages"]]
+        else:
+            prompt = _normalize(payload.get("prompt", ""))
+        material = json.dumps(
+            {"model": payload["model"], "options": options, "prompt": prompt},
+            sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    async def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at >= time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.response
+        if entry is not None:
+            self._remove(key)
+        if self.db is not None:
+            try:
+                response = await self.db.run(fetch_cached_response, key, self.ttl)
+            except Exception as db_error:
+                logging.error(f"Error reading response cache: {db_error}")
+                response = None
+            if response is not None:
+                self._store(key, response)
+                self.hits += 1
+                return response
+        self.misses += 1
+        return None
+
+    async def put(self, key: Optional[str], model_name: str, response: str):
+        if key is None or not response:
+            return
+        self._store(key, response)
+        if self.db is not None:
+            try:
+                await self.db.run(store_cached_response, key, model_name, response)
+            except Exception as db_error:
+                logging.error(f"Error writing response cache: {db_error}")
+
+    def _store(self, key: str, response: str):
+        if key in self._entries:
+            self._remove(key)
+        if len(response) > self.max_bytes:
+            return
+        self._entries[key] = _Entry(response, time.monotonic() + self.ttl)
+        self._bytes += len(response)
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.response)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,366 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+
+from coordination import Coordinator
+from metrics import STAGE_SECONDS
+
+# Generations run concurrently per model and Ollama backend, counted across all
+# workers through the coordinator; Ollama itself serves OLLAMA_NUM_PARALLEL
+MODEL_MAX_CONCURRENCY = int(os.environ.get("MODEL_MAX_CONCURRENCY", "2"))
+# Requests allowed to wait per model in one worker before new ones are rejected with 429
+SCHEDULER_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", "32"))
+# Queued requests allowed per session, so one session cannot fill the queue
+SCHEDULER_MAX_QUEUE_PER_SESSION = int(os.environ.get("SCHEDULER_MAX_QUEUE_PER_SESSION", "4"))
+# Seconds between attempts to take a generation slot while other workers hold them all
+SCHEDULER_SLOT_POLL_INTERVAL = float(os.environ.get("SCHEDULER_SLOT_POLL_INTERVAL", "0.1"))
+
+# Consecutive failures that open a model's circuit breaker
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "3"))
+# Seconds an open breaker waits before letting a probe request through
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Generations started per second per model across all workers; 0 disables the limit
+MODEL_RATE_LIMIT = float(os.environ.get("MODEL_RATE_LIMIT", "0"))
+# Generations that may start at once after an idle period
+MODEL_RATE_BURST = float(os.environ.get("MODEL_RATE_BURST", "10"))
+
+# Chat requests per second per session, enforced in each worker process, so a
+# session spread over the workers gets up to WEB_CONCURRENCY times this; 0 disables the limit
+SESSION_RATE_LIMIT = float(os.environ.get("SESSION_RATE_LIMIT", "0.5"))
+# Requests a session may send at once after an idle period
+SESSION_RATE_BURST = float(os.environ.get("SESSION_RATE_BURST", "5"))
+# Chat requests per second per client IP, enforced in each worker like the session limit; 0 disables the limit
+CLIENT_RATE_LIMIT = float(os.environ.get("CLIENT_RATE_LIMIT", "2"))
+# Requests a client IP may send at once after an idle period
+CLIENT_RATE_BURST = float(os.environ.get("CLIENT_RATE_BURST", "20"))
+# Buckets kept per limiter; the least recently used are dropped first
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class Overloaded(Exception):
+    """Base for rejections answered with 429; ``retry_after`` is in seconds."""
+    reason = "overloaded"
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFull(Overloaded):
+    """Raised when a model's queue is full."""
+    reason = "queue_full"
+
+    def __init__(self, model_name: str, retry_after: int):
+        super().__init__(f"Too many queued requests for model {model_name}", retry_after)
+        self.model_name = model_name
+
+
+class RateLimited(Overloaded):
+    """Raised when a shared rate limit has no tokens left."""
+    reason = "rate_limited"
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimiter:
+    """In-process token buckets keyed by session, client address or similar.
+
+    Buckets are kept in least-recently-used order. A bucket idle long enough
+    to refill completely is the same as a new one, so those are dropped from
+    the old end on every call, which keeps memory proportional to the
+    recently active keys.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.allowed_total = 0
+        self.rejected_total = 0
+
+    def take(self, key: str):
+        """Take a token for ``key``; raises :class:`RateLimited` when none is left."""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+            bucket.updated_at = now
+            self._buckets.move_to_end(key)
+        self._expire(now)
+        if bucket.tokens < 1:
+            self.rejected_total += 1
+            raise RateLimited(f"Too many requests for this {self.name}",
+                              max(1, math.ceil((1 - bucket.tokens) / self.rate)))
+        bucket.tokens -= 1
+        self.allowed_total += 1
+
+    def _expire(self, now: float):
+        refill_seconds = self.burst / self.rate
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+            if len(self._buckets) <= self.max_keys and now - bucket.updated_at < refill_seconds:
+                break
+            self._buckets.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "keys": len(self._buckets),
+            "allowed_total": self.allowed_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+class ModelQueue:
+    """Concurrency limit for one model with a fair per-session wait queue.
+
+    When a slot frees up, waiting sessions are served round-robin, so a
+    session with many queued requests cannot starve the others.
+    """
+
+    def __init__(self, model_name: str, max_concurrency: int = MODEL_MAX_CONCURRENCY,
+                 max_queue: int = SCHEDULER_MAX_QUEUE,
+                 max_queue_per_session: int = SCHEDULER_MAX_QUEUE_PER_SESSION):
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self.active = 0
+        self.queued = 0
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._service_seconds = 0.0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def retry_after(self) -> int:
+        """Rough seconds until a queued request would be served."""
+        service = self._service_seconds or 10.0
+        return max(1, math.ceil(service * (self.queued + 1) / self.max_concurrency))
+
+    def check_capacity(self, session_id: str):
+        """Raise :class:`QueueFull` if a new request would be rejected."""
+        if self.active < self.max_concurrency and not self.queued:
+            return
+        session_waiters = self._waiters.get(session_id)
+        if self.queued >= self.max_queue or (
+                session_waiters and len(session_waiters) >= self.max_queue_per_session):
+            self.rejected_total += 1
+            raise QueueFull(self.model_name, self.retry_after())
+
+    async def acquire(self, session_id: str):
+        self.check_capacity(session_id)
+        start_time = time.perf_counter()
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(session_id, deque()).append(future)
+            self.queued += 1
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was granted just as the waiter was cancelled
+                    self.release()
+                else:
+                    self._discard(session_id, future)
+                raise
+        waited = time.perf_counter() - start_time
+        self.admitted_total += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return waited
+
+    def release(self, service_seconds: float = 0.0):
+        self.active -= 1
+        if service_seconds:
+            # Exponential moving average for Retry-After estimates
+            self._service_seconds = service_seconds if not self._service_seconds else (
+                0.8 * self._service_seconds + 0.2 * service_seconds)
+        self._wake_next()
+
+    def _discard(self, session_id: str, future: asyncio.Future):
+        session_waiters = self._waiters.get(session_id)
+        if session_waiters and future in session_waiters:
+            session_waiters.remove(future)
+            self.queued -= 1
+            if not session_waiters:
+                del self._waiters[session_id]
+
+    def _wake_next(self):
+        while self.active < self.max_concurrency and self._waiters:
+            session_id, session_waiters = next(iter(self._waiters.items()))
+            future = session_waiters.popleft()
+            self.queued -= 1
+            # Rotate so the next slot goes to a different session
+            if session_waiters:
+                self._waiters.move_to_end(session_id)
+            else:
+                del self._waiters[session_id]
+            if future.cancelled():
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queued,
+            "queued_sessions": len(self._waiters),
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "wait_seconds_avg": self.wait_seconds_total / self.admitted_total if self.admitted_total else 0.0,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+class CircuitBreaker:
+    """Classic closed/open/half-open breaker for one model.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    callers should route to the fallback model. Once ``reset_timeout`` has
+    passed a single probe request is let through; its outcome closes or
+    re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = "closed"
+        self._probe_started: Optional[float] = None
+
+    def allow_request(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self._probe_started = None
+        # A probe that never reported back (e.g. cancelled) is replaced after a while
+        if self.state == "half_open" and (
+                self._probe_started is None or now - self._probe_started >= self.reset_timeout):
+            self._probe_started = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.state = "closed"
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class Scheduler:
+    """Admission control and circuit breakers for every model.
+
+    With a ``coordinator``, ``max_concurrency`` is a cluster-wide limit:
+    a request that gets one of its worker's slots also takes one of the
+    model's numbered slots shared by all workers, waiting while other
+    workers hold them all. Any worker can use every slot, so none sits
+    idle on a worker that has no work.
+    """
+
+    def __init__(self, max_concurrency: int = MODEL_MAX_CONCURRENCY, max_queue: int = SCHEDULER_MAX_QUEUE,
+                 coordinator: Optional[Coordinator] = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.coordinator = coordinator
+        self._queues: Dict[str, ModelQueue] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._shared_waiting: Dict[str, int] = {}
+
+    def queue(self, model_name: str) -> ModelQueue:
+        if model_name not in self._queues:
+            self._queues[model_name] = ModelQueue(model_name, self.max_concurrency, self.max_queue)
+        return self._queues[model_name]
+
+    def breaker(self, model_name: str) -> CircuitBreaker:
+        if model_name not in self._breakers:
+            self._breakers[model_name] = CircuitBreaker()
+        return self._breakers[model_name]
+
+    @asynccontextmanager
+    async def slot(self, model_name: str, session_id: str):
+        """Hold a generation slot for ``model_name``; yields the queue wait in seconds."""
+        model_queue = self.queue(model_name)
+        start_time = time.perf_counter()
+        await model_queue.acquire(session_id)
+        service_seconds = 0.0
+        try:
+            shared_slot = await self._acquire_shared(model_name)
+            try:
+                waited = time.perf_counter() - start_time
+                STAGE_SECONDS.observe(waited, "queue_wait")
+                start_time = time.perf_counter()
+                try:
+                    yield waited
+                finally:
+                    service_seconds = time.perf_counter() - start_time
+            finally:
+                if shared_slot is not None:
+                    await self.coordinator.release_slot(f"generation:{model_name}", shared_slot)
+        finally:
+            model_queue.release(service_seconds)
+
+    async def _acquire_shared(self, model_name: str) -> Optional[int]:
+        """Take one of the model's cluster-wide slots, waiting until one is free."""
+        if self.coordinator is None:
+            return None
+        name = f"generation:{model_name}"
+        self._shared_waiting[model_name] = self._shared_waiting.get(model_name, 0) + 1
+        try:
+            while True:
+                attempt = asyncio.ensure_future(self.coordinator.try_slot(name, self.max_concurrency))
+                try:
+                    number = await asyncio.shield(attempt)
+                except asyncio.CancelledError:
+                    # The lock may still be taken after the caller gave up
+                    attempt.add_done_callback(lambda done: self._release_abandoned(name, done))
+                    raise
+                if number is not None:
+                    return number
+                await asyncio.sleep(SCHEDULER_SLOT_POLL_INTERVAL)
+        finally:
+            self._shared_waiting[model_name] -= 1
+
+    def _release_abandoned(self, name: str, attempt: asyncio.Future):
+        if not attempt.cancelled() and attempt.exception() is None and attempt.result() is not None:
+            asyncio.ensure_future(self.coordinator.release_slot(name, attempt.result()))
+
+    def stats(self) -> dict:
+        return {
+            model_name: dict(
+                self.queue(model_name).stats(),
+                shared_slot_waiting=self._shared_waiting.get(model_name, 0),
+                circuit=self.breaker(model_name).state,
+            )
+            for model_name in sorted(set(self._queues) | set(self._breakers))
+        }
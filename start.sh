@@ -2,23 +2,14 @@
 
 # No need to start Ollama service as it runs in its own container
 
-# Wait for PostgreSQL to be ready
-until pg_isready -h postgres -U vit --dbname=vit; do
-  echo "Waiting for PostgreSQL to start..."
-  sleep 5
-done
+# PostgreSQL and Ollama may still be starting: the app applies the schema and
+# loads the models in the background and reports readiness at /readyz
 
-# Wait for Ollama to be ready
-until curl -s http://ollama:11434/api/version > /dev/null; do
-  echo "Waiting for Ollama to start..."
-  sleep 5
-done
-
-# Wait for Ollama to be ready
-until curl -s http://ollama:11434/api/version > /dev/null; do
-  echo "Waiting for Ollama to start..."
-  sleep 5
-done
+# Two worker processes unless WEB_CONCURRENCY is set: generation is bound by the
+# GPU, not the cores, and the generation slots and database connections are
+# split between the workers. Every worker runs the app's startup once and shares
+# locks and rate limits via PostgreSQL
+export WEB_CONCURRENCY="${WEB_CONCURRENCY:-2}"
 
 # Run the application
-exec uvicorn app:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+exec uvicorn app:app --host 0.0.0.0 --port 8000 --workers "$WEB_CONCURRENCY"
\ No newline at end of file
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, Optional
+
+from db import Database
+from migrations import run_migrations
+from model_registry import PRIMARY_MODEL, ModelRegistry
+from ollama_pool import OllamaPool
+
+# Seconds between retries of a startup step whose dependency is not up yet
+STARTUP_RETRY_INTERVAL = float(os.environ.get("STARTUP_RETRY_INTERVAL", "2"))
+# Longest wait between pulls of a model that keeps failing; the wait doubles
+# from STARTUP_RETRY_INTERVAL after every failed pull
+STARTUP_PULL_MAX_BACKOFF = float(os.environ.get("STARTUP_PULL_MAX_BACKOFF", "300"))
+# Load the configured models into Ollama's memory before reporting ready
+STARTUP_WARM_MODELS = os.environ.get("STARTUP_WARM_MODELS", "1") != "0"
+# Timeout for one warm-up generation, which includes loading the model
+STARTUP_WARMUP_TIMEOUT = float(os.environ.get("STARTUP_WARMUP_TIMEOUT", "300"))
+
+
+class Startup:
+    """Background startup phase that decides when the app is ready.
+
+    The server answers liveness checks as soon as it runs, while this
+    phase waits for PostgreSQL and creates or migrates the schema, waits
+    for Ollama, pulls missing models and loads each model on every backend
+    that serves it with a one-token generation. The primary model is
+    loaded last, so a GPU that cannot hold every model keeps the primary
+    one and the fallback is reloaded on demand. The app is ready once the
+    schema is current and the primary model is loaded, so the first
+    request does not pay for a pull or a model load. A pull that fails is
+    retried with exponential backoff, and its error is reported with the
+    model's state.
+    """
+
+    def __init__(self, db: Database, ollama: OllamaPool, models: ModelRegistry,
+                 warmup_payload: Callable[[str], dict]):
+        self.db = db
+        self.ollama = ollama
+        self.models = models
+        self.warmup_payload = warmup_payload
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self.steps: Dict[str, str] = {"schema": "pending", "models": "pending"}
+        self.model_states: Dict[str, str] = {model_name: "pending" for model_name in models.models}
+        self.model_errors: Dict[str, str] = {}
+        self._pull_failures: Dict[str, int] = {}
+        self._next_pull: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        await asyncio.gather(self._prepare_schema(), self._prepare_models())
+        self.ready_at = time.time()
+        logging.info(f"Ready to serve after {self.ready_at - self.started_at:.1f} seconds")
+
+    async def _prepare_schema(self):
+        self.steps["schema"] = "running"
+        while not await run_migrations(self.db):
+            await asyncio.sleep(STARTUP_RETRY_INTERVAL)
+        self.steps["schema"] = "done"
+
+    async def _prepare_models(self):
+        self.steps["models"] = "running"
+        while True:
+            if not self.models.reachable:
+                await self.models.refresh()
+            if self.models.reachable:
+                # Loading a model may unload another, so the one that must stay loaded goes last
+                for model_name in sorted(self.models.models, key=lambda model_name: model_name == PRIMARY_MODEL):
+                    await self._prepare_model(model_name)
+                if not STARTUP_WARM_MODELS or self.model_states.get(PRIMARY_MODEL) == "warm":
+                    break
+            await asyncio.sleep(STARTUP_RETRY_INTERVAL)
+        self.steps["models"] = "done"
+
+    async def _prepare_model(self, model_name: str):
+        if self.model_states[model_name] == "warm":
+            return
+        if not self.models.is_available(model_name):
+            if time.monotonic() < self._next_pull.get(model_name, 0.0):
+                return
+            self.model_states[model_name] = "pulling"
+            await self.models.ensure_pulled(model_name)
+            if not self.models.is_available(model_name):
+                self._pull_failed(model_name)
+                return
+            self._pull_failures.pop(model_name, None)
+            self.model_errors.pop(model_name, None)
+        if not STARTUP_WARM_MODELS:
+            self.model_states[model_name] = "available"
+            return
+        self.model_states[model_name] = "loading"
+        backends = [backend for backend in self.ollama.backends
+                    if not backend.ejected and backend.has_model(model_name)]
+        start_time = time.perf_counter()
+        results = await asyncio.gather(
+            *(backend.client.complete(self.warmup_payload(model_name), timeout=STARTUP_WARMUP_TIMEOUT)
+              for backend in backends),
+            return_exceptions=True
+        )
+        failures = []
+        for backend, result in zip(backends, results):
+            if isinstance(result, Exception):
+                failures.append(f"{backend.url}: {result}")
+            elif result.status_code != 200:
+                failures.append(f"{backend.url}: status {result.status_code}")
+        if failures or not backends:
+            self.model_states[model_name] = "failed"
+            logging.warning(f"Could not load model {model_name}: {failures or 'no healthy backend'}")
+            return
+        self.model_states[model_name] = "warm"
+        logging.info(f"Loaded model {model_name} on {len(backends)} backend(s) "
+                     f"in {time.perf_counter() - start_time:.1f} seconds")
+
+    def _pull_failed(self, model_name: str):
+        failures = self._pull_failures[model_name] = self._pull_failures.get(model_name, 0) + 1
+        delay = min(STARTUP_RETRY_INTERVAL * 2 ** (failures - 1), STARTUP_PULL_MAX_BACKOFF)
+        self._next_pull[model_name] = time.monotonic() + delay
+        error = self.models.pull_errors.get(model_name)
+        self.model_states[model_name] = "pull_failed" if error else "unavailable"
+        self.model_errors[model_name] = (
+            f"{error or 'not available after pull'}; attempt {failures}, retrying in {delay:.0f} seconds"
+        )
+        logging.warning(f"Model {model_name} is not available: {self.model_errors[model_name]}")
+
+    def snapshot(self) -> dict:
+        return {
+            "ready": self.ready,
+            "seconds": (self.ready_at or time.time()) - self.started_at,
+            "steps": dict(self.steps),
+            "models": dict(self.model_states),
+            "model_errors": dict(self.model_errors),
+        }
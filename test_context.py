@@ -0,0 +1,52 @@
+from context import (
+    CONTEXT_RESPONSE_RESERVE, Turn, build_messages, estimate_tokens, format_summary, is_trim_point,
+    select_history_window
+)
+
+
+def turns(count: int, tokens: int = 10):
+    return [Turn(f"question {index}", f"answer {index}", tokens) for index in range(count)]
+
+
+def test_whole_history_is_kept_when_it_fits():
+    history = turns(5)
+    assert select_history_window(history, 50) == history
+
+
+def test_window_starts_at_a_trim_point_and_fits_the_budget():
+    history = turns(40)
+    window = select_history_window(history, 200)
+    assert window == history[-len(window):]
+    assert sum(turn.tokens for turn in window) <= 200
+    assert is_trim_point(window[0])
+
+
+def test_window_start_stays_put_until_it_no_longer_fits():
+    history = turns(200)
+    starts = []
+    for count in range(30, 200):
+        window = select_history_window(history[:count], 200)
+        assert sum(turn.tokens for turn in window) <= 200
+        starts.append(window[0])
+    changes = sum(1 for previous, current in zip(starts, starts[1:]) if current is not previous)
+    # Trimming one turn at a time would move the start on every new turn
+    assert changes < len(starts) / 3
+
+
+def test_trimming_is_turn_by_turn_with_block_of_one():
+    assert all(is_trim_point(turn, block=1) for turn in turns(10))
+
+
+def test_summary_is_always_sent_and_comes_out_of_the_budget():
+    summary = format_summary("The user is called Ann.")
+    history = [Turn(f"question {index}", f"answer {index}", 100) for index in range(100)]
+    num_ctx = estimate_tokens("system") + estimate_tokens("hi") + CONTEXT_RESPONSE_RESERVE + 1000
+    messages = build_messages("system", history, "hi", num_ctx, summary)
+    assert messages[1:3] == [
+        {"role": "user", "content": summary.user_input},
+        {"role": "assistant", "content": summary.model_response},
+    ]
+    # The remaining messages are the window, sized to what the summary left over
+    window_turns = (len(messages) - 4) // 2
+    assert window_turns == len(select_history_window(history, 1000 - summary.tokens))
+    assert messages[-2]["content"] == "answer 99"
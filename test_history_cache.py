@@ -0,0 +1,90 @@
+from context import format_turn
+from history_cache import HistoryCache
+
+
+def turn(text: str):
+    return format_turn(text, text)
+
+
+def test_append_extends_entry_when_previous_id_matches(clock):
+    cache = HistoryCache()
+    cache.put("s1", [turn("a")], 1)
+    cache.append("s1", turn("b"), 2, previous_id=1)
+    entry = cache.get("s1")
+    assert [t.user_input for t in entry.turns] == ["a", "b"]
+    assert entry.last_id == 2
+
+
+def test_append_drops_entry_when_previous_id_is_stale(clock):
+    cache = HistoryCache()
+    cache.put("s1", [turn("a")], 1)
+    # Another worker wrote row 2, so this insert saw it as the newest row
+    cache.append("s1", turn("c"), 3, previous_id=2)
+    assert cache.get("s1") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_append_ignores_uncached_session(clock):
+    cache = HistoryCache()
+    cache.append("s1", turn("a"), 1, previous_id=None)
+    assert cache.get("s1") is None
+
+
+def test_append_keeps_summary_and_turn_limit(clock):
+    cache = HistoryCache(max_turns=2)
+    summary = turn("summary")
+    cache.put("s1", [turn("a"), turn("b")], 2, summary)
+    cache.append("s1", turn("c"), 3, previous_id=2)
+    entry = cache.get("s1")
+    assert entry.summary == summary
+    assert [t.user_input for t in entry.turns] == ["b", "c"]
+
+
+def test_evicts_least_recently_used_over_byte_limit(clock):
+    # Every turn below holds 2 bytes: its input and response are one character each
+    cache = HistoryCache(max_bytes=4)
+    cache.put("s1", [turn("a")], 1)
+    cache.put("s2", [turn("b")], 1)
+    assert cache.get("s1") is not None
+    cache.put("s3", [turn("c")], 1)
+    assert cache.get("s2") is None
+    assert cache.get("s1") is not None and cache.get("s3") is not None
+    assert cache.stats()["bytes"] == 4
+    assert cache.stats()["evictions"] == 1
+
+
+def test_append_that_grows_past_byte_limit_evicts_others_first(clock):
+    cache = HistoryCache(max_bytes=4)
+    cache.put("s1", [turn("a")], 1)
+    cache.put("s2", [turn("b")], 1)
+    cache.append("s2", turn("c"), 2, previous_id=1)
+    assert cache.get("s1") is None
+    assert [t.user_input for t in cache.get("s2").turns] == ["b", "c"]
+
+
+def test_entry_larger_than_limit_is_not_cached(clock):
+    cache = HistoryCache(max_bytes=3)
+    cache.put("s1", [turn("ab")], 1)
+    assert cache.get("s1") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_entries_expire_after_idle_ttl(clock):
+    cache = HistoryCache(ttl=10)
+    cache.put("s1", [turn("a")], 1)
+    cache.put("s2", [turn("b")], 1)
+    clock.now += 8
+    # Access slides the expiry of s1 only
+    assert cache.get("s1") is not None
+    clock.now += 8
+    assert cache.get("s2") is None
+    assert cache.get("s1") is not None
+
+
+def test_expired_entries_are_evicted_on_put(clock):
+    cache = HistoryCache(ttl=10)
+    cache.put("s1", [turn("a")], 1)
+    clock.now += 11
+    cache.put("s2", [turn("b")], 1)
+    assert cache.stats()["sessions"] == 1
+    assert cache.stats()["bytes"] == 2
@@ -0,0 +1,197 @@
+import asyncio
+
+import pytest
+
+from idempotency import InflightRequests, KeyReused, body_digest, request_key
+
+
+async def reply(*items):
+    for item in items:
+        await asyncio.sleep(0)
+        yield item
+
+
+async def failing():
+    await asyncio.sleep(0)
+    raise RuntimeError("model failed")
+    yield
+
+
+def test_request_key_scopes_explicit_keys_to_the_session():
+    assert request_key("chat", "s1", "a", "k1") == request_key("chat", "s1", "b", "k1")
+    assert request_key("chat", "s1", "a", "k1") != request_key("chat", "s2", "a", "k1")
+    assert request_key("chat", "s1", "a", None) != request_key("chat", "s1", "b", None)
+    assert request_key("chat", None, "a", None) is None
+
+
+def test_identical_requests_share_one_run():
+    async def scenario():
+        registry = InflightRequests()
+        runs = []
+
+        async def produce():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            yield "reply"
+
+        shared, leader = registry.claim("k")
+        shared.run(produce())
+        joined, joined_leader = registry.claim("k")
+        await joined.joined()
+        results = await asyncio.gather(shared.result(), joined.result())
+        return shared, joined, leader, joined_leader, results, runs, registry
+
+    shared, joined, leader, joined_leader, results, runs, registry = asyncio.run(scenario())
+    assert joined is shared
+    assert leader and not joined_leader
+    assert results == ["reply", "reply"]
+    assert runs == [1]
+    assert registry.stats()["joined_total"] == 1
+    assert registry.stats()["running"] == 0
+
+
+def test_late_subscriber_gets_the_items_sent_so_far():
+    async def scenario():
+        registry = InflightRequests()
+        shared, _ = registry.claim("k")
+        release = asyncio.Event()
+
+        async def produce():
+            yield "session"
+            yield "token"
+            await release.wait()
+            yield "done"
+
+        shared.run(produce())
+        first = shared.subscribe()
+        assert await first.__anext__() == "session"
+        assert await first.__anext__() == "token"
+        late, _ = registry.claim("k")
+        second = late.subscribe()
+        release.set()
+        return [item async for item in first], [item async for item in second]
+
+    first_rest, second_all = asyncio.run(scenario())
+    assert first_rest == ["done"]
+    assert second_all == ["session", "token", "done"]
+
+
+def test_last_reader_leaving_cancels_the_work():
+    async def scenario():
+        registry = InflightRequests()
+        cancelled = asyncio.Event()
+
+        async def produce():
+            try:
+                await asyncio.Event().wait()
+                yield "never"
+            finally:
+                cancelled.set()
+
+        shared, _ = registry.claim("k")
+        shared.run(produce())
+        readers = [asyncio.create_task(shared.result()) for _ in range(2)]
+        await asyncio.sleep(0)
+        readers[0].cancel()
+        await asyncio.gather(readers[0], return_exceptions=True)
+        await asyncio.sleep(0)
+        still_running = not cancelled.is_set()
+        readers[1].cancel()
+        await asyncio.gather(readers[1], return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 5)
+        _, leader = registry.claim("k")
+        return still_running, leader
+
+    still_running, leader = asyncio.run(scenario())
+    assert still_running
+    # A retry after everyone left starts over
+    assert leader
+
+
+def test_keyed_result_is_replayed_after_it_finished():
+    async def scenario():
+        registry = InflightRequests()
+        shared, _ = registry.claim("k", keep=True, fingerprint=body_digest("a"))
+        shared.run(reply("reply"))
+        first = await shared.result()
+        replay, leader = registry.claim("k", keep=True, fingerprint=body_digest("a"))
+        return first, await replay.result(), leader, registry.stats()
+
+    first, replayed, leader, stats = asyncio.run(scenario())
+    assert first == replayed == "reply"
+    assert not leader
+    assert stats["replayed_total"] == 1 and stats["replayable"] == 1
+
+
+def test_unkeyed_result_is_not_replayed():
+    async def scenario():
+        registry = InflightRequests()
+        shared, _ = registry.claim("k")
+        shared.run(reply("reply"))
+        await shared.result()
+        return registry.claim("k")[1]
+
+    assert asyncio.run(scenario())
+
+
+def test_failure_is_not_replayed():
+    async def scenario():
+        registry = InflightRequests()
+        shared, _ = registry.claim("k", keep=True)
+        shared.run(failing())
+        with pytest.raises(RuntimeError):
+            await shared.result()
+        return registry.claim("k", keep=True)[1]
+
+    assert asyncio.run(scenario())
+
+
+def test_rejected_start_fails_the_joined_requests():
+    async def scenario():
+        registry = InflightRequests()
+        shared, _ = registry.claim("k")
+        joined, _ = registry.claim("k")
+        waiter = asyncio.create_task(joined.joined())
+        await asyncio.sleep(0)
+        shared.fail(ValueError("rate limited"))
+        with pytest.raises(ValueError):
+            await waiter
+        return registry.claim("k")[1]
+
+    assert asyncio.run(scenario())
+
+
+def test_reused_key_with_different_body_is_rejected():
+    async def scenario():
+        registry = InflightRequests()
+        shared, _ = registry.claim("k", keep=True, fingerprint=body_digest("a"))
+        with pytest.raises(KeyReused):
+            registry.claim("k", keep=True, fingerprint=body_digest("DIFFERENT"))
+        shared.run(reply("reply"))
+        await shared.result()
+        with pytest.raises(KeyReused):
+            registry.claim("k", keep=True, fingerprint=body_digest("DIFFERENT"))
+        return registry.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["reused_total"] == 2
+    assert stats["replayed_total"] == 0
+
+
+def test_replayable_results_expire(clock):
+
+    async def scenario():
+        registry = InflightRequests(ttl=10, max_keys=1)
+        for key in ("k1", "k2"):
+            shared, _ = registry.claim(key, keep=True)
+            shared.run(reply(key))
+            await shared.result()
+        # Over max_keys, the oldest result was forgotten
+        evicted = registry.claim("k1", keep=True)[1]
+        kept = registry.claim("k2", keep=True)[1]
+        clock.now += 10
+        expired = registry.claim("k2", keep=True)[1]
+        return evicted, kept, expired
+
+    evicted, kept, expired = asyncio.run(scenario())
+    assert evicted and not kept and expired
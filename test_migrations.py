@@ -0,0 +1,99 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+import psycopg2
+import pytest
+
+from db import POSTGRES_HOST, POSTGRES_PASSWORD, POSTGRES_PORT, POSTGRES_USER, Database, fetch_history, insert_turns
+from migrations import MIGRATIONS, list_partitions, run_migrations
+
+# conversation_history as created by the original initdb/init.sql
+BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversation_history (
+    id SERIAL PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    user_input TEXT NOT NULL,
+    model_response TEXT NOT NULL,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_session_id ON conversation_history(session_id);
+"""
+
+
+@pytest.fixture
+def baseline_db():
+    """A scratch database on the configured server, holding the baseline schema and a few turns."""
+    server = {
+        "host": POSTGRES_HOST, "port": POSTGRES_PORT, "user": POSTGRES_USER,
+        "password": POSTGRES_PASSWORD, "database": "postgres", "connect_timeout": 3,
+    }
+    try:
+        admin = psycopg2.connect(**server)
+    except psycopg2.OperationalError as db_error:
+        pytest.skip(f"PostgreSQL is not reachable: {db_error}")
+    admin.autocommit = True
+    name = f"migration_test_{uuid.uuid4().hex[:12]}"
+    with admin.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE "{name}"')
+    connect_kwargs = dict(server, database=name)
+    try:
+        conn = psycopg2.connect(**connect_kwargs)
+        with conn, conn.cursor() as cursor:
+            cursor.execute(BASELINE_SCHEMA)
+            cursor.execute(
+                "INSERT INTO conversation_history (session_id, user_input, model_response, timestamp) VALUES "
+                "('s1', 'hello', 'hi', '2024-03-05 10:00'), ('s1', 'name?', 'Ann', '2024-04-01 09:00'), "
+                "('s2', 'old', 'row', NULL)"
+            )
+        conn.close()
+        yield connect_kwargs
+    finally:
+        with admin.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+        admin.close()
+
+
+def migrate(connect_kwargs) -> bool:
+    async def run():
+        db = Database(1, 2, **connect_kwargs)
+        await db.open()
+        try:
+            return await run_migrations(db)
+        finally:
+            db.close()
+    return asyncio.run(run())
+
+
+def test_migrates_baseline_schema(baseline_db):
+    assert migrate(baseline_db)
+
+    conn = psycopg2.connect(**baseline_db)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'conversation_history'::regclass")
+            assert cursor.fetchone()[0] == "p"
+            cursor.execute("SELECT version FROM schema_migrations ORDER BY version")
+            assert [row[0] for row in cursor.fetchall()] == [migration.version for migration in MIGRATIONS]
+            cursor.execute("SELECT count(*) FROM conversation_history")
+            assert cursor.fetchone()[0] == 3
+
+        partitions = list_partitions(conn)
+        legacy = partitions[0]
+        assert legacy.name == "conversation_history_legacy"
+        assert legacy.lower is None and legacy.upper == datetime(2024, 5, 1)
+        assert any(partition.lower is not None and partition.lower <= datetime.utcnow() < partition.upper
+                   for partition in partitions)
+
+        # New turns continue the old ids and land in the current month's partition
+        [(row_id, previous_id)] = insert_turns(conn, [("s1", "again", "hello Ann", datetime.utcnow())])
+        conn.commit()
+        summary, rows = fetch_history(conn, "s1", 10)
+        assert summary is None
+        assert [row["user_input"] for row in rows] == ["hello", "name?", "again"]
+        assert row_id > previous_id == rows[1]["id"]
+    finally:
+        conn.close()
+
+    # Applying the migrations again changes nothing
+    assert migrate(baseline_db)
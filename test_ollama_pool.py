@@ -0,0 +1,197 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import ollama_pool
+from ollama_pool import OllamaPool
+
+PAYLOAD = {"model": "m", "prompt": "hi"}
+
+
+def ndjson(*chunks):
+    return "".join(json.dumps(chunk) + "\n" for chunk in chunks).encode("utf-8")
+
+
+def reply(text: str = "hello"):
+    return httpx.Response(200, content=ndjson({"response": text, "done": False}, {"response": "", "done": True}))
+
+
+def pool_with(handlers):
+    """A pool of one backend per handler, named a, b, ... and reached through a mock transport."""
+    calls = []
+
+    async def handle(request: httpx.Request):
+        calls.append(request.url.host)
+        return await handlers[request.url.host](request)
+
+    urls = [f"http://{host}:11434" for host in handlers]
+    return OllamaPool(urls, transport=httpx.MockTransport(handle)), calls
+
+
+def prefer_first(pool: OllamaPool):
+    # The other backends look busier, so the first one is picked first
+    for backend in pool.backends[1:]:
+        backend.begin("other")
+
+
+async def collect(pool: OllamaPool, session_id=None):
+    return [chunk async for chunk in pool.stream(PAYLOAD, session_id=session_id)]
+
+
+@pytest.fixture(autouse=True)
+def fast_first_token(monkeypatch):
+    monkeypatch.setattr(ollama_pool, "OLLAMA_FIRST_TOKEN_TIMEOUT", 0.05)
+
+
+@pytest.mark.parametrize("failure", ["connect", "server_error"])
+def test_fails_over_before_the_first_chunk(failure):
+    async def broken(request):
+        if failure == "connect":
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(503, text="loading")
+
+    async def healthy(request):
+        return reply()
+
+    async def scenario():
+        pool, calls = pool_with({"a": broken, "b": healthy})
+        prefer_first(pool)
+        chunks = await collect(pool)
+        await pool.aclose()
+        return pool, calls, chunks
+
+    pool, calls, chunks = asyncio.run(scenario())
+    assert calls == ["a", "b"]
+    assert chunks[0]["response"] == "hello"
+    assert pool.failovers_total == 1
+    assert pool.backends[0].failures == 1 and pool.backends[1].failures == 0
+
+
+def test_no_failover_once_streaming_started():
+    async def cut_off(request):
+        async def body():
+            yield ndjson({"response": "hel", "done": False})
+            raise httpx.ReadError("connection reset")
+        return httpx.Response(200, content=body())
+
+    async def healthy(request):
+        return reply()
+
+    async def scenario():
+        pool, calls = pool_with({"a": cut_off, "b": healthy})
+        prefer_first(pool)
+        received = []
+        with pytest.raises(httpx.ReadError):
+            async for chunk in pool.stream(PAYLOAD):
+                received.append(chunk)
+        await pool.aclose()
+        return pool, calls, received
+
+    pool, calls, received = asyncio.run(scenario())
+    # Retrying elsewhere would send the caller a second, different beginning
+    assert calls == ["a"]
+    assert [chunk["response"] for chunk in received] == ["hel"]
+    assert pool.failovers_total == 0
+
+
+def test_client_errors_are_not_backend_failures():
+    async def not_found(request):
+        return httpx.Response(404, json={"error": "model 'm' not found"})
+
+    async def healthy(request):
+        return reply()
+
+    async def scenario():
+        pool, calls = pool_with({"a": not_found, "b": healthy})
+        prefer_first(pool)
+        response = await pool.complete(PAYLOAD)
+        await pool.aclose()
+        return pool, calls, response
+
+    pool, calls, response = asyncio.run(scenario())
+    # The request itself is wrong, so another backend would answer the same
+    assert calls == ["a"]
+    assert response.status_code == 404
+    assert pool.backends[0].failures == 0 and not pool.backends[0].ejected
+
+
+def test_slow_first_chunk_fails_over_without_ejecting():
+    async def slow(request):
+        await asyncio.sleep(1)
+        return reply("late")
+
+    async def healthy(request):
+        return reply()
+
+    async def scenario():
+        pool, calls = pool_with({"a": slow, "b": healthy})
+        prefer_first(pool)
+        for _ in range(ollama_pool.OLLAMA_EJECT_FAILURES + 1):
+            assert (await collect(pool))[0]["response"] == "hello"
+        await pool.aclose()
+        return pool
+
+    pool = asyncio.run(scenario())
+    slow_backend = pool.backends[0]
+    assert slow_backend.slow_starts_total == ollama_pool.OLLAMA_EJECT_FAILURES + 1
+    assert slow_backend.failures == 0 and not slow_backend.ejected
+    assert pool.failovers_total == ollama_pool.OLLAMA_EJECT_FAILURES + 1
+
+
+def test_sessions_stick_to_their_backend_within_the_slack(monkeypatch):
+    monkeypatch.setattr(ollama_pool, "OLLAMA_STICKY_SLACK", 2)
+    pool = OllamaPool(["http://a:11434", "http://b:11434"])
+    first = pool.pick("m", "s1")
+    other = next(backend for backend in pool.backends if backend is not first)
+    # The session's backend may carry up to two more requests than the least busy one
+    first.begin("m")
+    first.begin("m")
+    assert pool.pick("m", "s1") is first
+    first.begin("m")
+    assert pool.pick("m", "s1") is other
+    # The session now sticks to the backend it moved to
+    first.end("m")
+    first.end("m")
+    first.end("m")
+    assert pool.pick("m", "s1") is other
+    # Sessions without an id always take the least busy backend
+    other.begin("m")
+    assert pool.pick("m") is first
+
+
+def test_backend_is_ejected_and_recovers_after_a_health_check():
+    state = {"down": True}
+
+    async def flaky(request):
+        if state["down"]:
+            raise httpx.ConnectError("connection refused", request=request)
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": [{"name": "m:latest"}]})
+        return reply()
+
+    async def healthy(request):
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": [{"name": "m:latest"}]})
+        return reply()
+
+    async def scenario():
+        pool, calls = pool_with({"a": flaky, "b": healthy})
+        for _ in range(ollama_pool.OLLAMA_EJECT_FAILURES):
+            prefer_first(pool)
+            await collect(pool)
+        ejected = pool.backends[0].ejected
+        # Ejected backends are skipped even when they look less busy
+        picked_while_ejected = pool.pick("m")
+        state["down"] = False
+        await pool.check_health()
+        recovered = not pool.backends[0].ejected
+        await pool.aclose()
+        return pool, ejected, picked_while_ejected, recovered
+
+    pool, ejected, picked_while_ejected, recovered = asyncio.run(scenario())
+    assert ejected
+    assert picked_while_ejected is pool.backends[1]
+    assert recovered
+    assert pool.backends[0].failures == 0
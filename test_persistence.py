@@ -0,0 +1,206 @@
+import asyncio
+import os
+from typing import Optional
+
+import pytest
+
+import persistence
+from context import format_turn
+from db import insert_turns
+from history_cache import HistoryCache
+from persistence import TurnWriter
+
+
+class FakeDatabase:
+    """Stands in for :class:`db.Database`, keeping inserted rows in a list."""
+
+    def __init__(self):
+        self.rows = []
+        self.fail = False
+        # While set, inserts wait after assigning row ids, as if the commit were slow
+        self.gate: Optional[asyncio.Event] = None
+
+    async def run(self, fn, *args):
+        assert fn is insert_turns
+        if self.fail:
+            raise RuntimeError("database is down")
+        rows, on_inserted = args[0], args[1] if len(args) > 1 else None
+        results = []
+        for session_id, user_input, model_response, created_at in rows:
+            previous_id = max((row[0] for row in self.rows if row[1] == session_id), default=None)
+            row_id = len(self.rows) + 1
+            self.rows.append((row_id, session_id, user_input, model_response, created_at))
+            results.append((row_id, previous_id))
+        if on_inserted is not None:
+            on_inserted(results)
+        if self.gate is not None:
+            await self.gate.wait()
+        return results
+
+
+@pytest.fixture(autouse=True)
+def no_retries(monkeypatch):
+    monkeypatch.setattr(persistence, "PERSIST_MAX_RETRIES", 1)
+    monkeypatch.setattr(persistence, "PERSIST_RETRY_BACKOFF", 0)
+
+
+async def wait_for(condition):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), 5)
+
+
+def test_pending_turns_skip_rows_the_caller_already_has(tmp_path):
+    async def scenario():
+        db = FakeDatabase()
+        db.gate = asyncio.Event()
+        cache = HistoryCache()
+        writer = TurnWriter(db, cache, spill_path=str(tmp_path / "spill.jsonl"))
+        await writer.start()
+        writer.submit("s1", "first", "one")
+        writer.submit("s1", "second", "two")
+        writer.submit("s2", "other", "three")
+        queued = [turn.user_input for turn in writer.pending_turns("s1")]
+        # Ids are assigned, but the batch has not finished committing yet
+        await wait_for(lambda: len(db.rows) == 3)
+        without_cutoff = [turn.user_input for turn in writer.pending_turns("s1")]
+        after_first = [turn.user_input for turn in writer.pending_turns("s1", stored_through=1)]
+        after_both = writer.pending_turns("s1", stored_through=2)
+        db.gate.set()
+        await writer.stop()
+        return queued, without_cutoff, after_first, after_both, writer
+
+    queued, without_cutoff, after_first, after_both, writer = asyncio.run(scenario())
+    assert queued == ["first", "second"]
+    assert without_cutoff == ["first", "second"]
+    assert after_first == ["second"]
+    assert after_both == []
+    assert writer.pending_turns("s1") == []
+    assert writer.written_total == 3
+
+
+def test_written_turns_extend_the_cached_history(tmp_path):
+    async def scenario():
+        db = FakeDatabase()
+        cache = HistoryCache()
+        cache.put("s1", [], None)
+        writer = TurnWriter(db, cache, spill_path=str(tmp_path / "spill.jsonl"))
+        await writer.start()
+        writer.submit("s1", "hello", "hi")
+        await writer.stop()
+        return cache
+
+    cache = asyncio.run(scenario())
+    entry = cache.get("s1")
+    assert entry.turns == [format_turn("hello", "hi")]
+    assert entry.last_id == 1
+
+
+def test_failed_turns_are_spilled_and_replayed(tmp_path):
+    spill_path = str(tmp_path / "spill.jsonl")
+
+    async def scenario():
+        db = FakeDatabase()
+        db.fail = True
+        cache = HistoryCache()
+        writer = TurnWriter(db, cache, spill_path=spill_path)
+        await writer.start()
+        writer.submit("s1", "hello", "hi")
+        writer.submit("s2", "name?", "Ann")
+        await wait_for(lambda: writer.spilled_total == 2)
+        assert os.path.exists(spill_path)
+        # Spilled turns still reach the next prompt
+        assert [turn.user_input for turn in writer.pending_turns("s1")] == ["hello"]
+
+        cache.put("s1", [], None)
+        db.fail = False
+        await writer.replay_spill()
+        await writer.stop()
+        return db, cache, writer
+
+    db, cache, writer = asyncio.run(scenario())
+    assert [row[1:4] for row in db.rows] == [("s1", "hello", "hi"), ("s2", "name?", "Ann")]
+    assert writer.pending_turns("s1") == [] and writer.pending_turns("s2") == []
+    assert writer.replayed_total == 2
+    assert not os.path.exists(spill_path)
+    assert not os.path.exists(spill_path + ".replay")
+    # Replayed rows are older than cached ones, so the cached copy is dropped
+    assert cache.get("s1") is None
+
+
+def test_replay_keeps_turns_that_still_fail(tmp_path):
+    spill_path = str(tmp_path / "spill.jsonl")
+
+    async def scenario():
+        db = FakeDatabase()
+        db.fail = True
+        writer = TurnWriter(db, HistoryCache(), spill_path=spill_path)
+        await writer.start()
+        writer.submit("s1", "hello", "hi")
+        await wait_for(lambda: writer.spilled_total == 1)
+        await writer.replay_spill()
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert writer.replayed_total == 0
+    with open(spill_path, encoding="utf-8") as spill_file:
+        assert [persistence.PendingTurn.from_json(line).user_input for line in spill_file] == ["hello"]
+
+
+def test_turns_spilled_when_the_queue_is_full_stay_pending(tmp_path):
+    spill_path = str(tmp_path / "spill.jsonl")
+
+    async def scenario():
+        writer = TurnWriter(FakeDatabase(), HistoryCache(), max_queue=1, spill_path=spill_path)
+        # Not started, so the first turn fills the queue
+        writer.submit("s1", "first", "one")
+        writer.submit("s1", "second", "two")
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert writer.spilled_total == 1
+    assert [turn.user_input for turn in writer.pending_turns("s1")] == ["first", "second"]
+
+
+def test_spill_is_replayed_on_its_own_timer(tmp_path, monkeypatch):
+    monkeypatch.setattr(persistence, "PERSIST_REPLAY_INTERVAL", 0.01)
+    spill_path = str(tmp_path / "spill.jsonl")
+
+    async def scenario():
+        db = FakeDatabase()
+        db.fail = True
+        writer = TurnWriter(db, HistoryCache(), spill_path=spill_path)
+        await writer.start()
+        writer.submit("s1", "hello", "hi")
+        await wait_for(lambda: writer.spilled_total == 1)
+        # No new turn is written, yet the spill file is replayed once the database is back
+        db.fail = False
+        await wait_for(lambda: writer.replayed_total == 1)
+        pending = writer.pending_turns("s1", stored_through=1)
+        await writer.stop()
+        return db, pending
+
+    db, pending = asyncio.run(scenario())
+    assert [row[1:4] for row in db.rows] == [("s1", "hello", "hi")]
+    assert pending == []
+
+
+def test_turns_replayed_by_another_worker_are_no_longer_pending(tmp_path, monkeypatch):
+    monkeypatch.setattr(persistence, "PERSIST_REPLAY_INTERVAL", 0.01)
+    spill_path = str(tmp_path / "spill.jsonl")
+
+    async def scenario():
+        db = FakeDatabase()
+        db.fail = True
+        writer = TurnWriter(db, HistoryCache(), spill_path=spill_path)
+        await writer.start()
+        writer.submit("s1", "hello", "hi")
+        await wait_for(lambda: writer.spilled_total == 1)
+        # The worker sharing the spill file took it and wrote the turn
+        os.remove(spill_path)
+        await wait_for(lambda: writer.pending_turns("s1") == [])
+        await writer.stop()
+
+    asyncio.run(scenario())
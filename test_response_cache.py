@@ -0,0 +1,84 @@
+import asyncio
+
+from response_cache import ResponseCache
+
+
+def chat(content: str, **options):
+    return {
+        "model": "m",
+        "messages": [{"role": "system", "content": "Be brief."}, {"role": "user", "content": content}],
+        "options": dict({"temperature": 0}, **options),
+    }
+
+
+def test_key_covers_model_and_options():
+    cache = ResponseCache(enabled=True)
+    key = cache.key(chat("hello"))
+    assert key == cache.key(chat("hello"))
+    assert key != cache.key(chat("hello", num_ctx=8192))
+    assert key != cache.key(dict(chat("hello"), model="other"))
+    assert key != cache.key(chat("hello again"))
+
+
+def test_key_normalizes_whitespace():
+    cache = ResponseCache(enabled=True)
+    assert cache.key(chat("hello   there\n")) == cache.key(chat(" hello there"))
+    prompt = {"model": "m", "prompt": "User: hi\n\nAssistant:", "options": {"temperature": 0}}
+    spaced = dict(prompt, prompt="User:  hi \nAssistant: ")
+    assert cache.key(prompt) == cache.key(spaced)
+
+
+def test_sampled_requests_bypass_the_cache():
+    cache = ResponseCache(enabled=True)
+    assert cache.key(chat("hello", temperature=0.7)) is None
+    # Without a temperature Ollama samples at its default
+    assert cache.key({"model": "m", "prompt": "hi"}) is None
+    assert cache.stats()["bypassed"] == 2
+    sampling = ResponseCache(enabled=True, allow_sampling=True)
+    assert sampling.key(chat("hello", temperature=0.7)) is not None
+
+
+def test_disabled_cache_has_no_keys():
+    assert ResponseCache(enabled=False).key(chat("hello")) is None
+
+
+def test_evicts_least_recently_used_over_byte_limit():
+    async def scenario():
+        cache = ResponseCache(enabled=True, max_bytes=6)
+        await cache.put("a", "m", "aa")
+        await cache.put("b", "m", "bb")
+        await cache.put("c", "m", "cc")
+        # Reading "a" makes "b" the least recently used
+        assert await cache.get("a") == "aa"
+        await cache.put("d", "m", "dd")
+        return cache, [await cache.get(key) for key in "abcd"]
+
+    cache, responses = asyncio.run(scenario())
+    assert responses == ["aa", None, "cc", "dd"]
+    assert cache.stats()["bytes"] == 6
+
+
+def test_response_larger_than_limit_is_not_cached():
+    async def scenario():
+        cache = ResponseCache(enabled=True, max_bytes=3)
+        await cache.put("a", "m", "abcd")
+        return cache, await cache.get("a")
+
+    cache, response = asyncio.run(scenario())
+    assert response is None
+    assert cache.stats()["entries"] == 0 and cache.stats()["bytes"] == 0
+
+
+def test_entries_expire_after_ttl(clock):
+
+    async def scenario():
+        cache = ResponseCache(enabled=True, ttl=10)
+        await cache.put("a", "m", "aa")
+        clock.now += 10
+        fresh = await cache.get("a")
+        clock.now += 1
+        return cache, fresh, await cache.get("a")
+
+    cache, fresh, expired = asyncio.run(scenario())
+    assert fresh == "aa" and expired is None
+    assert cache.stats()["bytes"] == 0
@@ -0,0 +1,250 @@
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import CircuitBreaker, ModelQueue, QueueFull, RateLimited, RateLimiter, Scheduler
+
+
+def test_queue_serves_sessions_round_robin():
+    async def scenario():
+        queue = ModelQueue("m", max_concurrency=1)
+        await queue.acquire("holder")
+        order = []
+
+        async def request(session_id, name):
+            await queue.acquire(session_id)
+            order.append(name)
+            queue.release()
+
+        tasks = [asyncio.create_task(request(session_id, name)) for session_id, name in
+                 [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1")]]
+        await asyncio.sleep(0)
+        assert queue.queued == 5
+        queue.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        return order, queue
+
+    order, queue = asyncio.run(scenario())
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert queue.active == 0 and queue.queued == 0
+
+
+def test_queue_rejects_over_session_and_total_limits():
+    async def scenario():
+        queue = ModelQueue("m", max_concurrency=1, max_queue=3, max_queue_per_session=2)
+        await queue.acquire("holder")
+        tasks = [asyncio.create_task(queue.acquire("a")) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            queue.check_capacity("a")
+        tasks.append(asyncio.create_task(queue.acquire("b")))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            queue.check_capacity("c")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.rejected_total == 2
+    assert queue.queued == 0 and queue.active == 1
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        queue = ModelQueue("m", max_concurrency=1)
+        await queue.acquire("holder")
+        waiter = asyncio.create_task(queue.acquire("a"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert queue.queued == 0
+        queue.release()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.active == 0
+
+
+def test_waiter_cancelled_while_slot_is_granted_releases_it():
+    async def scenario():
+        queue = ModelQueue("m", max_concurrency=1)
+        await queue.acquire("holder")
+        waiter = asyncio.create_task(queue.acquire("a"))
+        other = asyncio.create_task(queue.acquire("b"))
+        await asyncio.sleep(0)
+        # The slot goes to the waiter, which is cancelled before it resumes
+        queue.release()
+        waiter.cancel()
+        # A leaked slot would leave the other waiter queued forever
+        results = await asyncio.wait_for(asyncio.gather(waiter, other, return_exceptions=True), 5)
+        assert isinstance(results[0], asyncio.CancelledError)
+        # The released slot went on to the next session in line
+        assert queue.active == 1 and queue.queued == 0
+        queue.release()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.active == 0
+
+
+class FakeCoordinator:
+    """Stands in for :class:`coordination.Coordinator`; shared by the schedulers of several "workers"."""
+
+    def __init__(self):
+        self.held = set()
+
+    async def try_slot(self, name, slots):
+        await asyncio.sleep(0)
+        number = next((number for number in range(slots) if (name, number) not in self.held), None)
+        if number is not None:
+            self.held.add((name, number))
+        return number
+
+    async def release_slot(self, name, number):
+        self.held.remove((name, number))
+
+
+def test_slots_are_shared_by_all_workers(monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_SLOT_POLL_INTERVAL", 0.01)
+
+    async def scenario():
+        coordinator = FakeCoordinator()
+        workers = [Scheduler(max_concurrency=2, coordinator=coordinator) for _ in range(2)]
+        release = asyncio.Event()
+        running = []
+
+        async def generate(worker, session_id):
+            async with worker.slot("m", session_id):
+                running.append(session_id)
+                await release.wait()
+
+        # One worker may use every slot while the other is idle
+        first = [asyncio.create_task(generate(workers[0], f"a{index}")) for index in range(2)]
+        await asyncio.sleep(0.05)
+        assert len(running) == 2
+        late = asyncio.create_task(generate(workers[1], "b"))
+        await asyncio.sleep(0.05)
+        # The other worker waits for a shared slot, not just its own
+        assert running == ["a0", "a1"]
+        assert workers[1].stats()["m"]["shared_slot_waiting"] == 1
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*first, late), 5)
+        return running, coordinator
+
+    running, coordinator = asyncio.run(scenario())
+    assert running[-1] == "b"
+    assert coordinator.held == set()
+
+
+def test_cancelled_wait_for_a_shared_slot_gives_it_back(monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_SLOT_POLL_INTERVAL", 0.01)
+
+    async def scenario():
+        coordinator = FakeCoordinator()
+        worker = Scheduler(max_concurrency=1, coordinator=coordinator)
+
+        async def generate():
+            async with worker.slot("m", "a"):
+                pass
+
+        # Cancelled while the attempt that takes the lock is in flight
+        task = asyncio.create_task(generate())
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        return worker, coordinator
+
+    worker, coordinator = asyncio.run(scenario())
+    assert coordinator.held == set()
+    assert worker.stats()["m"]["active"] == 0
+
+
+def test_breaker_opens_after_threshold_and_probes_after_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    clock.now += 30
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    # Only one probe at a time
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+
+
+def test_breaker_replaces_a_probe_that_never_reports_back(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow_request()
+    clock.now += 29
+    assert not breaker.allow_request()
+    clock.now += 1
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_the_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    clock.now += 30
+    assert breaker.allow_request()
+
+
+def test_rate_limiter_allows_burst_then_refills(clock):
+    limiter = RateLimiter("session", rate=0.5, burst=2)
+    limiter.take("s1")
+    limiter.take("s1")
+    with pytest.raises(RateLimited) as limited:
+        limiter.take("s1")
+    assert limited.value.retry_after == 2
+    # Other keys have their own buckets
+    limiter.take("s2")
+    clock.now += 2
+    limiter.take("s1")
+    assert limiter.stats()["rejected_total"] == 1
+
+
+def test_rate_limiter_drops_buckets_once_refilled(clock):
+    limiter = RateLimiter("session", rate=1, burst=2)
+    limiter.take("s1")
+    limiter.take("s2")
+    clock.now += 1
+    limiter.take("s3")
+    assert limiter.stats()["keys"] == 3
+    # After burst / rate seconds idle a bucket is full again, so it is forgotten
+    clock.now += 1
+    limiter.take("s3")
+    assert limiter.stats()["keys"] == 1
+
+
+def test_rate_limiter_keeps_the_most_recent_keys(clock):
+    limiter = RateLimiter("client", rate=1, burst=1, max_keys=2)
+    limiter.take("a")
+    limiter.take("b")
+    limiter.take("c")
+    assert limiter.stats()["keys"] == 2
+    # "a" was dropped, so it starts with a full bucket
+    limiter.take("a")
+    with pytest.raises(RateLimited):
+        limiter.take("c")
+
+
+def test_rate_limiter_disabled_at_zero_rate(clock):
+    limiter = RateLimiter("session", rate=0, burst=1)
+    for _ in range(10):
+        limiter.take("s1")
+    assert limiter.stats()["keys"] == 0
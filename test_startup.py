@@ -0,0 +1,40 @@
+import asyncio
+
+import startup
+from startup import Startup
+
+
+class FakeModels:
+    """Stands in for :class:`model_registry.ModelRegistry` with a pull that always fails."""
+
+    def __init__(self):
+        self.models = ["m"]
+        self.pulls = 0
+        self.pull_errors = {}
+
+    def is_available(self, model_name):
+        return False
+
+    async def ensure_pulled(self, model_name):
+        self.pulls += 1
+        self.pull_errors[model_name] = "status 500: disk full"
+
+
+def test_failed_pulls_back_off_and_show_in_the_snapshot(clock, monkeypatch):
+    monkeypatch.setattr(startup, "STARTUP_RETRY_INTERVAL", 2)
+    models = FakeModels()
+    phase = Startup(None, None, models, lambda model_name: {})
+
+    async def attempts(seconds_between):
+        pulls = []
+        for seconds in seconds_between:
+            clock.now += seconds
+            await phase._prepare_model("m")
+            pulls.append(models.pulls)
+        return pulls
+
+    # Retries wait 2, 4, then 8 seconds
+    assert asyncio.run(attempts([0, 1, 1, 3, 1, 7, 1])) == [1, 1, 2, 2, 3, 3, 4]
+    snapshot = phase.snapshot()
+    assert snapshot["models"] == {"m": "pull_failed"}
+    assert "disk full" in snapshot["model_errors"]["m"]